@@ -23,6 +23,62 @@ export async function api(path, options = {}) {
   return data
 }
 
+// Server-Sent Events: EventSource no permite cabeceras, así que el token va en la URL
+// (debe ser un token de corta duración, nunca el de acceso). Devuelve la función para cerrar.
+export function escucharEventos(path, { evento = 'message', onMensaje, onError }) {
+  const fuente = new EventSource(`${getBaseUrl()}${path}`)
+  fuente.addEventListener(evento, (e) => onMensaje(JSON.parse(e.data)))
+  fuente.onerror = () => {
+    fuente.close()
+    onError?.()
+  }
+  return () => fuente.close()
+}
+
+const esperar = (ms) => new Promise((r) => setTimeout(r, ms))
+
+// Estado listo para el cliente: transcripción disponible o fallo
+const estadoResuelto = (est) =>
+  (est.estado === 'completado' && est.transcripcion) || est.estado === 'fallido'
+
+async function sondearEstado(idAudio, intentos = 40, intervaloMs = 2000) {
+  for (let i = 0; i < intentos; i++) {
+    await esperar(intervaloMs)
+    const res = await api(`/api/v1/audio/${idAudio}/estado`)
+    const est = res?.datos ?? res
+    if (estadoResuelto(est)) return est
+  }
+  return null
+}
+
+// Espera la transcripción por SSE; si EventSource no existe o la conexión falla, sondea /estado
+async function esperarTranscripcion(idAudio) {
+  if (typeof EventSource === 'undefined') return sondearEstado(idAudio)
+  let token
+  try {
+    token = (await audioApi.tokenEventos(idAudio))?.datos?.token
+  } catch {
+    return sondearEstado(idAudio)
+  }
+  if (!token) return sondearEstado(idAudio)
+  return new Promise((resolve, reject) => {
+    const cerrar = escucharEventos(
+      `/api/v1/audio/${idAudio}/eventos?token=${encodeURIComponent(token)}`,
+      {
+        evento: 'estado',
+        onMensaje: (est) => {
+          // Completado sin texto ni refinado pendiente: el servidor no enviará nada más
+          const sinMas = est.estado === 'completado' && est.refinamiento !== 'pendiente'
+          if (!estadoResuelto(est) && !sinMas) return
+          cerrar()
+          resolve(est)
+        },
+        onError: () => sondearEstado(idAudio).then(resolve, reject),
+      }
+    )
+  })
+}
+
 export const authApi = {
   login: (usuario, contrasena) =>
     api('/api/v1/auth/login', {
@@ -76,8 +132,14 @@ export const audioApi = {
     return api('/api/v1/audio/subir', { method: 'POST', body: form })
   },
   estado: (idAudio) => api(`/api/v1/audio/${idAudio}/estado`),
-  listar: (limite = 50) =>
-    api(`/api/v1/audio/usuario/listar?limite=${limite}`),
+  tokenEventos: (idAudio) =>
+    api(`/api/v1/audio/${idAudio}/token-eventos`, { method: 'POST' }),
+  esperarTranscripcion: (idAudio) => esperarTranscripcion(idAudio),
+  listar: (limite = 50, cursor = null) =>
+    api(
+      `/api/v1/audio/usuario/listar?limite=${limite}` +
+        (cursor ? `&cursor=${encodeURIComponent(cursor)}` : '')
+    ),
 }
 
 export const iaApi = {
@@ -25,20 +25,13 @@ export default function AudioRecorder({ onSubido }) {
         try {
           const res = await audioApi.subir(file)
           setEstado('Transcribiendo...')
-          let transcripcion = ''
-          for (let i = 0; i < 40; i++) {
-            await new Promise((r) => setTimeout(r, 2000))
-            const est = await audioApi.estado(res.id_audio)
-            if (est.estado === 'completado' && est.transcripcion) {
-              transcripcion = est.transcripcion
-              break
-            }
-            if (est.estado === 'fallido') {
-              setError(est.error || 'Error')
-              setEstado('')
-              return
-            }
+          const est = await audioApi.esperarTranscripcion(res.id_audio)
+          if (est?.estado === 'fallido') {
+            setError(est.error || 'Error')
+            setEstado('')
+            return
           }
+          const transcripcion = est?.transcripcion || ''
           if (transcripcion) {
             setEstado('Analizando IA...')
             const analisis = await iaApi.analizar(transcripcion, false)
@@ -76,19 +69,16 @@ export default function AudioRecorder({ onSubido }) {
     setEstado('Subiendo...')
     try {
       const res = await audioApi.subir(file)
-      for (let i = 0; i < 40; i++) {
-        await new Promise((r) => setTimeout(r, 2000))
-        const est = await audioApi.estado(res.id_audio)
-        if (est.estado === 'completado' && est.transcripcion) {
-          onSubido(res.id_audio, est.transcripcion)
-          setEstado('Listo.')
-          return
-        }
-        if (est.estado === 'fallido') {
-          setError(est.error || 'Error')
-          setEstado('')
-          return
-        }
+      const est = await audioApi.esperarTranscripcion(res.id_audio)
+      if (est?.estado === 'completado') {
+        onSubido(res.id_audio, est.transcripcion || '')
+        setEstado('Listo.')
+        return
+      }
+      if (est?.estado === 'fallido') {
+        setError(est.error || 'Error')
+        setEstado('')
+        return
       }
       onSubido(res.id_audio, '')
       setEstado('Subido.')
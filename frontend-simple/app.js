@@ -149,40 +149,86 @@ function stopRecording() {
   }
 }
 
-async function esperarTranscripcion(idAudio, section) {
-  setAudioStatus(section, "Transcribiendo...");
+async function escucharEstadoAudio(idAudio, onCambio) {
+  // Server-Sent Events: el servidor empuja cada cambio de estado, sin polling
+  if (!window.EventSource) {
+    throw new Error("EventSource no disponible");
+  }
+  // EventSource no envía cabeceras: token de corta duración para este audio, no el de sesión
+  const { token } = await apiFetch(state.api.audio, `/api/v1/audio/${idAudio}/token-eventos`, { method: "POST" });
+  return new Promise((resolve, reject) => {
+    const url = `${state.api.audio}/api/v1/audio/${idAudio}/eventos?token=${encodeURIComponent(token)}`;
+    const fuente = new EventSource(url);
+    let recibido = false;
+    fuente.addEventListener("estado", (event) => {
+      recibido = true;
+      const estado = JSON.parse(event.data);
+      onCambio(estado);
+      if (estado.estado === "completado" || estado.estado === "fallido") {
+        fuente.close();
+        resolve(estado);
+      }
+    });
+    fuente.onerror = () => {
+      // EventSource reconecta solo; si nunca llegó un evento se usa polling
+      if (!recibido) {
+        fuente.close();
+        reject(new Error("SSE no disponible"));
+      }
+    };
+  });
+}
+
+async function consultarEstadoPorPolling(idAudio, onCambio) {
   const maxIntentos = 180; // ~90s con intervalo de 500ms
   for (let i = 0; i < maxIntentos; i += 1) {
     const estado = await apiFetch(state.api.audio, `/api/v1/audio/${idAudio}/estado`);
-    if (estado.estado === "completado" && estado.transcripcion) {
-      const resp = document.getElementById(`resp-${section}`);
-      if (resp) {
-        resp.textContent = JSON.stringify(
-          {
-            id_audio: estado.id_audio,
-            estado: estado.estado,
-            transcripcion_limpia: estado.transcripcion,
-            transcripcion_raw: estado.transcripcion_raw,
-            tokens_muestra: estado.tokens_muestra,
-          },
-          null,
-          2
-        );
-      }
-      await analizarIA(estado.transcripcion, section);
-      setAudioStatus(section, "Listo");
-      return;
-    }
-    if (estado.estado === "fallido") {
-      setAudioStatus(section, "Falló");
-      return;
+    onCambio(estado);
+    if (estado.estado === "completado" || estado.estado === "fallido") {
+      return estado;
     }
+    await new Promise((r) => setTimeout(r, 500));
+  }
+  return null;
+}
+
+async function esperarTranscripcion(idAudio, section) {
+  setAudioStatus(section, "Transcribiendo...");
+  const onCambio = (estado) => {
     if (estado.estado === "pendiente" || estado.estado === "procesando") {
-      setAudioStatus(section, `Transcribiendo... (${i + 1}/${maxIntentos})`);
+      setAudioStatus(section, `Transcribiendo... (${estado.estado})`);
     }
-    await new Promise((r) => setTimeout(r, 500));
+  };
+  let estado;
+  try {
+    estado = await escucharEstadoAudio(idAudio, onCambio);
+  } catch {
+    estado = await consultarEstadoPorPolling(idAudio, onCambio);
+  }
+  if (!estado) {
+    setAudioStatus(section, "Tiempo agotado (sin transcripción)");
+    return;
+  }
+  if (estado.estado === "completado" && estado.transcripcion) {
+    const resp = document.getElementById(`resp-${section}`);
+    if (resp) {
+      resp.textContent = JSON.stringify(
+        {
+          id_audio: estado.id_audio,
+          estado: estado.estado,
+          transcripcion_limpia: estado.transcripcion,
+          transcripcion_raw: estado.transcripcion_raw,
+          tokens_muestra: estado.tokens_muestra,
+        },
+        null,
+        2
+      );
+    }
+    await analizarIA(estado.transcripcion, section);
+    setAudioStatus(section, "Listo");
+    return;
   }
-  setAudioStatus(section, "Tiempo agotado (sin transcripción)");
+  setAudioStatus(section, "Falló");
 }
 
 async function analizarIA(texto, section) {
@@ -232,24 +232,64 @@ async function subirAudioArchivo(file) {
   return data;
 }
 
-async function esperarTranscripcion(idAudio) {
-  setAudioStatus("Transcribiendo…");
+async function escucharEstadoAudio(idAudio) {
+  // Server-Sent Events: el servidor empuja cada cambio de estado, sin polling
+  if (!window.EventSource) {
+    throw new Error("EventSource no disponible");
+  }
+  // EventSource no envía cabeceras: token de corta duración para este audio, no el de sesión
+  const { token } = await apiFetchService("audio", `/api/v1/audio/${idAudio}/token-eventos`, { method: "POST" });
+  return new Promise((resolve, reject) => {
+    const url = `${resolveBase("audio")}/api/v1/audio/${idAudio}/eventos?token=${encodeURIComponent(token)}`;
+    const fuente = new EventSource(url);
+    let recibido = false;
+    fuente.addEventListener("estado", (event) => {
+      recibido = true;
+      const data = JSON.parse(event.data);
+      if (data.estado === "completado" || data.estado === "fallido") {
+        fuente.close();
+        resolve(data);
+      }
+    });
+    fuente.onerror = () => {
+      // EventSource reconecta solo; si nunca llegó un evento se usa polling
+      if (!recibido) {
+        fuente.close();
+        reject(new Error("SSE no disponible"));
+      }
+    };
+  });
+}
+
+async function consultarEstadoPorPolling(idAudio) {
   const maxIntentos = 30;
   for (let i = 0; i < maxIntentos; i += 1) {
     const data = await apiFetchService("audio", `/api/v1/audio/${idAudio}/estado`);
-    if (data.estado === "completado" && data.transcripcion) {
-      writeResponse(els.audioResponse, data);
-      await analizarTextoIA(data.transcripcion, false);
-      return;
-    }
-    if (data.estado === "fallido") {
-      throw new Error(data.error || "Transcripción fallida.");
+    if (data.estado === "completado" || data.estado === "fallido") {
+      return data;
     }
     await new Promise((resolve) => setTimeout(resolve, 3000));
   }
   throw new Error("Tiempo de espera agotado para transcripción.");
 }
 
+async function esperarTranscripcion(idAudio) {
+  setAudioStatus("Transcribiendo…");
+  let data;
+  try {
+    data = await escucharEstadoAudio(idAudio);
+  } catch {
+    data = await consultarEstadoPorPolling(idAudio);
+  }
+  if (data.estado === "fallido") {
+    throw new Error(data.error || "Transcripción fallida.");
+  }
+  writeResponse(els.audioResponse, data);
+  if (data.transcripcion) {
+    await analizarTextoIA(data.transcripcion, false);
+  }
+}
+
 async function startRecording() {
   if (!navigator.mediaDevices?.getUserMedia) {
     throw new Error("El navegador no soporta grabación de audio.");
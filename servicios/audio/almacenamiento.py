@@ -0,0 +1,388 @@
+# servicios/audio/almacenamiento.py
+"""
+Almacenamiento de objetos del microservicio de Audio: interfaz asíncrona sobre
+MinIO/S3 o el sistema de archivos local y subidas alimentadas por bloques.
+"""
+
+from typing import Optional
+import os
+import uuid
+import asyncio
+import functools
+import io
+import shutil
+import mimetypes
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from minio import Minio
+from minio.error import S3Error
+import urllib3
+import certifi
+from dotenv import load_dotenv
+from pathlib import Path
+
+load_dotenv(dotenv_path=Path(__file__).resolve().parents[2] / ".env")
+
+# ==================== CONFIGURACIÓN ====================
+ENDPOINT_MINIO = os.getenv("ENDPOINT_MINIO", os.getenv("MINIO_ENDPOINT", "localhost:9000"))
+CLAVE_ACCESO_MINIO = os.getenv("CLAVE_ACCESO_MINIO", os.getenv("MINIO_USER", "admin"))
+CLAVE_SECRETA_MINIO = os.getenv("CLAVE_SECRETA_MINIO", os.getenv("MINIO_PASSWORD", "password"))
+BUCKET_MINIO = "archivos-audio"
+ALMACENAMIENTO_BACKEND = os.getenv("ALMACENAMIENTO_BACKEND", "minio").lower()  # minio | local
+ALMACENAMIENTO_DIRECTORIO = os.getenv("ALMACENAMIENTO_DIRECTORIO", "/tmp/almacenamiento-audio")  # Solo backend local
+MINIO_POOL_CONEXIONES = int(os.getenv("MINIO_POOL_CONEXIONES", "16"))  # Conexiones HTTP = hilos de E/S
+MINIO_TIMEOUT_CONEXION = float(os.getenv("MINIO_TIMEOUT_CONEXION", "5"))
+MINIO_TIMEOUT_LECTURA = float(os.getenv("MINIO_TIMEOUT_LECTURA", "60"))
+MINIO_REINTENTOS = int(os.getenv("MINIO_REINTENTOS", "3"))
+MINIO_SEGURO = os.getenv("MINIO_SEGURO", os.getenv("MINIO_SECURE", "False")).lower() == "true"
+TAMANO_BLOQUE_DESCARGA = 64 * 1024
+
+# Subidas en streaming
+MAX_TAMANO_AUDIO_MB = int(os.getenv("MAX_TAMANO_AUDIO_MB", "50"))
+MAX_TAMANO_AUDIO_BYTES = MAX_TAMANO_AUDIO_MB * 1024 * 1024
+TAMANO_PARTE_MINIO = max(5, int(os.getenv("TAMANO_PARTE_MINIO_MB", "5"))) * 1024 * 1024  # mínimo S3: 5 MiB
+BLOQUES_EN_VUELO_SUBIDA = int(os.getenv("BLOQUES_EN_VUELO_SUBIDA", "16"))
+SUBIDAS_SIMULTANEAS = int(os.getenv("SUBIDAS_SIMULTANEAS", "8"))  # Hilos propios de subidas/sesiones en vivo
+
+# ==================== ALMACENAMIENTO DE OBJETOS ====================
+# Interfaz asíncrona sobre el almacenamiento de audios. Las llamadas bloqueantes
+# corren en un ejecutor del mismo tamaño que el pool HTTP, así nunca frenan el event loop.
+# Las subidas en streaming ocupan un hilo mientras dura la subida (o la sesión en vivo),
+# así que corren en un ejecutor aparte: no pueden dejar sin hilos a info/obtener/eliminar.
+
+class ErrorAlmacenamiento(Exception):
+    """Fallo del almacenamiento de objetos"""
+
+class ObjetoNoEncontrado(ErrorAlmacenamiento):
+    """El objeto solicitado no existe"""
+
+class AlmacenamientoObjetos:
+    """Base común: ejecutor acotado, traducción de errores y streaming asíncrono"""
+
+    backend = ""
+
+    def __init__(self, bucket: str, hilos: int, subidas: int = SUBIDAS_SIMULTANEAS):
+        self.bucket = bucket
+        self.hilos = hilos
+        self.subidas = subidas
+        self._ejecutor: Optional[ThreadPoolExecutor] = None
+        self._ejecutor_subidas: Optional[ThreadPoolExecutor] = None
+
+    # --- Operaciones síncronas de cada backend (se ejecutan en hilos) ---
+    def _asegurar_bucket(self) -> bool: raise NotImplementedError
+    def _existe_bucket(self) -> bool: raise NotImplementedError
+    def _guardar(self, nombre: str, datos: bytes, tipo_contenido: str): raise NotImplementedError
+    def _consumir_subida(self, nombre: str, lector, tipo_contenido: str): raise NotImplementedError
+    def _info(self, nombre: str) -> dict: raise NotImplementedError
+    def _eliminar(self, nombre: str): raise NotImplementedError
+    def _traducir_error(self, error: Exception) -> ErrorAlmacenamiento: raise NotImplementedError
+
+    def iterar_bloques(self, nombre: str, tamano_bloque: int, inicio: int = 0, longitud: Optional[int] = None):
+        """Generador síncrono de bloques del objeto (para usar desde hilos)"""
+        raise NotImplementedError
+
+    def url_lectura(self, nombre: str) -> str:
+        """URL (o ruta) que ffmpeg puede leer con seek"""
+        raise NotImplementedError
+
+    # --- Interfaz asíncrona ---
+    async def _en_ejecutor(self, ejecutor: ThreadPoolExecutor, funcion, *args):
+        try:
+            return await asyncio.get_running_loop().run_in_executor(ejecutor, functools.partial(funcion, *args))
+        except ErrorAlmacenamiento:
+            raise
+        except Exception as e:
+            raise self._traducir_error(e) from e
+
+    async def _ejecutar(self, funcion, *args):
+        if self._ejecutor is None:
+            self._ejecutor = ThreadPoolExecutor(max_workers=self.hilos, thread_name_prefix=f"almacenamiento-{self.backend}")
+        return await self._en_ejecutor(self._ejecutor, funcion, *args)
+
+    async def _ejecutar_subida(self, funcion, *args):
+        """Como _ejecutar, en el ejecutor de subidas: si está lleno, la subida espera su turno"""
+        if self._ejecutor_subidas is None:
+            self._ejecutor_subidas = ThreadPoolExecutor(
+                max_workers=self.subidas, thread_name_prefix=f"subidas-{self.backend}"
+            )
+        return await self._en_ejecutor(self._ejecutor_subidas, funcion, *args)
+
+    async def asegurar_bucket(self) -> bool:
+        """Crear el bucket si no existe; retorna True si se creó"""
+        return await self._ejecutar(self._asegurar_bucket)
+
+    async def verificar(self):
+        if not await self._ejecutar(self._existe_bucket):
+            raise ErrorAlmacenamiento(f"El bucket '{self.bucket}' no existe")
+
+    async def guardar(self, datos: bytes, nombre_archivo: str, tipo_contenido: str = "application/octet-stream") -> str:
+        """Guardar un objeto pequeño ya en memoria y retornar su nombre"""
+        nombre = f"{uuid.uuid4()}_{nombre_archivo}"
+        await self._ejecutar(self._guardar, nombre, datos, tipo_contenido or "application/octet-stream")
+        return nombre
+
+    async def guardar_como(self, nombre: str, datos: bytes, tipo_contenido: str = "application/octet-stream"):
+        """Guardar un objeto con nombre fijo (artefactos derivados)"""
+        await self._ejecutar(self._guardar, nombre, datos, tipo_contenido)
+
+    async def obtener(self, nombre: str) -> bytes:
+        def leer():
+            return b"".join(self.iterar_bloques(nombre, TAMANO_BLOQUE_DESCARGA))
+        return await self._ejecutar(leer)
+
+    async def info(self, nombre: str) -> dict:
+        """tamano, etag, ultima_modificacion y tipo_contenido del objeto"""
+        return await self._ejecutar(self._info, nombre)
+
+    async def eliminar(self, nombre: str):
+        await self._ejecutar(self._eliminar, nombre)
+
+    async def iterar(self, nombre: str, inicio: int = 0, longitud: Optional[int] = None):
+        """Bloques del objeto como generador asíncrono (cada lectura corre en el ejecutor)"""
+        bloques = self.iterar_bloques(nombre, TAMANO_BLOQUE_DESCARGA, inicio, longitud)
+        fin = object()
+        try:
+            while True:
+                bloque = await self._ejecutar(next, bloques, fin)
+                if bloque is fin:
+                    return
+                yield bloque
+        finally:
+            await self._ejecutar(bloques.close)
+
+    def subida_en_streaming(self, nombre: str, tipo_contenido: str) -> "SubidaEnStreaming":
+        """Subida cuyo contenido se entrega por bloques desde el event loop"""
+        return SubidaEnStreaming(self, nombre, tipo_contenido)
+
+    def cerrar(self):
+        for ejecutor in (self._ejecutor, self._ejecutor_subidas):
+            if ejecutor is not None:
+                ejecutor.shutdown(wait=False, cancel_futures=True)
+        self._ejecutor = self._ejecutor_subidas = None
+
+class AlmacenamientoMinio(AlmacenamientoObjetos):
+    """MinIO/S3 con pool de conexiones, timeouts y reintentos explícitos"""
+
+    backend = "minio"
+
+    def __init__(self, bucket: str, conexiones: int):
+        super().__init__(bucket, conexiones)
+        self.cliente = Minio(
+            ENDPOINT_MINIO,
+            access_key=CLAVE_ACCESO_MINIO,
+            secret_key=CLAVE_SECRETA_MINIO,
+            secure=MINIO_SEGURO,
+            http_client=urllib3.PoolManager(
+                maxsize=conexiones + SUBIDAS_SIMULTANEAS,
+                timeout=urllib3.Timeout(connect=MINIO_TIMEOUT_CONEXION, read=MINIO_TIMEOUT_LECTURA),
+                retries=urllib3.Retry(
+                    total=MINIO_REINTENTOS,
+                    backoff_factor=0.2,
+                    status_forcelist=[500, 502, 503, 504],
+                ),
+                cert_reqs="CERT_REQUIRED",
+                ca_certs=os.environ.get("SSL_CERT_FILE") or certifi.where(),
+            ),
+        )
+
+    def _traducir_error(self, error: Exception) -> ErrorAlmacenamiento:
+        if isinstance(error, S3Error) and error.code in ("NoSuchKey", "NoSuchObject", "NoSuchBucket"):
+            return ObjetoNoEncontrado(str(error))
+        return ErrorAlmacenamiento(str(error))
+
+    def _asegurar_bucket(self) -> bool:
+        if self.cliente.bucket_exists(self.bucket):
+            return False
+        self.cliente.make_bucket(self.bucket)
+        return True
+
+    def _existe_bucket(self) -> bool:
+        return self.cliente.bucket_exists(self.bucket)
+
+    def _guardar(self, nombre: str, datos: bytes, tipo_contenido: str):
+        self.cliente.put_object(self.bucket, nombre, io.BytesIO(datos), length=len(datos), content_type=tipo_contenido)
+
+    def _consumir_subida(self, nombre: str, lector, tipo_contenido: str):
+        # length=-1: subida multiparte; si el lector falla, el SDK aborta la subida
+        self.cliente.put_object(
+            self.bucket, nombre, lector, length=-1, part_size=TAMANO_PARTE_MINIO, content_type=tipo_contenido
+        )
+
+    def _info(self, nombre: str) -> dict:
+        stat = self.cliente.stat_object(self.bucket, nombre)
+        return {
+            "tamano": stat.size,
+            "etag": stat.etag,
+            "ultima_modificacion": stat.last_modified,
+            "tipo_contenido": stat.content_type,
+        }
+
+    def _eliminar(self, nombre: str):
+        self.cliente.remove_object(self.bucket, nombre)
+
+    def iterar_bloques(self, nombre: str, tamano_bloque: int, inicio: int = 0, longitud: Optional[int] = None):
+        try:
+            respuesta = self.cliente.get_object(self.bucket, nombre, offset=inicio, length=longitud or 0)
+        except Exception as e:
+            raise self._traducir_error(e) from e
+        try:
+            yield from respuesta.stream(tamano_bloque)
+        finally:
+            respuesta.close()
+            respuesta.release_conn()
+
+    def url_lectura(self, nombre: str) -> str:
+        return self.cliente.presigned_get_object(self.bucket, nombre, expires=timedelta(minutes=10))
+
+class AlmacenamientoLocal(AlmacenamientoObjetos):
+    """Sistema de archivos local con la misma interfaz (pruebas y desarrollo sin MinIO)"""
+
+    backend = "local"
+
+    def __init__(self, bucket: str, directorio: str, hilos: int = 4):
+        super().__init__(bucket, hilos)
+        self.raiz = Path(directorio) / bucket
+
+    def _ruta(self, nombre: str) -> Path:
+        ruta = (self.raiz / nombre).resolve()
+        if ruta.parent != self.raiz.resolve():
+            raise ErrorAlmacenamiento(f"Nombre de objeto inválido: {nombre}")
+        return ruta
+
+    def _traducir_error(self, error: Exception) -> ErrorAlmacenamiento:
+        if isinstance(error, FileNotFoundError):
+            return ObjetoNoEncontrado(str(error))
+        return ErrorAlmacenamiento(str(error))
+
+    def _asegurar_bucket(self) -> bool:
+        creado = not self.raiz.exists()
+        self.raiz.mkdir(parents=True, exist_ok=True)
+        return creado
+
+    def _existe_bucket(self) -> bool:
+        return self.raiz.is_dir()
+
+    def _escribir(self, nombre: str, lector):
+        ruta = self._ruta(nombre)
+        temporal = ruta.with_name(f".{ruta.name}.parcial")
+        try:
+            with open(temporal, "wb") as archivo:
+                shutil.copyfileobj(lector, archivo, TAMANO_BLOQUE_DESCARGA)
+            os.replace(temporal, ruta)
+        finally:
+            temporal.unlink(missing_ok=True)
+
+    def _guardar(self, nombre: str, datos: bytes, tipo_contenido: str):
+        self._escribir(nombre, io.BytesIO(datos))
+
+    def _consumir_subida(self, nombre: str, lector, tipo_contenido: str):
+        self._escribir(nombre, lector)
+
+    def _info(self, nombre: str) -> dict:
+        stat = self._ruta(nombre).stat()
+        return {
+            "tamano": stat.st_size,
+            "etag": f"{stat.st_size:x}-{stat.st_mtime_ns:x}",
+            "ultima_modificacion": datetime.fromtimestamp(stat.st_mtime, timezone.utc),
+            "tipo_contenido": mimetypes.guess_type(nombre)[0],
+        }
+
+    def _eliminar(self, nombre: str):
+        self._ruta(nombre).unlink(missing_ok=True)
+
+    def iterar_bloques(self, nombre: str, tamano_bloque: int, inicio: int = 0, longitud: Optional[int] = None):
+        try:
+            archivo = open(self._ruta(nombre), "rb")
+        except FileNotFoundError as e:
+            raise ObjetoNoEncontrado(str(e)) from e
+        with archivo:
+            archivo.seek(inicio)
+            restante = longitud
+            while restante is None or restante > 0:
+                bloque = archivo.read(tamano_bloque if restante is None else min(tamano_bloque, restante))
+                if not bloque:
+                    return
+                if restante is not None:
+                    restante -= len(bloque)
+                yield bloque
+
+    def url_lectura(self, nombre: str) -> str:
+        return str(self._ruta(nombre))
+
+def crear_almacenamiento() -> AlmacenamientoObjetos:
+    """Crear el almacenamiento según ALMACENAMIENTO_BACKEND"""
+    if ALMACENAMIENTO_BACKEND == "minio":
+        return AlmacenamientoMinio(BUCKET_MINIO, MINIO_POOL_CONEXIONES)
+    if ALMACENAMIENTO_BACKEND == "local":
+        return AlmacenamientoLocal(BUCKET_MINIO, ALMACENAMIENTO_DIRECTORIO)
+    raise RuntimeError(f"ALMACENAMIENTO_BACKEND desconocido: {ALMACENAMIENTO_BACKEND}")
+
+almacenamiento = crear_almacenamiento()
+
+# ==================== SUBIDA POR BLOQUES ====================
+# El event loop entrega los bloques a medida que llegan y el SDK los consume desde
+# un hilo del ejecutor de subidas, así el archivo completo nunca está en memoria.
+
+class LectorBloques:
+    """Vista síncrona sobre una asyncio.Queue de bloques, para que el SDK de MinIO lea desde un hilo"""
+
+    def __init__(self, cola: asyncio.Queue, loop: asyncio.AbstractEventLoop):
+        self._cola = cola
+        self._loop = loop
+        self._pendiente = bytearray()
+        self._fin = False
+        self._error: Optional[BaseException] = None
+
+    def abortar(self, error: BaseException):
+        """Hacer fallar la próxima lectura (MinIO aborta la subida multiparte)"""
+        self._error = error
+        try:
+            self._cola.put_nowait(None)
+        except asyncio.QueueFull:
+            pass
+
+    def read(self, tamano: int = -1) -> bytes:
+        while not self._fin and (tamano < 0 or len(self._pendiente) < tamano):
+            bloque = asyncio.run_coroutine_threadsafe(self._cola.get(), self._loop).result()
+            if self._error is not None:
+                raise self._error
+            if bloque is None:
+                self._fin = True
+            else:
+                self._pendiente += bloque
+        if tamano < 0 or tamano > len(self._pendiente):
+            tamano = len(self._pendiente)
+        datos = bytes(self._pendiente[:tamano])
+        del self._pendiente[:tamano]
+        return datos
+
+class SubidaEnStreaming:
+    """Subida (multiparte en MinIO) que corre en el ejecutor de subidas, alimentada desde el event loop"""
+
+    def __init__(self, almacenamiento: "AlmacenamientoObjetos", nombre_objeto: str, content_type: str):
+        self.cola: asyncio.Queue = asyncio.Queue(maxsize=BLOQUES_EN_VUELO_SUBIDA)
+        self.lector = LectorBloques(self.cola, asyncio.get_running_loop())
+        self.tarea = asyncio.ensure_future(
+            almacenamiento._ejecutar_subida(almacenamiento._consumir_subida, nombre_objeto, self.lector, content_type)
+        )
+
+    async def entregar(self, bloque: Optional[bytes]):
+        """Encolar un bloque (None = fin); espera si el almacenamiento va más lento que el cliente"""
+        if not self.cola.full():
+            self.cola.put_nowait(bloque)
+            return
+        entrega = asyncio.ensure_future(self.cola.put(bloque))
+        await asyncio.wait({entrega, self.tarea}, return_when=asyncio.FIRST_COMPLETED)
+        if not entrega.done():
+            entrega.cancel()
+            self.tarea.result()  # Propaga el error del almacenamiento
+            raise ErrorAlmacenamiento("La subida terminó antes de recibir todo el archivo")
+
+    async def finalizar(self):
+        await self.entregar(None)
+        return await self.tarea
+
+    async def abortar(self, error: BaseException):
+        if not self.tarea.done():
+            self.lector.abortar(error if isinstance(error, Exception) else RuntimeError("Subida cancelada"))
+        await asyncio.gather(self.tarea, return_exceptions=True)
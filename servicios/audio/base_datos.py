@@ -0,0 +1,18 @@
+# servicios/audio/base_datos.py
+"""Cliente MongoDB y colecciones del microservicio de Audio"""
+
+import os
+from motor.motor_asyncio import AsyncIOMotorClient
+from dotenv import load_dotenv
+from pathlib import Path
+
+load_dotenv(dotenv_path=Path(__file__).resolve().parents[2] / ".env")
+
+# ==================== CONFIGURACIÓN ====================
+URL_MONGODB = os.getenv("URL_MONGODB", os.getenv("MONGODB_URL", "mongodb://localhost:27017"))
+
+# ==================== CLIENTES ====================
+cliente_mongo = AsyncIOMotorClient(URL_MONGODB)
+bd = cliente_mongo.project_parallel
+coleccion_audios = bd.audios
+coleccion_cache_transcripciones = bd.cache_transcripciones
@@ -0,0 +1,295 @@
+# servicios/audio/benchmark.py
+"""
+Benchmark offline de transcripción - Project Parallel
+Ejecuta el mismo camino que transcribir_audio (decodificación a 16 kHz, recorte de
+silencio y ejecutar_transcripcion) sobre un corpus local, para una matriz de
+configuraciones de Whisper, y reporta RTF, latencia p50/p95, RSS pico y WER.
+
+Corpus: un directorio con clips de audio y, junto a cada uno, su referencia
+con el mismo nombre y extensión .txt (p. ej. llamada01.wav + llamada01.txt).
+
+Uso:
+    python benchmark.py --corpus ./corpus --motores openai,ctranslate2 --modelos tiny,base --beam 1,3 \\
+        --best-of 1,3 --temperatura 0 --condition-prev false,true --salida resultados.json
+
+Cada configuración corre en un proceso nuevo: el modelo se carga con esa
+configuración (como en producción, por variables de entorno) y el RSS pico
+medido es el de esa configuración sola.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import multiprocessing
+import os
+import re
+import resource
+import subprocess
+import sys
+import threading
+import time
+import unicodedata
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+EXTENSIONES_AUDIO = {".wav", ".mp3", ".m4a", ".ogg", ".opus", ".webm", ".flac", ".aac"}
+
+# Variables de entorno que forman la matriz (una lista de valores por variable)
+PARAMETROS_MATRIZ = {
+    "motores": "WHISPER_BACKEND",
+    "modelos": "WHISPER_MODELO",
+    "beam": "WHISPER_BEAM_SIZE",
+    "best_of": "WHISPER_BEST_OF",
+    "temperatura": "WHISPER_TEMPERATURA",
+    "condition_prev": "WHISPER_CONDITION_PREV",
+}
+
+# ==================== CORPUS Y MÉTRICAS ====================
+
+def cargar_corpus(directorio: str) -> List[Tuple[Path, str]]:
+    """Pares (clip, transcripción de referencia); se omiten clips sin referencia"""
+    corpus = []
+    for ruta in sorted(Path(directorio).iterdir()):
+        if ruta.suffix.lower() not in EXTENSIONES_AUDIO:
+            continue
+        referencia = ruta.with_suffix(".txt")
+        if not referencia.exists():
+            print(f"⚠️ {ruta.name} no tiene referencia {referencia.name}; se omite")
+            continue
+        corpus.append((ruta, referencia.read_text(encoding="utf-8").strip()))
+    return corpus
+
+def normalizar_texto(texto: str) -> List[str]:
+    """Minúsculas, sin tildes ni puntuación, separado en palabras"""
+    texto = unicodedata.normalize("NFKD", texto.lower())
+    texto = "".join(c for c in texto if not unicodedata.combining(c))
+    return re.sub(r"[^\w\s]", " ", texto).split()
+
+def distancia_palabras(referencia: List[str], hipotesis: List[str]) -> int:
+    """Distancia de edición (sustituciones + inserciones + borrados) entre listas de palabras"""
+    anterior = list(range(len(hipotesis) + 1))
+    for i, palabra_ref in enumerate(referencia, 1):
+        actual = [i] + [0] * len(hipotesis)
+        for j, palabra_hip in enumerate(hipotesis, 1):
+            actual[j] = min(
+                anterior[j] + 1,
+                actual[j - 1] + 1,
+                anterior[j - 1] + (palabra_ref != palabra_hip),
+            )
+        anterior = actual
+    return anterior[-1]
+
+def tasa_error_palabras(referencias: List[str], hipotesis: List[str]) -> Optional[float]:
+    """WER del corpus: errores totales / palabras de referencia totales"""
+    errores = palabras = 0
+    for referencia, hip in zip(referencias, hipotesis):
+        palabras_ref = normalizar_texto(referencia)
+        errores += distancia_palabras(palabras_ref, normalizar_texto(hip))
+        palabras += len(palabras_ref)
+    return round(errores / palabras, 4) if palabras else None
+
+def expandir_matriz(valores: Dict[str, List[str]]) -> List[Dict[str, str]]:
+    """Producto cartesiano de valores -> lista de configuraciones (variables de entorno)"""
+    claves = list(valores)
+    return [
+        {PARAMETROS_MATRIZ[clave]: valor for clave, valor in zip(claves, combinacion)}
+        for combinacion in itertools.product(*(valores[clave] for clave in claves))
+    ]
+
+def _procesos_descendientes(pid: int) -> List[int]:
+    """pid y todos sus descendientes, según /proc/<pid>/task/*/children (Linux)"""
+    pids, pendientes = [], [pid]
+    while pendientes:
+        actual = pendientes.pop()
+        pids.append(actual)
+        for tarea in Path(f"/proc/{actual}/task").glob("*"):
+            try:
+                pendientes.extend(int(hijo) for hijo in (tarea / "children").read_text().split())
+            except OSError:
+                continue
+    return pids
+
+def rss_arbol_kib(pid: int) -> int:
+    """Suma del RSS actual (VmRSS, KiB) del proceso y sus descendientes"""
+    total = 0
+    for actual in _procesos_descendientes(pid):
+        try:
+            for linea in Path(f"/proc/{actual}/status").read_text().splitlines():
+                if linea.startswith("VmRSS:"):
+                    total += int(linea.split()[1])
+                    break
+        except OSError:
+            continue  # el proceso terminó entre el listado y la lectura
+    return total
+
+class MuestreadorRss:
+    """
+    Muestrea en segundo plano el RSS sumado del árbol de procesos (servicio + workers
+    de PoolInferencia) y guarda el pico. ru_maxrss solo da el máximo de un proceso.
+    """
+
+    def __init__(self, intervalo_s: float = 0.1):
+        self.intervalo_s = intervalo_s
+        self.pico_kib = 0
+        self._detenido = threading.Event()
+        self._hilo = threading.Thread(target=self._muestrear, daemon=True)
+
+    def _muestrear(self):
+        while True:
+            self.pico_kib = max(self.pico_kib, rss_arbol_kib(os.getpid()))
+            if self._detenido.wait(self.intervalo_s):
+                return
+
+    def iniciar(self) -> "MuestreadorRss":
+        self._hilo.start()
+        return self
+
+    def detener(self) -> float:
+        """Detiene el muestreo y devuelve el pico en MB"""
+        self._detenido.set()
+        self._hilo.join()
+        return rss_pico_mb(self.pico_kib)
+
+def rss_pico_mb(pico_arbol_kib: int = 0) -> float:
+    """Pico entre el árbol muestreado y ru_maxrss propio (KiB en Linux), por si /proc no existe"""
+    propio = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(max(propio, pico_arbol_kib) / 1024, 1)
+
+# ==================== EJECUCIÓN DE UNA CONFIGURACIÓN ====================
+
+def _decodificar_archivo(ruta: Path) -> bytes:
+    import pipeline
+    proceso = subprocess.run(pipeline._comando_ffmpeg(str(ruta)), capture_output=True)
+    if proceso.returncode != 0:
+        raise RuntimeError(f"ffmpeg no pudo decodificar {ruta.name}: {proceso.stderr.decode(errors='replace').strip()}")
+    return proceso.stdout
+
+async def _ejecutar_corpus(corpus: List[Tuple[str, str]], repeticiones: int, calentamiento: bool) -> dict:
+    import pipeline
+    modelo = pipeline.WHISPER_MODELO
+    clips = []
+    if calentamiento and corpus:
+        audio = pipeline.pcm16_a_float32(_decodificar_archivo(Path(corpus[0][0])))
+        await pipeline.ejecutar_transcripcion(pipeline.preprocesar_audio(audio)[0], modelo)
+
+    for _ in range(repeticiones):
+        for ruta, referencia in corpus:
+            inicio = time.perf_counter()
+            audio = pipeline.pcm16_a_float32(_decodificar_archivo(Path(ruta)))
+            duracion_s = len(audio) / pipeline.FRECUENCIA_MUESTREO
+            reducido, preproceso = pipeline.preprocesar_audio(audio)
+            resultado = await pipeline.ejecutar_transcripcion(reducido, modelo)
+            clips.append({
+                "clip": Path(ruta).name,
+                "duracion_s": round(duracion_s, 2),
+                "latencia_ms": int((time.perf_counter() - inicio) * 1000),
+                "segundos_recortados": preproceso["segundos_recortados"],
+                "modo": resultado["modo"],
+                "referencia": referencia,
+                "hipotesis": pipeline.limpiar_transcripcion(resultado["texto"]),
+            })
+
+    pipeline.planificador_lotes.detener()
+    if pipeline.pool_inferencia is not None:
+        await pipeline.pool_inferencia.detener()
+    return {"clips": clips}
+
+def ejecutar_configuracion(entorno: Dict[str, str], corpus: List[Tuple[str, str]], repeticiones: int, calentamiento: bool) -> dict:
+    """Se ejecuta en un proceso nuevo: fija la configuración y luego importa el servicio"""
+    os.environ.update(entorno)
+    os.environ.setdefault("SECRETO_JWT", "benchmark")
+    os.environ.setdefault("COLA_BACKEND", "memoria")
+    os.environ.setdefault("ALMACENAMIENTO_BACKEND", "local")
+    # Los lotes decodifican sin condition_on_previous_text ni respaldo de temperatura:
+    # se desactivan para que los ejes de la matriz midan lo que dicen medir
+    os.environ["INFERENCIA_POR_LOTES"] = "false"
+    sys.path.insert(0, str(Path(__file__).resolve().parent))
+    muestreador = MuestreadorRss().iniciar()
+    import pipeline
+
+    try:
+        resultado = asyncio.run(_ejecutar_corpus(corpus, repeticiones, calentamiento))
+    finally:
+        rss_pico = muestreador.detener()
+    clips = resultado["clips"]
+    latencias = [c["latencia_ms"] for c in clips]
+    duracion_total = sum(c["duracion_s"] for c in clips)
+    return {
+        "configuracion": entorno,
+        "clips": len(clips),
+        "rtf": round(sum(latencias) / 1000 / duracion_total, 3) if duracion_total else None,
+        "latencia_p50_ms": pipeline._percentil(latencias, 50, decimales=0),
+        "latencia_p95_ms": pipeline._percentil(latencias, 95, decimales=0),
+        "rss_pico_mb": rss_pico,
+        "wer": tasa_error_palabras([c["referencia"] for c in clips], [c["hipotesis"] for c in clips]),
+        "detalle": clips,
+    }
+
+# ==================== CLI ====================
+
+def _lista(valor: str) -> List[str]:
+    return [v.strip() for v in valor.split(",") if v.strip()]
+
+def imprimir_tabla(resultados: List[dict]):
+    columnas = ["motor", "modelo", "beam", "best_of", "temp", "cond_prev", "RTF", "p50 ms", "p95 ms", "RSS MB", "WER"]
+    filas = [
+        [
+            r["configuracion"].get("WHISPER_BACKEND", ""),
+            r["configuracion"].get("WHISPER_MODELO", ""),
+            r["configuracion"].get("WHISPER_BEAM_SIZE", ""),
+            r["configuracion"].get("WHISPER_BEST_OF", ""),
+            r["configuracion"].get("WHISPER_TEMPERATURA", ""),
+            r["configuracion"].get("WHISPER_CONDITION_PREV", ""),
+        ] + [str(r[campo]) for campo in ("rtf", "latencia_p50_ms", "latencia_p95_ms", "rss_pico_mb", "wer")]
+        for r in resultados
+    ]
+    anchos = [max(len(str(x)) for x in columna) for columna in zip(columnas, *filas)]
+    for fila in [columnas] + filas:
+        print("  ".join(str(x).ljust(ancho) for x, ancho in zip(fila, anchos)))
+
+def main_cli(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Benchmark offline de transcripción (RTF, latencia, RSS, WER)")
+    parser.add_argument("--corpus", required=True, help="Directorio con clips y referencias .txt")
+    parser.add_argument("--motores", type=_lista, default=[os.getenv("WHISPER_BACKEND", "openai")],
+                        help="openai y/o ctranslate2 (int8 en CPU, requiere faster-whisper)")
+    parser.add_argument("--modelos", type=_lista, default=[os.getenv("WHISPER_MODELO", "tiny")])
+    parser.add_argument("--beam", type=_lista, default=[os.getenv("WHISPER_BEAM_SIZE", "3")])
+    parser.add_argument("--best-of", dest="best_of", type=_lista, default=[os.getenv("WHISPER_BEST_OF", "3")])
+    parser.add_argument("--temperatura", type=_lista, default=[os.getenv("WHISPER_TEMPERATURA", "0")])
+    parser.add_argument("--condition-prev", dest="condition_prev", type=_lista,
+                        default=[os.getenv("WHISPER_CONDITION_PREV", "false")])
+    parser.add_argument("--entorno", action="append", default=[],
+                        help="Variable fija para todas las configuraciones, CLAVE=valor (repetible)")
+    parser.add_argument("--repeticiones", type=int, default=1)
+    parser.add_argument("--sin-calentamiento", dest="calentamiento", action="store_false",
+                        help="No descartar una pasada inicial antes de medir")
+    parser.add_argument("--salida", help="Archivo JSON con resultados y detalle por clip")
+    args = parser.parse_args(argv)
+
+    corpus = [(str(ruta), referencia) for ruta, referencia in cargar_corpus(args.corpus)]
+    if not corpus:
+        parser.error(f"No hay clips con referencia en {args.corpus}")
+    fijas = dict(e.split("=", 1) for e in args.entorno)
+    configuraciones = expandir_matriz({clave: getattr(args, clave) for clave in PARAMETROS_MATRIZ})
+    print(f"🧪 {len(corpus)} clips x {len(configuraciones)} configuraciones")
+
+    resultados = []
+    contexto = multiprocessing.get_context("spawn")
+    for entorno in configuraciones:
+        print(f"▶️ {entorno}")
+        with ProcessPoolExecutor(max_workers=1, mp_context=contexto) as ejecutor:
+            resultado = ejecutor.submit(
+                ejecutar_configuracion, {**fijas, **entorno}, corpus, args.repeticiones, args.calentamiento
+            ).result()
+        print(f"   RTF {resultado['rtf']} · p95 {resultado['latencia_p95_ms']} ms · WER {resultado['wer']}")
+        resultados.append(resultado)
+
+    print()
+    imprimir_tabla(resultados)
+    if args.salida:
+        Path(args.salida).write_text(json.dumps(resultados, ensure_ascii=False, indent=2), encoding="utf-8")
+        print(f"💾 Resultados guardados en {args.salida}")
+
+if __name__ == "__main__":
+    main_cli()
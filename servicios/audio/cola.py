@@ -0,0 +1,292 @@
+# servicios/audio/cola.py
+"""
+Cola de transcripción del microservicio de Audio: trabajos con prioridad y lease,
+en memoria o en Redis, y sus métricas. Los workers que la consumen están en pipeline.py.
+"""
+
+from typing import Optional, List, Dict, Tuple
+import os
+import asyncio
+import heapq
+import json
+import time
+from collections import deque
+from redis import asyncio as aioredis
+from dotenv import load_dotenv
+from pathlib import Path
+from inferencia import PROCESOS_TRANSCRIPCION
+
+load_dotenv(dotenv_path=Path(__file__).resolve().parents[2] / ".env")
+
+# ==================== CONFIGURACIÓN ====================
+COLA_BACKEND = os.getenv("COLA_BACKEND", "redis").lower()  # redis | memoria
+URL_REDIS = os.getenv("URL_REDIS", os.getenv("REDIS_URL", "redis://localhost:6379/0"))
+WORKERS_TRANSCRIPCION = int(os.getenv("WORKERS_TRANSCRIPCION", str(max(1, PROCESOS_TRANSCRIPCION))))
+COLA_SEGUNDOS_LEASE = int(os.getenv("COLA_SEGUNDOS_LEASE", "120"))
+COLA_SEGUNDOS_LATIDO = int(os.getenv("COLA_SEGUNDOS_LATIDO", "30"))
+COLA_MAX_INTENTOS = int(os.getenv("COLA_MAX_INTENTOS", "3"))
+COLA_INTERVALO_SONDEO = float(os.getenv("COLA_INTERVALO_SONDEO", "1.0"))
+
+# ==================== COLA DE TRANSCRIPCIÓN ====================
+# Los trabajos se reservan con un lease que el worker renueva mientras transcribe.
+# Si el proceso muere, el lease vence y el trabajo vuelve a la cola.
+
+PRIORIDAD_NORMAL = 0
+PRIORIDAD_REFINADO = -1  # Solo avanza cuando no quedan trabajos de prioridad normal
+
+def _puntaje_trabajo(prioridad: int, encolado_en: float) -> float:
+    """Menor puntaje sale primero: la prioridad domina y el orden de llegada desempata"""
+    return -prioridad * 1e10 + encolado_en
+
+class ColaTrabajosMemoria:
+    """Cola en memoria con la misma semántica que la de Redis (pruebas y desarrollo local)"""
+
+    def __init__(self, segundos_lease: int):
+        self.segundos_lease = segundos_lease
+        self._pendientes: List[Tuple[float, str]] = []  # heap (puntaje, id_trabajo)
+        self._trabajos: Dict[str, dict] = {}
+        self._en_curso: Dict[str, float] = {}  # id_trabajo -> vencimiento del lease
+
+    async def encolar(self, trabajo: dict) -> bool:
+        if trabajo["id_trabajo"] in self._trabajos:
+            return False
+        self._trabajos[trabajo["id_trabajo"]] = dict(trabajo, intentos=0)
+        heapq.heappush(self._pendientes, (trabajo["puntaje"], trabajo["id_trabajo"]))
+        return True
+
+    async def contiene(self, id_trabajo: str) -> bool:
+        return id_trabajo in self._trabajos
+
+    async def reservar(self) -> Optional[dict]:
+        while self._pendientes:
+            _, id_trabajo = heapq.heappop(self._pendientes)
+            trabajo = self._trabajos.get(id_trabajo)
+            if trabajo is None or id_trabajo in self._en_curso:
+                continue
+            trabajo["intentos"] += 1
+            self._en_curso[id_trabajo] = time.time() + self.segundos_lease
+            return dict(trabajo)
+        return None
+
+    async def renovar(self, id_trabajo: str) -> bool:
+        if id_trabajo not in self._en_curso:
+            return False
+        self._en_curso[id_trabajo] = time.time() + self.segundos_lease
+        return True
+
+    async def completar(self, id_trabajo: str):
+        self._en_curso.pop(id_trabajo, None)
+        self._trabajos.pop(id_trabajo, None)
+
+    async def recuperar_vencidos(self, max_intentos: int) -> Tuple[List[dict], List[dict]]:
+        """Devolver a la cola los trabajos con lease vencido; retorna (reencolados, agotados)"""
+        ahora = time.time()
+        reencolados, agotados = [], []
+        for id_trabajo in [i for i, vence in self._en_curso.items() if vence <= ahora]:
+            del self._en_curso[id_trabajo]
+            trabajo = self._trabajos[id_trabajo]
+            if trabajo["intentos"] >= max_intentos:
+                del self._trabajos[id_trabajo]
+                agotados.append(dict(trabajo))
+            else:
+                heapq.heappush(self._pendientes, (trabajo["puntaje"], id_trabajo))
+                reencolados.append(dict(trabajo))
+        return reencolados, agotados
+
+    async def profundidad(self) -> dict:
+        return {
+            "pendientes": len(self._trabajos) - len(self._en_curso),
+            "en_curso": len(self._en_curso),
+        }
+
+    async def pendientes_segundo_plano(self) -> int:
+        return sum(
+            1 for id_trabajo, trabajo in self._trabajos.items()
+            if id_trabajo not in self._en_curso and trabajo["prioridad"] < PRIORIDAD_NORMAL
+        )
+
+_LUA_ENCOLAR = """
+if redis.call('HSETNX', KEYS[1], ARGV[1], ARGV[2]) == 0 then return 0 end
+redis.call('ZADD', KEYS[2], ARGV[3], ARGV[1])
+return 1
+"""
+
+_LUA_RESERVAR = """
+local ids = redis.call('ZRANGE', KEYS[1], 0, 0)
+if #ids == 0 then return nil end
+local id = ids[1]
+redis.call('ZREM', KEYS[1], id)
+local datos = redis.call('HGET', KEYS[2], id)
+if not datos then return nil end
+local intentos = redis.call('HINCRBY', KEYS[4], id, 1)
+redis.call('ZADD', KEYS[3], ARGV[1], id)
+return {datos, intentos}
+"""
+
+_LUA_RECUPERAR = """
+local vencidos = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+local resultado = {}
+for _, id in ipairs(vencidos) do
+  redis.call('ZREM', KEYS[1], id)
+  local datos = redis.call('HGET', KEYS[2], id)
+  if datos then
+    local intentos = tonumber(redis.call('HGET', KEYS[3], id) or '0')
+    if intentos >= tonumber(ARGV[2]) then
+      redis.call('HDEL', KEYS[2], id)
+      redis.call('HDEL', KEYS[3], id)
+      table.insert(resultado, {datos, intentos, 1})
+    else
+      redis.call('ZADD', KEYS[4], cjson.decode(datos)['puntaje'], id)
+      table.insert(resultado, {datos, intentos, 0})
+    end
+  end
+end
+return resultado
+"""
+
+class ColaTrabajosRedis:
+    """Cola persistente en Redis: sobrevive reinicios y se comparte entre réplicas"""
+
+    def __init__(self, url_redis: str, segundos_lease: int, prefijo: str = "cola:transcripcion"):
+        self.segundos_lease = segundos_lease
+        self.cliente = aioredis.from_url(url_redis, decode_responses=True)
+        self.clave_pendientes = f"{prefijo}:pendientes"
+        self.clave_trabajos = f"{prefijo}:trabajos"
+        self.clave_en_curso = f"{prefijo}:en_curso"
+        self.clave_intentos = f"{prefijo}:intentos"
+        self._encolar = self.cliente.register_script(_LUA_ENCOLAR)
+        self._reservar = self.cliente.register_script(_LUA_RESERVAR)
+        self._recuperar = self.cliente.register_script(_LUA_RECUPERAR)
+
+    async def encolar(self, trabajo: dict) -> bool:
+        creado = await self._encolar(
+            keys=[self.clave_trabajos, self.clave_pendientes],
+            args=[trabajo["id_trabajo"], json.dumps(trabajo), trabajo["puntaje"]],
+        )
+        return bool(creado)
+
+    async def contiene(self, id_trabajo: str) -> bool:
+        return bool(await self.cliente.hexists(self.clave_trabajos, id_trabajo))
+
+    async def reservar(self) -> Optional[dict]:
+        resultado = await self._reservar(
+            keys=[self.clave_pendientes, self.clave_trabajos, self.clave_en_curso, self.clave_intentos],
+            args=[time.time() + self.segundos_lease],
+        )
+        if not resultado:
+            return None
+        datos, intentos = resultado
+        return dict(json.loads(datos), intentos=int(intentos))
+
+    async def renovar(self, id_trabajo: str) -> bool:
+        actualizados = await self.cliente.zadd(
+            self.clave_en_curso, {id_trabajo: time.time() + self.segundos_lease}, xx=True, ch=True
+        )
+        return bool(actualizados)
+
+    async def completar(self, id_trabajo: str):
+        async with self.cliente.pipeline(transaction=True) as pipe:
+            pipe.zrem(self.clave_en_curso, id_trabajo)
+            pipe.hdel(self.clave_trabajos, id_trabajo)
+            pipe.hdel(self.clave_intentos, id_trabajo)
+            await pipe.execute()
+
+    async def recuperar_vencidos(self, max_intentos: int) -> Tuple[List[dict], List[dict]]:
+        resultado = await self._recuperar(
+            keys=[self.clave_en_curso, self.clave_trabajos, self.clave_intentos, self.clave_pendientes],
+            args=[time.time(), max_intentos],
+        )
+        reencolados, agotados = [], []
+        for datos, intentos, agotado in resultado or []:
+            trabajo = dict(json.loads(datos), intentos=int(intentos))
+            (agotados if int(agotado) else reencolados).append(trabajo)
+        return reencolados, agotados
+
+    async def profundidad(self) -> dict:
+        async with self.cliente.pipeline(transaction=False) as pipe:
+            pipe.zcard(self.clave_pendientes)
+            pipe.zcard(self.clave_en_curso)
+            pendientes, en_curso = await pipe.execute()
+        return {"pendientes": pendientes, "en_curso": en_curso}
+
+    async def pendientes_segundo_plano(self) -> int:
+        # Con prioridad menor que la normal el puntaje arranca en _puntaje_trabajo(PRIORIDAD_NORMAL - 1, 0)
+        return await self.cliente.zcount(self.clave_pendientes, _puntaje_trabajo(PRIORIDAD_NORMAL - 1, 0), "+inf")
+
+def crear_cola_transcripcion():
+    """Crear la cola según COLA_BACKEND"""
+    if COLA_BACKEND == "memoria":
+        return ColaTrabajosMemoria(COLA_SEGUNDOS_LEASE)
+    if COLA_BACKEND == "redis":
+        return ColaTrabajosRedis(URL_REDIS, COLA_SEGUNDOS_LEASE)
+    raise RuntimeError(f"COLA_BACKEND no soportado: {COLA_BACKEND}")
+
+cola_transcripcion = crear_cola_transcripcion()
+
+metricas_cola = {
+    "encolados": 0,
+    "completados": 0,
+    "reintentados": 0,
+    "agotados": 0,
+    "workers_ocupados": 0,
+    "esperas_ms": deque(maxlen=500),
+}
+
+def _percentil(valores, percentil: float, decimales: int = 1) -> Optional[float]:
+    """Percentil por rango más cercano sobre una muestra pequeña"""
+    ordenados = sorted(valores)
+    if not ordenados:
+        return None
+    indice = min(len(ordenados) - 1, max(0, int(round(percentil / 100 * len(ordenados) + 0.5)) - 1))
+    return round(ordenados[indice], decimales)
+
+def id_trabajo_transcripcion(id_audio: str, pasada: str = "unica") -> str:
+    # El refinado convive en la cola con el trabajo del borrador, que aún no se completó
+    return f"{id_audio}:refinado" if pasada == "refinado" else id_audio
+
+async def encolar_transcripcion(id_audio: str, prioridad: int = PRIORIDAD_NORMAL, pasada: str = "unica") -> bool:
+    """Encolar la transcripción de un audio; es idempotente por id de audio y pasada"""
+    encolado_en = time.time()
+    creado = await cola_transcripcion.encolar({
+        "id_trabajo": id_trabajo_transcripcion(id_audio, pasada),
+        "id_audio": id_audio,
+        "pasada": pasada,
+        "prioridad": prioridad,
+        "encolado_en": encolado_en,
+        "puntaje": _puntaje_trabajo(prioridad, encolado_en),
+    })
+    if creado:
+        metricas_cola["encolados"] += 1
+    return creado
+
+async def _mantener_lease(id_trabajo: str):
+    """Renovar el lease periódicamente mientras el trabajo está en curso"""
+    while True:
+        await asyncio.sleep(COLA_SEGUNDOS_LATIDO)
+        try:
+            if not await cola_transcripcion.renovar(id_trabajo):
+                print(f"⚠️ Lease perdido para el trabajo {id_trabajo}")
+        except Exception as e:
+            print(f"⚠️ Error renovando lease de {id_trabajo}: {e}")
+
+async def obtener_metricas_cola() -> dict:
+    """Profundidad de la cola y tiempos de espera recientes"""
+    esperas = list(metricas_cola["esperas_ms"])
+    return {
+        "backend": COLA_BACKEND,
+        "workers": WORKERS_TRANSCRIPCION,
+        "workers_ocupados": metricas_cola["workers_ocupados"],
+        **await cola_transcripcion.profundidad(),
+        "pendientes_segundo_plano": await cola_transcripcion.pendientes_segundo_plano(),
+        "encolados": metricas_cola["encolados"],
+        "completados": metricas_cola["completados"],
+        "reintentados": metricas_cola["reintentados"],
+        "agotados": metricas_cola["agotados"],
+        "espera_ms": {
+            "muestras": len(esperas),
+            "promedio": round(sum(esperas) / len(esperas), 1) if esperas else None,
+            "p50": _percentil(esperas, 50),
+            "p95": _percentil(esperas, 95),
+            "max": round(max(esperas), 1) if esperas else None,
+        },
+    }
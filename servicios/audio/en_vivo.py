@@ -0,0 +1,261 @@
+# servicios/audio/en_vivo.py
+"""
+Transcripción en vivo del microservicio de Audio: el cliente envía audio por
+WebSocket mientras graba y recibe parciales sobre una ventana deslizante.
+"""
+
+from typing import Optional, List, Tuple
+import os
+import asyncio
+import json
+import mimetypes
+import uuid
+from datetime import datetime, timezone
+import numpy as np
+from fastapi import WebSocket, WebSocketDisconnect
+from dotenv import load_dotenv
+from pathlib import Path
+from inferencia import FRECUENCIA_MUESTREO, WHISPER_MODELO, _transcribir_segmento, opciones_whisper
+from almacenamiento import (
+    BUCKET_MINIO,
+    MAX_TAMANO_AUDIO_BYTES,
+    MAX_TAMANO_AUDIO_MB,
+    TAMANO_BLOQUE_DESCARGA,
+    SubidaEnStreaming,
+    almacenamiento,
+)
+from base_datos import coleccion_audios
+from cola import PRIORIDAD_REFINADO, encolar_transcripcion
+from pipeline import (
+    TRANSCRIPCION_DOS_PASADAS,
+    cabecera_wav,
+    campos_version,
+    ejecutar_inferencia,
+    enrutar_pasada,
+    limpiar_transcripcion,
+    parametros_transcripcion,
+    pcm16_a_float32,
+)
+
+load_dotenv(dotenv_path=Path(__file__).resolve().parents[2] / ".env")
+
+# ==================== CONFIGURACIÓN ====================
+EN_VIVO_PASO_SEGUNDOS = float(os.getenv("EN_VIVO_PASO_SEGUNDOS", "2"))  # Audio nuevo entre pasadas parciales
+EN_VIVO_VENTANA_SEGUNDOS = float(os.getenv("EN_VIVO_VENTANA_SEGUNDOS", "20"))  # Ventana máxima sin confirmar
+MAX_SESIONES_EN_VIVO = int(os.getenv("MAX_SESIONES_EN_VIVO", "4"))
+
+# ==================== TRANSCRIPCIÓN EN VIVO ====================
+# El cliente envía audio por WebSocket mientras graba; se transcribe sobre una
+# ventana deslizante y se confirman los segmentos estables para acotar la ventana.
+
+class TranscriptorEnVivo:
+    """Transcripción incremental sobre una ventana deslizante de PCM 16 kHz"""
+
+    def __init__(self, modelo: str = WHISPER_MODELO):
+        self.modelo = modelo
+        self.ventana = np.zeros(0, dtype=np.float32)  # Audio aún no confirmado
+        self.desplazamiento_s = 0.0  # Posición de la ventana dentro de la grabación
+        self.confirmados: List[dict] = []
+        self.parciales: List[dict] = []
+        self.duracion_s = 0.0
+        self._resto = b""
+        self._nuevo_s = 0.0  # Audio recibido desde la última pasada
+
+    def agregar_pcm16(self, datos: bytes):
+        datos = self._resto + datos
+        corte = len(datos) - len(datos) % 2
+        self._resto = datos[corte:]
+        nuevo = pcm16_a_float32(datos[:corte])
+        self.ventana = np.concatenate([self.ventana, nuevo])
+        self._nuevo_s += len(nuevo) / FRECUENCIA_MUESTREO
+        self.duracion_s += len(nuevo) / FRECUENCIA_MUESTREO
+
+    def listo_para_pasada(self) -> bool:
+        return self._nuevo_s >= EN_VIVO_PASO_SEGUNDOS
+
+    def tomar_ventana(self) -> Tuple[np.ndarray, float]:
+        self._nuevo_s = 0.0
+        return self.ventana, self.desplazamiento_s
+
+    def aplicar(self, resultado: dict, muestras_ventana: int, final: bool = False):
+        """Incorporar el resultado de una pasada; confirma todo salvo el último segmento si la ventana creció"""
+        segmentos = resultado["segmentos"]
+        if not segmentos and resultado["texto"]:
+            segmentos = [{
+                "inicio": round(self.desplazamiento_s, 2),
+                "fin": round(self.desplazamiento_s + muestras_ventana / FRECUENCIA_MUESTREO, 2),
+                "texto": resultado["texto"],
+            }]
+        duracion_ventana = muestras_ventana / FRECUENCIA_MUESTREO
+        if final:
+            confirmar, self.parciales = segmentos, []
+        elif duracion_ventana >= EN_VIVO_VENTANA_SEGUNDOS:
+            # El último segmento puede estar cortado; si es el único se confirma igual para acotar la ventana
+            confirmar = segmentos[:-1] if len(segmentos) > 1 else segmentos
+            self.parciales = segmentos[len(confirmar):]
+        else:
+            confirmar, self.parciales = [], segmentos
+        if confirmar:
+            self.confirmados.extend(confirmar)
+            fin_s = confirmar[-1]["fin"] if self.parciales else self.desplazamiento_s + duracion_ventana
+            muestras = min(len(self.ventana), max(0, int((fin_s - self.desplazamiento_s) * FRECUENCIA_MUESTREO)))
+            self.ventana = self.ventana[muestras:]
+            self.desplazamiento_s += muestras / FRECUENCIA_MUESTREO
+
+    def texto(self) -> str:
+        return " ".join(s["texto"] for s in self.confirmados + self.parciales if s["texto"])
+
+sesiones_en_vivo = {"activas": 0}
+
+def _opciones_en_vivo() -> dict:
+    """Decodificación voraz para los parciales: prioriza latencia sobre precisión"""
+    return dict(opciones_whisper(), beam_size=None, best_of=None, temperature=0.0)
+
+async def _pasada_en_vivo(transcriptor: TranscriptorEnVivo, final: bool = False, websocket: Optional[WebSocket] = None):
+    """Transcribir la ventana actual; las pasadas intermedias envían el texto parcial al cliente"""
+    ventana, desplazamiento = transcriptor.tomar_ventana()
+    if len(ventana) < FRECUENCIA_MUESTREO * 0.3 and not final:
+        return
+    if len(ventana) == 0:
+        transcriptor.aplicar({"texto": "", "segmentos": []}, 0, final=final)
+        return
+    opciones = opciones_whisper() if final else _opciones_en_vivo()
+    resultado = await ejecutar_inferencia(_transcribir_segmento, ventana, desplazamiento, opciones, transcriptor.modelo)
+    transcriptor.aplicar(resultado, len(ventana), final=final)
+    if websocket is not None:
+        await websocket.send_json({"tipo": "parcial", "texto": transcriptor.texto(), "segundos": round(transcriptor.duracion_s, 1)})
+
+async def _decodificar_contenedor_en_vivo(proceso, transcriptor: TranscriptorEnVivo):
+    """Leer el PCM que ffmpeg produce a partir del contenedor (webm/ogg) recibido"""
+    while True:
+        bloque = await proceso.stdout.read(TAMANO_BLOQUE_DESCARGA)
+        if not bloque:
+            return
+        transcriptor.agregar_pcm16(bloque)
+
+async def atender_sesion_en_vivo(websocket: WebSocket, datos_usuario: dict, formato: str, tipo_contenido: str):
+    """Recibir la grabación, enviar parciales y guardar el audio con su transcripción final"""
+    id_audio = str(uuid.uuid4())
+    extension = ".wav" if formato == "pcm16" else mimetypes.guess_extension(tipo_contenido.split(";")[0]) or ".webm"
+    recibido = {
+        "nombre_archivo": f"en_vivo_{id_audio}{extension}",
+        "tipo_contenido": "audio/wav" if formato == "pcm16" else tipo_contenido,
+    }
+    recibido["nombre_objeto"] = f"{uuid.uuid4()}_{recibido['nombre_archivo']}"
+    # Con dos pasadas, el resultado en vivo es el borrador: se transcribe con el modelo del borrador
+    pasada_sesion = "borrador" if TRANSCRIPCION_DOS_PASADAS else "unica"
+    transcriptor = TranscriptorEnVivo(enrutar_pasada(pasada_sesion, None)[0])
+    subida: Optional[SubidaEnStreaming] = None
+    proceso = None
+    lectura_ffmpeg = None
+    pasada: Optional[asyncio.Task] = None
+    tamano = 0
+    try:
+        # Dentro del try: si accept() o la subida fallan, el finally libera la sesión
+        sesiones_en_vivo["activas"] += 1
+        await websocket.accept()
+        subida = almacenamiento.subida_en_streaming(recibido["nombre_objeto"], recibido["tipo_contenido"])
+        if formato == "pcm16":
+            await subida.entregar(cabecera_wav())
+        else:
+            proceso = await asyncio.create_subprocess_exec(
+                "ffmpeg", "-nostdin", "-loglevel", "error", "-fflags", "+nobuffer",
+                "-i", "pipe:0", "-f", "s16le", "-ac", "1", "-ar", str(FRECUENCIA_MUESTREO), "pipe:1",
+                stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE,
+            )
+            lectura_ffmpeg = asyncio.create_task(_decodificar_contenedor_en_vivo(proceso, transcriptor))
+
+        while True:
+            mensaje = await websocket.receive()
+            if mensaje["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(mensaje.get("code", 1000))
+            if mensaje.get("bytes"):
+                datos = mensaje["bytes"]
+                tamano += len(datos)
+                if tamano > MAX_TAMANO_AUDIO_BYTES:
+                    raise ValueError(f"La grabación supera el máximo de {MAX_TAMANO_AUDIO_MB} MB")
+                await subida.entregar(datos)
+                if proceso is not None:
+                    proceso.stdin.write(datos)
+                    await proceso.stdin.drain()
+                else:
+                    transcriptor.agregar_pcm16(datos)
+            elif mensaje.get("text"):
+                if json.loads(mensaje["text"]).get("evento") == "fin":
+                    break
+            # Una pasada a la vez: si la anterior sigue en curso se espera al siguiente bloque
+            if (pasada is None or pasada.done()) and transcriptor.listo_para_pasada():
+                if pasada is not None:
+                    pasada.result()
+                pasada = asyncio.create_task(_pasada_en_vivo(transcriptor, websocket=websocket))
+
+        if tamano == 0:
+            raise ValueError("No se recibió audio")
+        if proceso is not None:
+            proceso.stdin.close()
+            await lectura_ffmpeg
+            await proceso.wait()
+        if pasada is not None:
+            await pasada
+        await _pasada_en_vivo(transcriptor, final=True)
+        await subida.finalizar()
+
+        transcripcion_raw = transcriptor.texto()
+        doc_audio = {
+            "_id": id_audio,
+            "id_usuario": int(datos_usuario.get("sub")),
+            "usuario": datos_usuario.get("usuario"),
+            "nombre_archivo_original": recibido["nombre_archivo"],
+            "nombre_objeto_s3": recibido["nombre_objeto"],
+            "bucket_s3": BUCKET_MINIO,
+            "tamano_bytes": tamano,
+            "tipo_contenido": recibido["tipo_contenido"],
+            "origen": "en_vivo",
+            "estado": "completado",
+            "transcripcion": limpiar_transcripcion(transcripcion_raw),
+            "transcripcion_raw": transcripcion_raw,
+            "segmentos": transcriptor.confirmados,
+            "duracion_segundos": round(transcriptor.duracion_s, 2),
+            "modelo_whisper": transcriptor.modelo,
+            "parametros_transcripcion": parametros_transcripcion(transcriptor.modelo),
+            "fecha_creacion": datetime.now(timezone.utc),
+            "fecha_procesamiento": datetime.now(timezone.utc),
+            "error": None
+        }
+        # Con dos pasadas, el refinado reemplaza después al borrador
+        doc_audio.update(campos_version({}, pasada_sesion))
+        await coleccion_audios.insert_one(doc_audio)
+        if TRANSCRIPCION_DOS_PASADAS:
+            try:
+                await encolar_transcripcion(id_audio, PRIORIDAD_REFINADO, "refinado")
+            except Exception as e:
+                print(f"⚠️ No se pudo encolar el refinado de {id_audio}: {e}")
+        await websocket.send_json({
+            "tipo": "final",
+            "id_audio": id_audio,
+            "transcripcion": doc_audio["transcripcion"],
+            "transcripcion_raw": transcripcion_raw,
+            "duracion_segundos": doc_audio["duracion_segundos"],
+            "refinamiento": doc_audio.get("refinamiento"),
+        })
+        await websocket.close()
+    except WebSocketDisconnect:
+        if subida is not None:
+            await subida.abortar(RuntimeError("Cliente desconectado"))
+    except Exception as e:
+        if subida is not None:
+            await subida.abortar(e)
+        print(f"❌ Error en transcripción en vivo: {e}")
+        try:
+            await websocket.send_json({"tipo": "error", "detalle": str(e)})
+            await websocket.close(code=1011)
+        except Exception:
+            pass
+    finally:
+        sesiones_en_vivo["activas"] -= 1
+        if pasada is not None and not pasada.done():
+            pasada.cancel()
+        if lectura_ffmpeg is not None and not lectura_ffmpeg.done():
+            lectura_ffmpeg.cancel()
+        if proceso is not None and proceso.returncode is None:
+            proceso.kill()
@@ -0,0 +1,116 @@
+# servicios/audio/estados.py
+"""
+Estados de los audios: cada cambio se guarda en MongoDB y se publica a las
+conexiones SSE suscritas (en memoria o por pub/sub de Redis).
+"""
+
+from typing import Optional, List, Dict
+import asyncio
+import json
+from datetime import datetime
+from redis import asyncio as aioredis
+from base_datos import coleccion_audios
+from cola import COLA_BACKEND, COLA_INTERVALO_SONDEO, URL_REDIS
+
+# ==================== NOTIFICACIÓN DE ESTADOS ====================
+# Cada cambio de estado de un audio se publica en un bus; las conexiones SSE
+# suscritas lo reciben sin consultar MongoDB. Con la cola en Redis, el bus usa
+# pub/sub para que el cambio llegue aunque el worker corra en otro proceso.
+
+CANAL_ESTADOS = "audio:estados"
+ESTADOS_FINALES = ("completado", "fallido")
+CAMPOS_ESTADO = (
+    "estado", "transcripcion", "transcripcion_raw", "duracion_segundos", "fecha_procesamiento", "error",
+    "version_transcripcion", "refinamiento",
+)
+
+def _tokens_muestra(transcripcion_raw: Optional[str]) -> Optional[List[str]]:
+    if isinstance(transcripcion_raw, str) and transcripcion_raw.strip():
+        return transcripcion_raw.strip().split()[:20]
+    return None
+
+def _iso(valor):
+    return valor.isoformat() if isinstance(valor, datetime) else valor
+
+def datos_estado_audio(doc_audio: dict) -> dict:
+    """Estado de un audio tal como lo exponen el endpoint de estado y los eventos SSE"""
+    return {
+        "id_audio": doc_audio["_id"],
+        "estado": doc_audio["estado"],
+        "transcripcion": doc_audio.get("transcripcion"),
+        "duracion_segundos": doc_audio.get("duracion_segundos"),
+        "fecha_creacion": _iso(doc_audio.get("fecha_creacion")),
+        "fecha_procesamiento": _iso(doc_audio.get("fecha_procesamiento")),
+        "error": doc_audio.get("error"),
+        "transcripcion_raw": doc_audio.get("transcripcion_raw"),
+        "tokens_muestra": _tokens_muestra(doc_audio.get("transcripcion_raw")),
+        "version_transcripcion": doc_audio.get("version_transcripcion"),
+        "refinamiento": doc_audio.get("refinamiento"),
+    }
+
+def estado_definitivo(datos: dict) -> bool:
+    """Estado final y, con dos pasadas, sin un refinado pendiente que reemplace el borrador"""
+    return datos["estado"] in ESTADOS_FINALES and datos.get("refinamiento") != "pendiente"
+
+class BusEstados:
+    """Suscripciones por id_audio; con Redis, la publicación se reparte entre procesos"""
+
+    def __init__(self, url_redis: Optional[str] = None):
+        self.cliente = aioredis.from_url(url_redis, decode_responses=True) if url_redis else None
+        self._suscriptores: Dict[str, set] = {}
+        self.publicados = 0
+
+    def suscribir(self, id_audio: str) -> asyncio.Queue:
+        cola: asyncio.Queue = asyncio.Queue()
+        self._suscriptores.setdefault(id_audio, set()).add(cola)
+        return cola
+
+    def desuscribir(self, id_audio: str, cola: asyncio.Queue):
+        colas = self._suscriptores.get(id_audio)
+        if colas is not None:
+            colas.discard(cola)
+            if not colas:
+                del self._suscriptores[id_audio]
+
+    def entregar(self, id_audio: str, cambios: dict):
+        for cola in self._suscriptores.get(id_audio, ()):
+            cola.put_nowait(cambios)
+
+    async def publicar(self, id_audio: str, cambios: dict):
+        self.publicados += 1
+        if self.cliente is None:
+            self.entregar(id_audio, cambios)
+            return
+        await self.cliente.publish(CANAL_ESTADOS, json.dumps({"id_audio": id_audio, "cambios": cambios}))
+
+    async def relevar(self):
+        """Entregar a los suscriptores locales lo publicado en Redis (por cualquier proceso)"""
+        while True:
+            try:
+                async with self.cliente.pubsub() as pubsub:
+                    await pubsub.subscribe(CANAL_ESTADOS)
+                    async for mensaje in pubsub.listen():
+                        if mensaje["type"] == "message":
+                            evento = json.loads(mensaje["data"])
+                            self.entregar(evento["id_audio"], evento["cambios"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"⚠️ Relevo de estados interrumpido ({e}); reintentando")
+                await asyncio.sleep(COLA_INTERVALO_SONDEO)
+
+    def suscriptores(self) -> int:
+        return sum(len(c) for c in self._suscriptores.values())
+
+bus_estados = BusEstados(URL_REDIS if COLA_BACKEND == "redis" else None)
+
+async def actualizar_estado_audio(id_audio: str, campos: dict):
+    """Guardar un cambio de estado en MongoDB y notificarlo a los suscriptores"""
+    await coleccion_audios.update_one({"_id": id_audio}, {"$set": campos})
+    try:
+        await bus_estados.publicar(id_audio, {k: _iso(campos[k]) for k in CAMPOS_ESTADO if k in campos})
+    except Exception as e:
+        print(f"⚠️ No se pudo notificar el estado de {id_audio}: {e}")
+
+def _evento_sse(datos: dict) -> str:
+    return f"event: estado\ndata: {json.dumps(datos, ensure_ascii=False)}\n\n"
@@ -0,0 +1,572 @@
+# servicios/audio/inferencia.py
+"""
+Inferencia Whisper del microservicio de Audio: motores, registro de modelos y
+procesos de inferencia. Sin efectos al importar (no crea la app ni clientes de
+MongoDB, Redis o almacenamiento): es lo único que cargan los procesos hijos.
+"""
+
+from typing import Optional, List, Dict
+import os
+import asyncio
+import itertools
+import multiprocessing
+import threading
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+import whisper
+import numpy as np
+from dotenv import load_dotenv
+from pathlib import Path
+
+load_dotenv(dotenv_path=Path(__file__).resolve().parents[2] / ".env")
+
+# ==================== CONFIGURACIÓN ====================
+WHISPER_MODELO = os.getenv("WHISPER_MODELO", "tiny")
+WHISPER_IDIOMA = os.getenv("WHISPER_IDIOMA", "es")
+WHISPER_BEAM_SIZE = int(os.getenv("WHISPER_BEAM_SIZE", "3"))
+WHISPER_BEST_OF = int(os.getenv("WHISPER_BEST_OF", "3"))
+WHISPER_TEMPERATURA = float(os.getenv("WHISPER_TEMPERATURA", "0"))
+WHISPER_CONDITION_PREV = os.getenv("WHISPER_CONDITION_PREV", "false").lower() == "true"
+WHISPER_BACKEND = os.getenv("WHISPER_BACKEND", "openai").lower()  # openai | ctranslate2
+WHISPER_CT2_TIPO_COMPUTO = os.getenv("WHISPER_CT2_TIPO_COMPUTO", "int8")  # int8 | int8_float32 | float32
+WHISPER_CT2_HILOS = int(os.getenv("WHISPER_CT2_HILOS", "0"))  # 0 = automático
+WHISPER_CT2_DIRECTORIO = os.getenv("WHISPER_CT2_DIRECTORIO", "")  # Caché de modelos convertidos
+WHISPER_MEMORIA_MAX_MB = int(os.getenv("WHISPER_MEMORIA_MAX_MB", "0"))  # 0 = sin límite
+FRECUENCIA_MUESTREO = 16000  # Whisper trabaja a 16 kHz mono
+DURACION_VENTANA_WHISPER_S = 30  # Ventana nativa del encoder
+
+# Procesos de inferencia (0 = en hilos del proceso de la API)
+PROCESOS_TRANSCRIPCION = int(os.getenv("PROCESOS_TRANSCRIPCION", "2"))
+INFERENCIA_HILOS_TORCH = int(os.getenv("INFERENCIA_HILOS_TORCH", "0"))  # 0 = CPU asignadas / procesos
+INFERENCIA_FIJAR_CPUS = os.getenv("INFERENCIA_FIJAR_CPUS", "false").lower() == "true"
+INFERENCIA_CPUS_RESERVADAS_API = int(os.getenv("INFERENCIA_CPUS_RESERVADAS_API", "1"))
+
+# ==================== MOTORES DE INFERENCIA ====================
+# Interfaz común para el motor de Whisper: openai-whisper sobre PyTorch o
+# CTranslate2 (faster-whisper) cuantizado a int8 en CPU. Ambos devuelven el mismo
+# formato (texto + segmentos con marcas relativas al inicio del audio).
+
+def _segmentos_desde_tokens(tokenizer, tokens: List[int], duracion_s: float) -> List[dict]:
+    """Reconstruir segmentos con marcas de tiempo a partir de los tokens <|t|> del decoder"""
+    segmentos = []
+    inicio = 0.0
+    texto: List[int] = []
+    for token in tokens:
+        if token >= tokenizer.timestamp_begin:
+            tiempo = (token - tokenizer.timestamp_begin) * 0.02
+            if texto:
+                segmentos.append((inicio, tiempo, texto))
+                texto = []
+            inicio = tiempo
+        else:
+            texto.append(token)
+    if texto:
+        segmentos.append((inicio, duracion_s, texto))
+    return [
+        {
+            "inicio": inicio,
+            "fin": min(fin, duracion_s),
+            "texto": tokenizer.decode(texto).strip(),
+        }
+        for inicio, fin, texto in segmentos
+        if tokenizer.decode(texto).strip()
+    ]
+
+# Umbrales con los que transcribe() de openai-whisper decide reintentar o descartar una ventana
+UMBRAL_COMPRESION = 2.4
+UMBRAL_LOGPROB = -1.0
+UMBRAL_SIN_VOZ = 0.6
+
+class MotorWhisper:
+    """Interfaz de un motor de inferencia Whisper"""
+    nombre = "base"
+    soporta_lotes = False  # decode por lotes sobre mel apilados
+    bytes_por_parametro = 4
+
+    def cargar(self, modelo: str):
+        raise NotImplementedError
+
+    def transcribir(self, modelo_cargado, audio: np.ndarray, opciones: dict) -> dict:
+        raise NotImplementedError
+
+    def transcribir_lote(self, modelo_cargado, audios: List[np.ndarray], opciones: dict) -> List[dict]:
+        return [self.transcribir(modelo_cargado, audio, opciones) for audio in audios]
+
+class MotorOpenAIWhisper(MotorWhisper):
+    """openai-whisper sobre PyTorch (fp32 en CPU)"""
+    nombre = "openai"
+    soporta_lotes = True
+
+    def cargar(self, modelo: str):
+        return whisper.load_model(modelo)
+
+    def transcribir(self, modelo_cargado, audio: np.ndarray, opciones: dict) -> dict:
+        resultado = modelo_cargado.transcribe(audio, **opciones)
+        return {
+            "texto": resultado.get("text", "").strip(),
+            "segmentos": [
+                {"inicio": s["start"], "fin": s["end"], "texto": s["text"].strip()}
+                for s in resultado.get("segments", [])
+            ],
+        }
+
+    @staticmethod
+    def _requiere_respaldo(resultado) -> bool:
+        """Mismo criterio que transcribe(): texto repetitivo o poco probable, salvo que sea silencio"""
+        if resultado.no_speech_prob > UMBRAL_SIN_VOZ:
+            return False
+        return resultado.compression_ratio > UMBRAL_COMPRESION or resultado.avg_logprob < UMBRAL_LOGPROB
+
+    @staticmethod
+    def _sin_voz(resultado) -> bool:
+        return resultado.no_speech_prob > UMBRAL_SIN_VOZ and resultado.avg_logprob <= UMBRAL_LOGPROB
+
+    def transcribir_lote(self, modelo_cargado, audios: List[np.ndarray], opciones: dict) -> List[dict]:
+        """
+        Primera pasada de decode para todo el lote. Los fragmentos que transcribe() no
+        aceptaría (compresión o logprob fuera de umbral) o que exceden la ventana de
+        30 s se repiten con transcribe(), que aplica el respaldo de temperatura; los
+        que son silencio se descartan como lo hace transcribe().
+        """
+
+        ventana = DURACION_VENTANA_WHISPER_S * FRECUENCIA_MUESTREO
+        en_lote = [i for i, audio in enumerate(audios) if len(audio) <= ventana]
+        resultados: List[Optional[dict]] = [None] * len(audios)
+        if en_lote:
+            for i, resultado in zip(en_lote, self._decodificar_lote(modelo_cargado, [audios[i] for i in en_lote], opciones)):
+                if self._sin_voz(resultado):
+                    resultados[i] = {"texto": "", "segmentos": []}
+                elif not self._requiere_respaldo(resultado):
+                    resultados[i] = {
+                        "texto": resultado.text.strip(),
+                        "segmentos": _segmentos_desde_tokens(
+                            self._tokenizer(modelo_cargado, opciones), resultado.tokens, len(audios[i]) / FRECUENCIA_MUESTREO
+                        ),
+                    }
+        return [
+            resultado if resultado is not None else self.transcribir(modelo_cargado, audio, opciones)
+            for audio, resultado in zip(audios, resultados)
+        ]
+
+    @staticmethod
+    def _tokenizer(modelo_cargado, opciones: dict):
+        return whisper.tokenizer.get_tokenizer(
+            modelo_cargado.is_multilingual,
+            num_languages=modelo_cargado.num_languages,
+            language=opciones["language"],
+            task="transcribe",
+        )
+
+    def _decodificar_lote(self, modelo_cargado, audios: List[np.ndarray], opciones: dict) -> list:
+        import torch
+
+        mel = torch.stack([
+            whisper.log_mel_spectrogram(whisper.pad_or_trim(audio), modelo_cargado.dims.n_mels)
+            for audio in audios
+        ]).to(modelo_cargado.device)
+        temperatura = opciones["temperature"]
+        # Igual que el primer intento de transcribe(): beam con temperatura 0, best_of con muestreo
+        return modelo_cargado.decode(mel, whisper.DecodingOptions(
+            task="transcribe",
+            language=opciones["language"],
+            temperature=temperatura,
+            beam_size=opciones["beam_size"] if temperatura == 0 else None,
+            best_of=opciones["best_of"] if temperatura > 0 else None,
+            fp16=opciones["fp16"],
+        ))
+
+class MotorCTranslate2(MotorWhisper):
+    """faster-whisper (CTranslate2) con pesos cuantizados; requiere el paquete faster-whisper"""
+    nombre = "ctranslate2"
+
+    def __init__(self, tipo_computo: str, hilos: int, directorio: Optional[str]):
+        self.tipo_computo = tipo_computo
+        self.hilos = hilos
+        self.directorio = directorio
+        self.bytes_por_parametro = 1 if tipo_computo.startswith("int8") else 2 if "16" in tipo_computo else 4
+
+    def cargar(self, modelo: str):
+        try:
+            from faster_whisper import WhisperModel
+        except ImportError:
+            raise RuntimeError("WHISPER_BACKEND=ctranslate2 requiere el paquete faster-whisper")
+        return WhisperModel(
+            modelo,
+            device="cpu",
+            compute_type=self.tipo_computo,
+            cpu_threads=self.hilos,
+            download_root=self.directorio,
+        )
+
+    def transcribir(self, modelo_cargado, audio: np.ndarray, opciones: dict) -> dict:
+        segmentos, _ = modelo_cargado.transcribe(
+            audio,
+            language=opciones["language"],
+            task="transcribe",
+            beam_size=opciones.get("beam_size") or 1,
+            best_of=opciones.get("best_of") or 1,
+            temperature=opciones["temperature"],
+            condition_on_previous_text=opciones["condition_on_previous_text"],
+            vad_filter=False,  # El recorte de silencio ya se hizo en la pre-pasada
+        )
+        segmentos = [
+            {"inicio": s.start, "fin": s.end, "texto": s.text.strip()}
+            for s in segmentos  # Generador: la inferencia ocurre al iterar
+        ]
+        return {"texto": " ".join(s["texto"] for s in segmentos if s["texto"]), "segmentos": segmentos}
+
+def crear_motor_whisper() -> MotorWhisper:
+    if WHISPER_BACKEND == "ctranslate2":
+        return MotorCTranslate2(WHISPER_CT2_TIPO_COMPUTO, WHISPER_CT2_HILOS, WHISPER_CT2_DIRECTORIO or None)
+    if WHISPER_BACKEND != "openai":
+        raise RuntimeError(f"WHISPER_BACKEND desconocido: {WHISPER_BACKEND}")
+    return MotorOpenAIWhisper()
+
+motor_whisper = crear_motor_whisper()
+
+# ==================== MODELOS WHISPER ====================
+# Registro de modelos por tamaño: se cargan bajo demanda y, si se supera el
+# presupuesto de memoria, se desaloja el menos usado recientemente que esté libre.
+
+# Millones de parámetros por tamaño (fp32 = 4 bytes por parámetro, int8 = 1)
+_PARAMETROS_MODELO_M = {"tiny": 39, "base": 74, "small": 244, "medium": 769, "large": 1550, "turbo": 809}
+
+def estimar_memoria_modelo_mb(nombre: str) -> int:
+    """Memoria aproximada de un modelo a partir de su tamaño nominal y la precisión del motor"""
+    base = nombre.split(".")[0].split("-")[0]
+    return _PARAMETROS_MODELO_M.get(base, _PARAMETROS_MODELO_M["large"]) * motor_whisper.bytes_por_parametro
+
+class RegistroModelos:
+    """Modelos Whisper cargados por nombre, con desalojo LRU por presupuesto de memoria"""
+
+    def __init__(self, memoria_max_mb: int):
+        self.memoria_max_mb = memoria_max_mb  # 0 = sin límite
+        self._modelos: "OrderedDict[str, object]" = OrderedDict()
+        self._en_uso: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._lock_carga = threading.Lock()
+        self.contadores = {"aciertos": 0, "cargas": 0, "desalojos": 0}
+
+    def memoria_mb(self) -> int:
+        return sum(estimar_memoria_modelo_mb(n) for n in self._modelos)
+
+    def _desalojar_para(self, nombre: str):
+        if not self.memoria_max_mb:
+            return
+        necesario = estimar_memoria_modelo_mb(nombre)
+        for candidato in list(self._modelos):
+            if self.memoria_mb() + necesario <= self.memoria_max_mb:
+                return
+            if self._en_uso.get(candidato):
+                continue
+            del self._modelos[candidato]
+            self.contadores["desalojos"] += 1
+            print(f"♻️ Modelo Whisper '{candidato}' desalojado (presupuesto {self.memoria_max_mb} MB)")
+        if self.memoria_mb() + necesario > self.memoria_max_mb:
+            print(f"⚠️ Cargando '{nombre}' por encima del presupuesto de memoria (modelos en uso)")
+
+    def obtener(self, nombre: str):
+        """Retornar el modelo, cargándolo si hace falta (una carga a la vez)"""
+        with self._lock:
+            if nombre in self._modelos:
+                self._modelos.move_to_end(nombre)
+                self.contadores["aciertos"] += 1
+                return self._modelos[nombre]
+        with self._lock_carga:
+            with self._lock:
+                if nombre in self._modelos:
+                    return self._modelos[nombre]
+                self._desalojar_para(nombre)
+            print(f"🔄 Cargando modelo Whisper ({nombre}, motor {motor_whisper.nombre})...")
+            modelo = motor_whisper.cargar(nombre)
+            with self._lock:
+                self._modelos[nombre] = modelo
+                self.contadores["cargas"] += 1
+            print(f"✅ Modelo Whisper cargado ({nombre})")
+            return modelo
+
+    @contextmanager
+    def usar(self, nombre: str):
+        """Obtener el modelo y protegerlo del desalojo mientras se usa"""
+        with self._lock:
+            self._en_uso[nombre] = self._en_uso.get(nombre, 0) + 1
+        try:
+            yield self.obtener(nombre)
+        finally:
+            with self._lock:
+                self._en_uso[nombre] -= 1
+
+    def estado(self) -> dict:
+        with self._lock:
+            return {
+                "cargados": list(self._modelos),
+                "en_uso": {n: c for n, c in self._en_uso.items() if c},
+                "memoria_mb": self.memoria_mb(),
+                "memoria_max_mb": self.memoria_max_mb or None,
+                **self.contadores,
+            }
+
+registro_modelos = RegistroModelos(WHISPER_MEMORIA_MAX_MB)
+
+# ==================== PROCESOS DE INFERENCIA ====================
+# La inferencia corre en procesos dedicados (uno por modelo cargado), fuera del
+# proceso de la API: cada uno con hilos de PyTorch fijos y, opcionalmente, fijado
+# a sus propias CPU. La API mantiene la cola de trabajos y los reparte a los procesos
+# libres por un pipe propio de cada uno (si un proceso muere no deja bloqueada una
+# cola compartida); los procesos que terminan se reinician.
+
+class ProcesoInferenciaCaido(RuntimeError):
+    """El proceso que ejecutaba el trabajo terminó antes de responder"""
+
+def repartir_cpus(procesos: int, reservadas_api: int = 0) -> List[List[int]]:
+    """Repartir las CPU disponibles en bloques disjuntos, dejando `reservadas_api` para el event loop"""
+    disponibles = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count() or 1))
+    if len(disponibles) - reservadas_api >= procesos:
+        disponibles = disponibles[reservadas_api:]
+    por_proceso = max(1, len(disponibles) // procesos)
+    return [
+        disponibles[i * por_proceso:(i + 1) * por_proceso] or [disponibles[i % len(disponibles)]]
+        for i in range(procesos)
+    ]
+
+def _proceso_inferencia(conexion, hilos: int, cpus: Optional[List[int]], precargar: bool):
+    """Bucle de un proceso de inferencia: recibe trabajos por su pipe y responde por el mismo"""
+    if cpus and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cpus)
+    import torch
+    torch.set_num_threads(hilos)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        pass  # Ya fijado en este proceso
+    if isinstance(motor_whisper, MotorCTranslate2) and not motor_whisper.hilos:
+        motor_whisper.hilos = hilos
+    if precargar:
+        registro_modelos.obtener(WHISPER_MODELO)
+    conexion.send(("listo", None, os.getpid()))
+
+    while True:
+        try:
+            trabajo = conexion.recv()
+        except EOFError:
+            return  # La API cerró el pipe
+        if trabajo is None:
+            return
+        id_trabajo, funcion, args = trabajo
+        try:
+            conexion.send(("ok", id_trabajo, funcion(*args)))
+        except Exception as e:
+            conexion.send(("error", id_trabajo, f"{type(e).__name__}: {e}"))
+
+class PoolInferencia:
+    """Procesos de inferencia supervisados; la API reparte los trabajos a los procesos libres"""
+
+    def __init__(self, procesos: int, hilos: int, cpus: List[Optional[List[int]]], precargar: bool = True):
+        self.procesos = procesos
+        self.hilos = hilos
+        self.cpus = cpus
+        self.precargar = precargar
+        self._contexto = multiprocessing.get_context("spawn")
+        self._workers: List[Optional[dict]] = [None] * procesos
+        self._pendientes: deque = deque()  # (id_trabajo, funcion, args) aún sin proceso
+        self._futuros: Dict[int, asyncio.Future] = {}
+        self._ids = itertools.count()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._deteniendo = False
+        self.contadores = {"completados": 0, "errores": 0, "reinicios": 0}
+
+    def _lanzar(self, indice: int):
+        conexion, conexion_hijo = self._contexto.Pipe()
+        proceso = self._contexto.Process(
+            target=_proceso_inferencia,
+            args=(conexion_hijo, self.hilos, self.cpus[indice], self.precargar),
+            name=f"inferencia-{indice}",
+            daemon=True,
+        )
+        proceso.start()
+        conexion_hijo.close()
+        worker = {"proceso": proceso, "conexion": conexion, "pid": None, "trabajo": None}
+        self._workers[indice] = worker
+        threading.Thread(
+            target=self._leer_resultados,
+            args=(indice, worker, self._loop),
+            name=f"inferencia-{indice}-resultados",
+            daemon=True,
+        ).start()
+
+    def iniciar(self):
+        if self._loop is not None:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._deteniendo = False
+        for indice in range(self.procesos):
+            self._lanzar(indice)
+        print(f"🧵 {self.procesos} proceso(s) de inferencia, {self.hilos} hilo(s) c/u, CPU {self.cpus}")
+
+    def _leer_resultados(self, indice: int, worker: dict, loop: asyncio.AbstractEventLoop):
+        """
+        Hilo lector de un proceso: entrega sus respuestas al event loop y detecta su caída.
+        Usa el loop con el que se lanzó el proceso: detener() deja self._loop en None.
+        """
+        while True:
+            try:
+                mensaje = worker["conexion"].recv()
+            except (EOFError, OSError):
+                self._entregar(loop, self._caido, indice, worker)
+                return
+            if not self._entregar(loop, self._procesar, worker, mensaje):
+                return
+
+    @staticmethod
+    def _entregar(loop: asyncio.AbstractEventLoop, callback, *args) -> bool:
+        try:
+            loop.call_soon_threadsafe(callback, *args)
+            return True
+        except RuntimeError:
+            return False  # El event loop ya terminó: el pool se detuvo
+
+    def _procesar(self, worker: dict, mensaje: tuple):
+        tipo, id_trabajo, valor = mensaje
+        if tipo == "listo":
+            worker["pid"] = valor
+        else:
+            worker["trabajo"] = None
+            futuro = self._futuros.pop(id_trabajo, None)
+            if tipo == "ok":
+                self.contadores["completados"] += 1
+                if futuro and not futuro.done():
+                    futuro.set_result(valor)
+            else:
+                self.contadores["errores"] += 1
+                if futuro and not futuro.done():
+                    futuro.set_exception(RuntimeError(valor))
+        self._repartir()
+
+    def _caido(self, indice: int, worker: dict):
+        if self._workers[indice] is not worker:
+            return
+        worker["proceso"].join(1)
+        if worker["trabajo"] is not None:
+            futuro = self._futuros.pop(worker["trabajo"], None)
+            if futuro and not futuro.done():
+                futuro.set_exception(ProcesoInferenciaCaido(f"El proceso de inferencia {indice} terminó"))
+        if self._deteniendo:
+            self._workers[indice] = None
+            return
+        print(f"⚠️ Proceso de inferencia {indice} terminó (código {worker['proceso'].exitcode}); reiniciando")
+        self.contadores["reinicios"] += 1
+        self._lanzar(indice)
+
+    def _repartir(self):
+        """Enviar trabajos pendientes a los procesos listos y libres"""
+        for worker in self._workers:
+            if not self._pendientes:
+                return
+            if worker is None or worker["pid"] is None or worker["trabajo"] is not None:
+                continue
+            id_trabajo, funcion, args = self._pendientes.popleft()
+            if id_trabajo not in self._futuros:
+                continue  # Cancelado mientras esperaba
+            worker["trabajo"] = id_trabajo
+            try:
+                worker["conexion"].send((id_trabajo, funcion, args))
+            except (OSError, ValueError):
+                pass  # El hilo lector detecta la caída y falla el trabajo
+
+    async def ejecutar(self, funcion, *args):
+        """Ejecutar funcion(*args) en algún proceso libre y esperar el resultado"""
+        self.iniciar()
+        id_trabajo = next(self._ids)
+        futuro = self._loop.create_future()
+        self._futuros[id_trabajo] = futuro
+        self._pendientes.append((id_trabajo, funcion, args))
+        self._repartir()
+        try:
+            return await futuro
+        finally:
+            self._futuros.pop(id_trabajo, None)
+
+    async def detener(self):
+        if self._loop is None:
+            return
+        self._deteniendo = True
+        for worker in self._workers:
+            if worker is None:
+                continue
+            try:
+                worker["conexion"].send(None)
+            except (OSError, ValueError):
+                pass
+            await asyncio.to_thread(worker["proceso"].join, 5)
+            if worker["proceso"].is_alive():
+                worker["proceso"].terminate()
+        for futuro in self._futuros.values():
+            if not futuro.done():
+                futuro.set_exception(ProcesoInferenciaCaido("Pool de inferencia detenido"))
+        self._futuros.clear()
+        self._pendientes.clear()
+        self._workers = [None] * self.procesos
+        self._loop = None
+
+    def estado(self) -> dict:
+        workers = [w for w in self._workers if w is not None]
+        return {
+            "procesos": self.procesos,
+            "vivos": sum(1 for w in workers if w["proceso"].is_alive()),
+            "listos": sum(1 for w in workers if w["pid"] is not None),
+            "hilos_por_proceso": self.hilos,
+            "cpus": self.cpus,
+            "en_curso": sum(1 for w in workers if w["trabajo"] is not None),
+            "pendientes": len(self._pendientes),
+            **self.contadores,
+        }
+
+def crear_pool_inferencia() -> Optional[PoolInferencia]:
+    if PROCESOS_TRANSCRIPCION <= 0:
+        return None  # Inferencia en hilos del propio proceso de la API
+    if INFERENCIA_FIJAR_CPUS:
+        cpus = repartir_cpus(PROCESOS_TRANSCRIPCION, INFERENCIA_CPUS_RESERVADAS_API)
+    else:
+        cpus = [None] * PROCESOS_TRANSCRIPCION
+    hilos = INFERENCIA_HILOS_TORCH or (
+        len(cpus[0]) if cpus[0] else max(1, (os.cpu_count() or 1) // PROCESOS_TRANSCRIPCION)
+    )
+    return PoolInferencia(PROCESOS_TRANSCRIPCION, hilos, cpus)
+
+# ==================== TRABAJOS DE INFERENCIA ====================
+# Funciones que se envían a los procesos (o a hilos): se serializan por referencia,
+# así que deben vivir en este módulo y no en main.
+
+def _transcribir_segmento(audio: np.ndarray, desplazamiento_s: float, opciones: dict, modelo: str = WHISPER_MODELO) -> dict:
+    """Transcribir un segmento (se ejecuta dentro de un proceso de inferencia o en un hilo)"""
+    with registro_modelos.usar(modelo) as modelo_cargado:
+        resultado = motor_whisper.transcribir(modelo_cargado, audio, opciones)
+    return _desplazar_segmentos(resultado, desplazamiento_s)
+
+def opciones_whisper() -> dict:
+    """Parámetros de decodificación de Whisper configurados por entorno"""
+    return {
+        "fp16": False,
+        "language": WHISPER_IDIOMA,
+        "beam_size": WHISPER_BEAM_SIZE,
+        "best_of": WHISPER_BEST_OF,
+        "temperature": WHISPER_TEMPERATURA,
+        "condition_on_previous_text": WHISPER_CONDITION_PREV,
+        "verbose": False,
+    }
+
+def _desplazar_segmentos(resultado: dict, desplazamiento_s: float) -> dict:
+    """Pasar las marcas del motor (relativas al fragmento) a la línea de tiempo del audio"""
+    return {
+        "texto": resultado["texto"],
+        "segmentos": [
+            {"inicio": round(s["inicio"] + desplazamiento_s, 2), "fin": round(s["fin"] + desplazamiento_s, 2), "texto": s["texto"]}
+            for s in resultado["segmentos"]
+        ],
+    }
+
+def _transcribir_lote(audios: List[np.ndarray], desplazamientos: List[float], opciones: dict, modelo: str) -> List[dict]:
+    """Decodificar un lote de segmentos (≤ 30 s) en una sola pasada del modelo"""
+    with registro_modelos.usar(modelo) as modelo_cargado:
+        resultados = motor_whisper.transcribir_lote(modelo_cargado, audios, opciones)
+    return [_desplazar_segmentos(r, d) for r, d in zip(resultados, desplazamientos)]
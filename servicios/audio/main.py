@@ -4,42 +4,94 @@ Microservicio de Procesamiento de Audio - Project Parallel
 Maneja grabación, almacenamiento y transcripción de audio con Whisper
 """
 
-from fastapi import FastAPI, File, UploadFile, HTTPException, BackgroundTasks, Depends, Header
+from fastapi import FastAPI, HTTPException, Depends, Header, Request, WebSocket
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
+from fastapi.responses import Response, StreamingResponse
 from pydantic import BaseModel, Field
-from typing import Optional, List
+from typing import Optional, List, Dict, Tuple
 import os
 import uuid
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
 import asyncio
-from motor.motor_asyncio import AsyncIOMotorClient
-from minio import Minio
-from minio.error import S3Error
-import whisper
-import tempfile
-import io
-import re
+import base64
+import hashlib
+import json
+import time
+from multipart.multipart import MultipartParser, parse_options_header
+import numpy as np
 import jwt
 from dotenv import load_dotenv
 from pathlib import Path
+from email.utils import format_datetime, parsedate_to_datetime
+from inferencia import motor_whisper, registro_modelos
+from almacenamiento import (
+    BUCKET_MINIO,
+    MAX_TAMANO_AUDIO_BYTES,
+    MAX_TAMANO_AUDIO_MB,
+    ErrorAlmacenamiento,
+    ObjetoNoEncontrado,
+    SubidaEnStreaming,
+    almacenamiento,
+)
+from base_datos import bd, coleccion_audios
+from cola import (
+    COLA_BACKEND,
+    PRIORIDAD_NORMAL,
+    WORKERS_TRANSCRIPCION,
+    _percentil,
+    cola_transcripcion,
+    encolar_transcripcion,
+    obtener_metricas_cola,
+)
+from estados import _evento_sse, _iso, _tokens_muestra, bus_estados, datos_estado_audio, estado_definitivo
+from pipeline import (
+    CALIDADES,
+    PIPELINE_CAPACIDAD,
+    PIPELINE_PREPARADORES,
+    PIPELINE_TRANSCRIPCION,
+    TRANSCRIPCION_DOS_PASADAS,
+    WHISPER_MODELO_BORRADOR,
+    WHISPER_MODELO_REFINADO,
+    _bucle_recuperacion_cola,
+    _bucle_worker_transcripcion,
+    _rehidratar_cola,
+    buscar_transcripcion_cache,
+    campos_desde_cache,
+    campos_version,
+    duraciones_trabajo_ms,
+    obtener_metricas_lotes,
+    obtener_metricas_transcripcion,
+    pasada_cache,
+    pasada_inicial,
+    pipeline_transcripcion,
+    planificador_lotes,
+    pool_inferencia,
+    reutilizar_objeto_existente,
+    rutas_elegidas,
+)
+from en_vivo import MAX_SESIONES_EN_VIVO, atender_sesion_en_vivo, sesiones_en_vivo
 
 load_dotenv(dotenv_path=Path(__file__).resolve().parents[2] / ".env")
 
 # ==================== CONFIGURACIÓN ====================
-URL_MONGODB = os.getenv("URL_MONGODB", os.getenv("MONGODB_URL", "mongodb://localhost:27017"))
-ENDPOINT_MINIO = os.getenv("ENDPOINT_MINIO", os.getenv("MINIO_ENDPOINT", "localhost:9000"))
-CLAVE_ACCESO_MINIO = os.getenv("CLAVE_ACCESO_MINIO", os.getenv("MINIO_USER", "admin"))
-CLAVE_SECRETA_MINIO = os.getenv("CLAVE_SECRETA_MINIO", os.getenv("MINIO_PASSWORD", "password"))
-BUCKET_MINIO = "archivos-audio"
-MINIO_SEGURO = os.getenv("MINIO_SEGURO", os.getenv("MINIO_SECURE", "False")).lower() == "true"
+# Cada módulo lee su propia configuración: almacenamiento.py, base_datos.py, cola.py,
+# pipeline.py, en_vivo.py e inferencia.py; aquí queda la de la API
 SECRETO_JWT = os.getenv("SECRETO_JWT", os.getenv("JWT_SECRET", ""))
-WHISPER_MODELO = os.getenv("WHISPER_MODELO", "tiny")
-WHISPER_IDIOMA = os.getenv("WHISPER_IDIOMA", "es")
-WHISPER_BEAM_SIZE = int(os.getenv("WHISPER_BEAM_SIZE", "3"))
-WHISPER_BEST_OF = int(os.getenv("WHISPER_BEST_OF", "3"))
-WHISPER_TEMPERATURA = float(os.getenv("WHISPER_TEMPERATURA", "0"))
-WHISPER_CONDITION_PREV = os.getenv("WHISPER_CONDITION_PREV", "false").lower() == "true"
+
+# Control de admisión (0 = sin límite)
+ADMISION_MAX_PENDIENTES = int(os.getenv("ADMISION_MAX_PENDIENTES", "200"))
+ADMISION_MAX_ESPERA_S = int(os.getenv("ADMISION_MAX_ESPERA_S", "1800"))
+ADMISION_MAX_POR_USUARIO = int(os.getenv("ADMISION_MAX_POR_USUARIO", "5"))
+ADMISION_TIEMPO_TRABAJO_S = float(os.getenv("ADMISION_TIEMPO_TRABAJO_S", "30"))  # Hasta tener mediciones
+
+# Listado paginado
+LISTADO_MAX_LIMITE = int(os.getenv("LISTADO_MAX_LIMITE", "200"))
+
+# Eventos de estado (SSE)
+SSE_LATIDO_SEGUNDOS = float(os.getenv("SSE_LATIDO_SEGUNDOS", "15"))
+SSE_MAX_SEGUNDOS = float(os.getenv("SSE_MAX_SEGUNDOS", "600"))  # Luego el cliente reconecta
+SSE_REINTENTO_MS = int(os.getenv("SSE_REINTENTO_MS", "3000"))
+SSE_TOKEN_SEGUNDOS = int(os.getenv("SSE_TOKEN_SEGUNDOS", "60"))  # Vigencia de los tokens de /eventos y /en-vivo
 
 if not SECRETO_JWT:
     raise RuntimeError("SECRETO_JWT/JWT_SECRET es obligatorio")
@@ -63,37 +115,12 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Cliente MongoDB
-cliente_mongo = AsyncIOMotorClient(URL_MONGODB)
-bd = cliente_mongo.project_parallel
-coleccion_audios = bd.audios
-
-# Cliente MinIO
-cliente_minio = Minio(
-    ENDPOINT_MINIO,
-    access_key=CLAVE_ACCESO_MINIO,
-    secret_key=CLAVE_SECRETA_MINIO,
-    secure=MINIO_SEGURO
-)
-
-# Asegurar que el bucket existe
-try:
-    if not cliente_minio.bucket_exists(BUCKET_MINIO):
-        cliente_minio.make_bucket(BUCKET_MINIO)
-        print(f"✅ Bucket '{BUCKET_MINIO}' creado exitosamente")
-except S3Error as e:
-    print(f"⚠️ Error configurando MinIO: {e}")
-
-# Modelo Whisper (se carga una vez al inicio)
-print("🔄 Cargando modelo Whisper...")
-modelo_whisper = whisper.load_model(WHISPER_MODELO)
-print(f"✅ Modelo Whisper cargado ({WHISPER_MODELO})")
-
 # ==================== ESQUEMAS ====================
 class RespuestaSubidaAudio(BaseModel):
     id_audio: str = Field(..., description="ID único del audio")
     estado: str = Field(..., description="Estado del procesamiento")
     mensaje: str = Field(..., description="Mensaje informativo")
+    finalizacion_estimada: Optional[datetime] = Field(None, description="Hora estimada de la transcripción")
 
 class RespuestaEstadoAudio(BaseModel):
     id_audio: str
@@ -136,150 +163,370 @@ def verificar_token(authorization: Optional[str] = Header(None)) -> dict:
     except Exception:
         raise HTTPException(status_code=401, detail="Error de autenticación")
 
-async def guardar_en_minio(
-    contenido_archivo: bytes,
-    nombre_archivo: str,
-    content_type: str = "application/octet-stream",
-) -> str:
-    """Subir archivo a MinIO y retornar nombre del objeto"""
-    nombre_objeto = f"{uuid.uuid4()}_{nombre_archivo}"
-    
+def crear_token_corto(datos_usuario: dict, tipo: str, id_audio: Optional[str] = None) -> str:
+    """
+    Token de corta duración para /eventos (tipo "eventos", ligado a un audio) y /en-vivo
+    (tipo "en_vivo"). EventSource y WebSocket no permiten cabeceras y el token viaja en
+    la URL (que queda en logs), así que solo sirve para un uso y vence pronto.
+    """
+    payload = {
+        "sub": str(datos_usuario.get("sub")),
+        "usuario": datos_usuario.get("usuario"),
+        "tipo": tipo,
+        "exp": datetime.now(timezone.utc) + timedelta(seconds=SSE_TOKEN_SEGUNDOS),
+    }
+    if id_audio is not None:
+        payload["id_audio"] = id_audio
+    return jwt.encode(payload, SECRETO_JWT, algorithm="HS256")
+
+def verificar_token_corto(token: str, tipo: str, id_audio: Optional[str] = None) -> dict:
+    """Validar un token de corta duración: firmado, vigente y emitido para este uso (y audio)"""
+    payload = verificar_token(f"Bearer {token}")
+    if payload.get("tipo") != tipo or payload.get("id_audio") != id_audio:
+        raise HTTPException(status_code=401, detail="Token de corta duración inválido")
+    return payload
+
+# ==================== CICLO DE VIDA ====================
+# Al arrancar: bucket, índices, rehidratación de la cola, relevo de estados y workers.
+
+@app.on_event("startup")
+async def preparar_almacenamiento():
+    """Asegurar que el bucket existe (antes se hacía al importar, bloqueando el arranque)"""
+    try:
+        if await almacenamiento.asegurar_bucket():
+            print(f"✅ Bucket '{BUCKET_MINIO}' creado exitosamente")
+    except ErrorAlmacenamiento as e:
+        print(f"⚠️ Error configurando almacenamiento ({almacenamiento.backend}): {e}")
+
+@app.on_event("shutdown")
+async def cerrar_almacenamiento():
+    almacenamiento.cerrar()
+
+async def _crear_indices_audio():
+    """Índices para buscar audios por hash de contenido y para el listado paginado por usuario"""
     try:
-        cliente_minio.put_object(
-            BUCKET_MINIO,
-            nombre_objeto,
-            io.BytesIO(contenido_archivo),
-            length=len(contenido_archivo),
-            content_type=content_type or "application/octet-stream",
+        await coleccion_audios.create_index("hash_contenido", sparse=True)
+        await coleccion_audios.create_index(
+            [("id_usuario", 1), ("fecha_creacion", -1), ("_id", -1)], name="usuario_fecha_id"
+        )
+    except Exception as e:
+        print(f"⚠️ No se pudieron crear los índices de audio: {e}")
+
+tareas_workers: List[asyncio.Task] = []
+
+@app.on_event("startup")
+async def iniciar_workers_transcripcion():
+    """Arrancar los workers de transcripción y la recuperación de leases"""
+    tareas_workers.append(asyncio.create_task(_crear_indices_audio()))
+    tareas_workers.append(asyncio.create_task(_rehidratar_cola()))
+    if bus_estados.cliente is not None:
+        tareas_workers.append(asyncio.create_task(bus_estados.relevar()))
+    tareas_workers.append(asyncio.create_task(_bucle_recuperacion_cola()))
+    if PIPELINE_TRANSCRIPCION:
+        tareas_workers.extend(pipeline_transcripcion.tareas())
+        print(
+            f"✅ Cola de transcripción ({COLA_BACKEND}) en pipeline: {PIPELINE_PREPARADORES} preparador(es), "
+            f"{WORKERS_TRANSCRIPCION} worker(s) de inferencia, capacidad {PIPELINE_CAPACIDAD}"
         )
-        return nombre_objeto
-    except S3Error as e:
-        raise HTTPException(status_code=500, detail=f"Error en MinIO: {str(e)}")
+        return
+    for numero in range(WORKERS_TRANSCRIPCION):
+        tareas_workers.append(asyncio.create_task(_bucle_worker_transcripcion(numero + 1)))
+    print(f"✅ Cola de transcripción ({COLA_BACKEND}) con {WORKERS_TRANSCRIPCION} worker(s)")
+
+@app.on_event("shutdown")
+async def detener_workers_transcripcion():
+    for tarea in tareas_workers:
+        tarea.cancel()
+    await asyncio.gather(*tareas_workers, return_exceptions=True)
+    tareas_workers.clear()
+    pipeline_transcripcion.detener()
+    planificador_lotes.detener()
+    if pool_inferencia is not None:
+        await pool_inferencia.detener()
+
+# ==================== SUBIDA EN STREAMING ====================
+# El cuerpo multipart se procesa a medida que llega y cada bloque del archivo se
+# entrega al almacenamiento (subida multiparte en un hilo) sin cargar el audio completo en memoria.
+
+def es_contenido_audio(cabecera: bytes) -> bool:
+    """Validar por firma (magic bytes) que el contenido sea un formato de audio conocido"""
+    if cabecera[:4] == b"RIFF" and cabecera[8:12] == b"WAVE":
+        return True
+    if cabecera[:4] == b"FORM" and cabecera[8:12] in (b"AIFF", b"AIFC"):
+        return True
+    if cabecera[4:8] == b"ftyp":  # m4a / mp4 / 3gp
+        return True
+    if cabecera.startswith((b"OggS", b"fLaC", b"ID3", b"\x1aE\xdf\xa3", b"#!AMR")):
+        return True
+    # Frame sync MPEG / ADTS (mp3, aac sin contenedor)
+    return len(cabecera) >= 2 and cabecera[0] == 0xFF and (cabecera[1] & 0xE0) == 0xE0
+
+class _EventosMultipart:
+    """Callbacks de python-multipart acumulados como eventos para procesarlos en el event loop"""
+
+    def __init__(self):
+        self.eventos: List[Tuple[str, object]] = []
+        self._campo = b""
+        self._valor = b""
+
+    def callbacks(self) -> dict:
+        return {
+            "on_header_field": self.on_header_field,
+            "on_header_value": self.on_header_value,
+            "on_header_end": self.on_header_end,
+            "on_headers_finished": lambda: self.eventos.append(("cabeceras_listas", None)),
+            "on_part_data": lambda datos, inicio, fin: self.eventos.append(("datos", datos[inicio:fin])),
+            "on_part_end": lambda: self.eventos.append(("fin_parte", None)),
+        }
+
+    def on_header_field(self, datos: bytes, inicio: int, fin: int):
+        self._campo += datos[inicio:fin]
+
+    def on_header_value(self, datos: bytes, inicio: int, fin: int):
+        self._valor += datos[inicio:fin]
+
+    def on_header_end(self):
+        self.eventos.append(("cabecera", (self._campo.lower(), self._valor)))
+        self._campo = b""
+        self._valor = b""
+
+async def recibir_audio_en_streaming(request: Request, campo: str = "archivo") -> dict:
+    """
+    Recibir el campo de archivo de un multipart/form-data y subirlo al almacenamiento en streaming.
+    Valida tipo, firma y tamaño y calcula el SHA-256 sobre la marcha; retorna metadata del objeto guardado.
+    """
+    tipo, opciones = parse_options_header(request.headers.get("content-type", ""))
+    if tipo != b"multipart/form-data" or b"boundary" not in opciones:
+        raise HTTPException(status_code=400, detail="Se esperaba multipart/form-data")
+
+    receptor = _EventosMultipart()
+    parser = MultipartParser(opciones[b"boundary"], receptor.callbacks())
+    subida: Optional[SubidaEnStreaming] = None
+    cabeceras: Dict[bytes, bytes] = {}
+    recibiendo = False
+    recibido: Optional[dict] = None
+    inicio_archivo = bytearray()
+    hash_contenido = hashlib.sha256()
+    tamano = 0
+
+    async def arrancar_con_cabecera():
+        nonlocal subida
+        if not es_contenido_audio(bytes(inicio_archivo[:16])):
+            raise HTTPException(status_code=415, detail="El contenido no corresponde a un formato de audio soportado")
+        subida = almacenamiento.subida_en_streaming(recibido["nombre_objeto"], recibido["tipo_contenido"])
+        await subida.entregar(bytes(inicio_archivo))
 
-async def obtener_de_minio(nombre_objeto: str) -> bytes:
-    """Descargar archivo desde MinIO"""
     try:
-        respuesta = cliente_minio.get_object(BUCKET_MINIO, nombre_objeto)
-        datos = respuesta.read()
-        respuesta.close()
-        respuesta.release_conn()
-        return datos
-    except S3Error as e:
-        raise HTTPException(status_code=404, detail=f"Audio no encontrado: {str(e)}")
+        async for bloque_http in request.stream():
+            parser.write(bloque_http)
+            for evento, valor in receptor.eventos:
+                if evento == "cabecera":
+                    cabeceras[valor[0]] = valor[1]
+                elif evento == "cabeceras_listas":
+                    _, disposicion = parse_options_header(cabeceras.get(b"content-disposition", b""))
+                    tipo_parte = cabeceras.get(b"content-type", b"").decode("latin-1")
+                    cabeceras = {}
+                    if disposicion.get(b"name", b"").decode("latin-1") != campo or recibido is not None:
+                        continue
+                    if not tipo_parte.startswith("audio/"):
+                        raise HTTPException(status_code=400, detail="El archivo debe ser de tipo audio")
+                    nombre_archivo = os.path.basename(disposicion.get(b"filename", b"").decode("utf-8", "replace")) or "audio"
+                    recibido = {
+                        "nombre_archivo": nombre_archivo,
+                        "nombre_objeto": f"{uuid.uuid4()}_{nombre_archivo}",
+                        "tipo_contenido": tipo_parte,
+                    }
+                    recibiendo = True
+                elif evento == "datos" and recibiendo:
+                    tamano += len(valor)
+                    hash_contenido.update(valor)
+                    if tamano > MAX_TAMANO_AUDIO_BYTES:
+                        raise HTTPException(status_code=413, detail=f"El audio supera el máximo de {MAX_TAMANO_AUDIO_MB} MB")
+                    if subida is None:
+                        inicio_archivo.extend(valor)
+                        if len(inicio_archivo) >= 16:
+                            await arrancar_con_cabecera()
+                    else:
+                        await subida.entregar(valor)
+                elif evento == "fin_parte" and recibiendo:
+                    recibiendo = False
+                    if tamano == 0:
+                        raise HTTPException(status_code=400, detail="Archivo vacío")
+                    if subida is None:
+                        await arrancar_con_cabecera()
+                    await subida.finalizar()
+            receptor.eventos.clear()
+        parser.finalize()
 
-def limpiar_transcripcion(texto: str) -> str:
-    """Limpiar transcripción de muletillas y normalizar"""
-    if not isinstance(texto, str):
-        return ""
-    
-    # Muletillas a eliminar
-    muletillas = [
-        r"\beh\b", r"\beste\b", r"\bpues\b", r"\bo sea\b", 
-        r"\bmmm\b", r"\bajá\b", r"\bem\b", r"\bah\b", 
-        r"\bdigamos\b", r"\bentonces\b"
-    ]
-    
-    for muletilla in muletillas:
-        texto = re.sub(muletilla, " ", texto, flags=re.IGNORECASE)
-    
-    # Normalizar espacios
-    texto = re.sub(r"\s+", " ", texto)
-    texto = re.sub(r"\s+([.,!?;:])", r"\1", texto)
-    texto = texto.strip()
-    
-    # Capitalizar primera letra
-    if texto:
-        texto = texto[0].upper() + texto[1:]
-    
-    return texto
+        if recibido is None or subida is None:
+            raise HTTPException(status_code=400, detail=f"Falta el archivo de audio ('{campo}')")
+    except BaseException as e:
+        if subida is not None:
+            await subida.abortar(e)
+        if isinstance(e, ErrorAlmacenamiento):
+            raise HTTPException(status_code=500, detail=f"Error de almacenamiento: {str(e)}")
+        raise
+
+    recibido["tamano_bytes"] = tamano
+    recibido["hash_contenido"] = hash_contenido.hexdigest()
+    return recibido
+
+# ==================== LISTADO PAGINADO ====================
+# Paginación por cursor (keyset) sobre (fecha_creacion, _id): cada página es un
+# recorrido acotado del índice usuario_fecha_id, sin skip, sin importar cuántos audios haya.
 
-async def transcribir_audio(id_audio: str):
-    """Tarea en segundo plano para transcribir audio usando Whisper"""
+# Solo los campos del listado; el texto de la transcripción no sale de la base de datos
+PROYECCION_LISTADO = {
+    "nombre_archivo_original": 1,
+    "estado": 1,
+    "fecha_creacion": 1,
+    "tiene_transcripcion": {"$ne": [{"$ifNull": ["$transcripcion", None]}, None]},
+}
+
+def codificar_cursor_listado(doc: dict) -> str:
+    """Cursor opaco con la posición del último elemento de la página"""
+    fecha = doc["fecha_creacion"]
+    if fecha.tzinfo is None:
+        fecha = fecha.replace(tzinfo=timezone.utc)  # Motor devuelve fechas UTC sin zona
+    crudo = json.dumps({"f": fecha.isoformat(), "i": doc["_id"]}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(crudo.encode("utf-8")).decode("ascii").rstrip("=")
+
+def decodificar_cursor_listado(cursor: str) -> Tuple[datetime, str]:
     try:
-        # Actualizar estado a procesando
-        await coleccion_audios.update_one(
-            {"_id": id_audio},
-            {
-                "$set": {
-                    "estado": "procesando",
-                    "fecha_inicio_procesamiento": datetime.now(timezone.utc)
-                }
-            }
+        crudo = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        datos = json.loads(crudo)
+        return datetime.fromisoformat(datos["f"]), str(datos["i"])
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(status_code=400, detail="Cursor inválido")
+
+# ==================== DESCARGA POR RANGOS ====================
+
+def parsear_rango(cabecera: Optional[str], tamano: int) -> Optional[Tuple[int, int]]:
+    """
+    Interpretar una cabecera Range de un solo rango de bytes.
+    Retorna (inicio, fin) inclusivo, None si debe enviarse el objeto completo,
+    o lanza 416 si el rango no es satisfacible.
+    """
+    if not cabecera or not cabecera.strip().lower().startswith("bytes="):
+        return None
+    especificacion = cabecera.strip()[6:]
+    if "," in especificacion:
+        return None  # Multirango no soportado: se responde el objeto completo
+    inicio_txt, _, fin_txt = especificacion.strip().partition("-")
+    try:
+        if inicio_txt == "":
+            sufijo = int(fin_txt)
+            if sufijo <= 0:
+                raise ValueError
+            inicio, fin = max(0, tamano - sufijo), tamano - 1
+        else:
+            inicio = int(inicio_txt)
+            fin = int(fin_txt) if fin_txt else tamano - 1
+            if fin_txt and fin < inicio:
+                return None
+    except ValueError:
+        return None  # Cabecera inválida: se ignora (RFC 9110)
+    fin = min(fin, tamano - 1)
+    if inicio >= tamano:
+        raise HTTPException(
+            status_code=416,
+            detail="Rango no satisfacible",
+            headers={"Content-Range": f"bytes */{tamano}"},
         )
-        
-        # Obtener metadata del audio
-        doc_audio = await coleccion_audios.find_one({"_id": id_audio})
-        if not doc_audio:
-            raise Exception("Documento de audio no encontrado")
-        
-        # Descargar desde MinIO
-        bytes_audio = await obtener_de_minio(doc_audio["nombre_objeto_s3"])
-        
-        # Guardar en archivo temporal para Whisper
-        _, ext = os.path.splitext(doc_audio.get("nombre_archivo_original", ""))
-        if not ext:
-            ext = ".wav"
-        with tempfile.NamedTemporaryFile(suffix=ext, delete=False) as tmp:
-            tmp.write(bytes_audio)
-            ruta_tmp = tmp.name
-        
-        try:
-            # Transcribir con Whisper en hilo aparte para no bloquear el event loop
-            print(f"🎙️ Transcribiendo audio {id_audio}...")
-            transcribe_kwargs = {
-                "fp16": False,
-                "language": WHISPER_IDIOMA,
-                "beam_size": WHISPER_BEAM_SIZE,
-                "best_of": WHISPER_BEST_OF,
-                "temperature": WHISPER_TEMPERATURA,
-                "condition_on_previous_text": WHISPER_CONDITION_PREV,
-                "verbose": False,
-            }
-            inicio = datetime.now(timezone.utc)
-            resultado = await asyncio.to_thread(
-                modelo_whisper.transcribe,
-                ruta_tmp,
-                **transcribe_kwargs,
-            )
-            duracion_ms = int((datetime.now(timezone.utc) - inicio).total_seconds() * 1000)
-            transcripcion_raw = resultado.get("text", "").strip()
-            
-            # Limpiar transcripción
-            transcripcion = limpiar_transcripcion(transcripcion_raw)
-            
-            print(f"✅ Transcripción completada en {duracion_ms} ms: {transcripcion[:100]}...")
-            
-            # Actualizar documento con transcripción
-            await coleccion_audios.update_one(
-                {"_id": id_audio},
-                {
-                    "$set": {
-                        "estado": "completado",
-                        "transcripcion": transcripcion,
-                        "transcripcion_raw": transcripcion_raw,
-                        "fecha_procesamiento": datetime.now(timezone.utc)
-                    }
-                }
-            )
-            
-        finally:
-            # Limpiar archivo temporal
-            if os.path.exists(ruta_tmp):
-                os.remove(ruta_tmp)
-                
-    except Exception as e:
-        print(f"❌ Error transcribiendo audio {id_audio}: {str(e)}")
-        # Actualizar estado a fallido
-        await coleccion_audios.update_one(
-            {"_id": id_audio},
-            {
-                "$set": {
-                    "estado": "fallido",
-                    "error": str(e),
-                    "fecha_procesamiento": datetime.now(timezone.utc)
-                }
-            }
+    return inicio, fin
+
+def _coincide_etag(cabecera: Optional[str], etag: str) -> bool:
+    if not cabecera:
+        return False
+    candidatos = [c.strip().removeprefix("W/") for c in cabecera.split(",")]
+    return "*" in candidatos or etag in candidatos
+
+def _no_modificado_desde(cabecera: Optional[str], ultima_modificacion: Optional[datetime]) -> bool:
+    if not cabecera or ultima_modificacion is None:
+        return False
+    try:
+        fecha = parsedate_to_datetime(cabecera)
+    except (TypeError, ValueError):
+        return False
+    return ultima_modificacion.replace(microsecond=0) <= fecha
+
+# ==================== CONTROL DE ADMISIÓN ====================
+# Las subidas se rechazan antes de leer el cuerpo cuando la cola no podría
+# atenderlas a tiempo (503) o el usuario ya tiene demasiados audios en curso (429).
+# El tiempo de espera se estima con la duración reciente de las inferencias.
+
+metricas_admision = {"admitidos": 0, "rechazos_usuario": 0, "rechazos_cola": 0, "rechazos_espera": 0}
+
+class SobrecargaTranscripcion(HTTPException):
+    """Rechazo por carga con Retry-After y tiempo estimado de finalización"""
+
+    def __init__(self, status_code: int, mensaje: str, reintentar_s: float, espera_s: float):
+        reintentar_s = max(1, int(np.ceil(reintentar_s)))
+        finalizacion = datetime.now(timezone.utc) + timedelta(seconds=espera_s)
+        super().__init__(
+            status_code=status_code,
+            detail=f"{mensaje}. Reintente en {reintentar_s} s (finalización estimada si se encola ahora: {_iso(finalizacion)})",
+            headers={"Retry-After": str(reintentar_s), "X-Finalizacion-Estimada": _iso(finalizacion)},
+        )
+
+def tiempo_trabajo_estimado_s() -> float:
+    """Duración típica de un trabajo: mediana de las inferencias recientes o el valor configurado"""
+    if len(duraciones_trabajo_ms) >= 5:
+        return _percentil(duraciones_trabajo_ms, 50) / 1000
+    return ADMISION_TIEMPO_TRABAJO_S
+
+async def estado_backlog() -> dict:
+    """Trabajos pendientes/en curso y espera estimada para un trabajo nuevo"""
+    cola = await cola_transcripcion.profundidad()
+    # Los refinados en segundo plano no retrasan a un trabajo nuevo, que sale antes
+    cola["pendientes"] -= await cola_transcripcion.pendientes_segundo_plano()
+    tiempo_trabajo_s = tiempo_trabajo_estimado_s()
+    en_paralelo = max(1, WORKERS_TRANSCRIPCION)
+    espera_s = (cola["pendientes"] + cola["en_curso"]) / en_paralelo * tiempo_trabajo_s
+    return {
+        **cola,
+        "tiempo_trabajo_s": round(tiempo_trabajo_s, 1),
+        "espera_estimada_s": round(espera_s, 1),
+        "finalizacion_estimada": datetime.now(timezone.utc) + timedelta(seconds=espera_s + tiempo_trabajo_s),
+        "admitiendo": not (
+            (ADMISION_MAX_PENDIENTES and cola["pendientes"] >= ADMISION_MAX_PENDIENTES)
+            or (ADMISION_MAX_ESPERA_S and espera_s > ADMISION_MAX_ESPERA_S)
+        ),
+    }
+
+async def verificar_admision(id_usuario: int) -> dict:
+    """Admitir una subida o lanzar 429/503 con Retry-After; retorna el estado del backlog"""
+    backlog = await estado_backlog()
+    tiempo_trabajo_s = backlog["tiempo_trabajo_s"]
+    espera_s = backlog["espera_estimada_s"]
+
+    if ADMISION_MAX_PENDIENTES and backlog["pendientes"] >= ADMISION_MAX_PENDIENTES:
+        metricas_admision["rechazos_cola"] += 1
+        exceso = backlog["pendientes"] - ADMISION_MAX_PENDIENTES + 1
+        raise SobrecargaTranscripcion(
+            503, f"Cola de transcripción llena ({backlog['pendientes']} pendientes)",
+            exceso / max(1, WORKERS_TRANSCRIPCION) * tiempo_trabajo_s, espera_s + tiempo_trabajo_s,
+        )
+    if ADMISION_MAX_ESPERA_S and espera_s > ADMISION_MAX_ESPERA_S:
+        metricas_admision["rechazos_espera"] += 1
+        raise SobrecargaTranscripcion(
+            503, f"Espera estimada de {int(espera_s)} s supera el máximo de {ADMISION_MAX_ESPERA_S} s",
+            espera_s - ADMISION_MAX_ESPERA_S, espera_s + tiempo_trabajo_s,
         )
+    if ADMISION_MAX_POR_USUARIO:
+        en_curso_usuario = await coleccion_audios.count_documents(
+            {"id_usuario": id_usuario, "estado": {"$in": ["pendiente", "procesando"]}},
+            limit=ADMISION_MAX_POR_USUARIO,
+        )
+        if en_curso_usuario >= ADMISION_MAX_POR_USUARIO:
+            metricas_admision["rechazos_usuario"] += 1
+            raise SobrecargaTranscripcion(
+                429, f"Ya tiene {en_curso_usuario} audios en transcripción (máximo {ADMISION_MAX_POR_USUARIO})",
+                tiempo_trabajo_s, espera_s + tiempo_trabajo_s,
+            )
+
+    metricas_admision["admitidos"] += 1
+    return backlog
 
 # ==================== ENDPOINTS ====================
 
@@ -295,66 +542,130 @@ async def verificar_salud():
         # Verificar MongoDB
         await bd.command("ping")
         
-        # Verificar MinIO
-        cliente_minio.bucket_exists(BUCKET_MINIO)
+        # Verificar almacenamiento de objetos
+        await almacenamiento.verificar()
+        
+        # Backlog de transcripción (la sobrecarga se informa, no vuelve al servicio no saludable)
+        backlog = await estado_backlog()
         
-        return respuesta_ok({"estado": "saludable", "mongodb": "ok", "minio": "ok", "modelo_whisper": "cargado"})
+        return respuesta_ok({"estado": "saludable", "mongodb": "ok", "almacenamiento": almacenamiento.backend, "modelo_whisper": "cargado", "motor_whisper": motor_whisper.nombre, "cola": backlog})
     except Exception as e:
         raise HTTPException(status_code=503, detail=f"No saludable: {str(e)}")
 
-@app.post("/api/v1/audio/subir", tags=["Audio"])
+@app.get("/metricas", tags=["General"])
+async def obtener_metricas():
+    """Métricas operativas del servicio (cola, transcripción, pipeline, lotes, modelos y eventos)"""
+    return respuesta_ok({
+        "cola": await obtener_metricas_cola(),
+        "transcripcion": obtener_metricas_transcripcion(),
+        "lotes": obtener_metricas_lotes(),
+        "pipeline": pipeline_transcripcion.estado() if PIPELINE_TRANSCRIPCION else {"habilitado": False},
+        "admision": metricas_admision,
+        "modelos": {
+            **registro_modelos.estado(),
+            "motor": motor_whisper.nombre,
+            "rutas_elegidas": rutas_elegidas,
+            "dos_pasadas": {
+                "habilitado": TRANSCRIPCION_DOS_PASADAS,
+                "borrador": WHISPER_MODELO_BORRADOR,
+                "refinado": WHISPER_MODELO_REFINADO,
+            },
+        },
+        "eventos": {"suscriptores": bus_estados.suscriptores(), "publicados": bus_estados.publicados},
+    })
+
+# El cuerpo se lee manualmente (streaming); se documenta el formulario para /docs
+_ESQUEMA_SUBIDA_AUDIO = {
+    "requestBody": {
+        "required": True,
+        "content": {
+            "multipart/form-data": {
+                "schema": {
+                    "type": "object",
+                    "required": ["archivo"],
+                    "properties": {
+                        "archivo": {
+                            "type": "string",
+                            "format": "binary",
+                            "description": "Archivo de audio (WAV recomendado)",
+                        }
+                    },
+                }
+            }
+        },
+    }
+}
+
+@app.post("/api/v1/audio/subir", tags=["Audio"], openapi_extra=_ESQUEMA_SUBIDA_AUDIO)
 async def subir_audio(
-    tareas_fondo: BackgroundTasks,
-    archivo: UploadFile = File(..., description="Archivo de audio (WAV recomendado)"),
+    request: Request,
+    calidad: Optional[str] = None,
     datos_usuario: dict = Depends(verificar_token)
 ):
-    """Subir archivo de audio y activar transcripción automática"""
-    
-    # Validar tipo de archivo
-    if not archivo.content_type or not archivo.content_type.startswith("audio/"):
-        raise HTTPException(
-            status_code=400,
-            detail="El archivo debe ser de tipo audio"
-        )
+    """
+    Subir archivo de audio (en streaming hacia MinIO) y activar transcripción automática.
+    calidad (rapida | normal | alta) influye en el modelo Whisper que se usa.
+    """
+    if calidad is not None and calidad not in CALIDADES:
+        raise HTTPException(status_code=400, detail=f"Calidad inválida. Opciones: {', '.join(CALIDADES)}")
     
-    # Leer contenido del archivo
-    contenido = await archivo.read()
-    
-    if len(contenido) == 0:
-        raise HTTPException(status_code=400, detail="Archivo vacío")
+    # Rechazar antes de recibir el cuerpo si la cola o el usuario están saturados
+    backlog = await verificar_admision(int(datos_usuario.get("sub")))
     
     # Generar ID único
     id_audio = str(uuid.uuid4())
     
-    # Subir a MinIO
-    nombre_objeto = await guardar_en_minio(contenido, archivo.filename, archivo.content_type or "application/octet-stream")
+    # Recibir y subir a MinIO validando tipo, firma y tamaño sobre la marcha
+    recibido = await recibir_audio_en_streaming(request)
+    
+    # Contenido repetido (reintentos de subida): reutilizar objeto y transcripción
+    await reutilizar_objeto_existente(recibido)
+    pasada = pasada_inicial()
+    cache = await buscar_transcripcion_cache(recibido["hash_contenido"], calidad, pasada_cache(pasada))
     
     # Crear documento en MongoDB
     doc_audio = {
         "_id": id_audio,
         "id_usuario": int(datos_usuario.get("sub")),
         "usuario": datos_usuario.get("usuario"),
-        "nombre_archivo_original": archivo.filename,
-        "nombre_objeto_s3": nombre_objeto,
+        "nombre_archivo_original": recibido["nombre_archivo"],
+        "nombre_objeto_s3": recibido["nombre_objeto"],
         "bucket_s3": BUCKET_MINIO,
-        "tamano_bytes": len(contenido),
-        "tipo_contenido": archivo.content_type,
+        "tamano_bytes": recibido["tamano_bytes"],
+        "tipo_contenido": recibido["tipo_contenido"],
+        "hash_contenido": recibido["hash_contenido"],
+        "calidad": calidad,
         "estado": "pendiente",
         "transcripcion": None,
         "fecha_creacion": datetime.now(timezone.utc),
         "fecha_procesamiento": None,
         "error": None
     }
+    doc_audio.update(recibido.get("ingesta", {}))
+    
+    if cache:
+        doc_audio.update({**campos_desde_cache(cache), **campos_version(doc_audio, "unica")})
+        await coleccion_audios.insert_one(doc_audio)
+        return RespuestaSubidaAudio(
+            id_audio=id_audio,
+            estado="completado",
+            mensaje="Audio ya transcrito anteriormente. Se reutilizó la transcripción."
+        )
     
     await coleccion_audios.insert_one(doc_audio)
     
-    # Activar transcripción en segundo plano
-    tareas_fondo.add_task(transcribir_audio, id_audio)
+    # Encolar transcripción (la procesan los workers de la cola)
+    try:
+        await encolar_transcripcion(id_audio, PRIORIDAD_NORMAL, pasada)
+    except Exception as e:
+        # El documento queda "pendiente" y se reencola al rehidratar la cola
+        raise HTTPException(status_code=503, detail=f"Cola de transcripción no disponible: {str(e)}")
     
     return RespuestaSubidaAudio(
         id_audio=id_audio,
         estado="pendiente",
-        mensaje="Audio subido exitosamente. Transcripción en progreso."
+        mensaje="Audio subido exitosamente. Transcripción en cola.",
+        finalizacion_estimada=backlog["finalizacion_estimada"],
     )
 
 @app.get("/api/v1/audio/{id_audio}/estado", tags=["Audio"])
@@ -373,19 +684,90 @@ async def obtener_estado_audio(
     if doc_audio["id_usuario"] != int(datos_usuario.get("sub")):
         raise HTTPException(status_code=403, detail="No autorizado para ver este audio")
     
-    transcripcion_raw = doc_audio.get("transcripcion_raw")
-    tokens_muestra = None
-    if isinstance(transcripcion_raw, str) and transcripcion_raw.strip():
-        tokens_muestra = transcripcion_raw.strip().split()[:20]
+    return respuesta_ok(datos_estado_audio(doc_audio))
 
-    return respuesta_ok({"id_audio": doc_audio["_id"], "estado": doc_audio["estado"], "transcripcion": doc_audio.get("transcripcion"), "duracion_segundos": doc_audio.get("duracion_segundos"), "fecha_creacion": doc_audio["fecha_creacion"].isoformat() if doc_audio.get("fecha_creacion") else None, "fecha_procesamiento": doc_audio.get("fecha_procesamiento").isoformat() if doc_audio.get("fecha_procesamiento") else None, "error": doc_audio.get("error"), "transcripcion_raw": transcripcion_raw, "tokens_muestra": tokens_muestra})
+@app.post("/api/v1/audio/{id_audio}/token-eventos", tags=["Audio"])
+async def token_eventos_audio(
+    id_audio: str,
+    datos_usuario: dict = Depends(verificar_token)
+):
+    """Emitir un token de corta duración para abrir /eventos con EventSource"""
+    doc_audio = await coleccion_audios.find_one({"_id": id_audio}, {"id_usuario": 1})
+    if not doc_audio:
+        raise HTTPException(status_code=404, detail="Audio no encontrado")
+    if doc_audio["id_usuario"] != int(datos_usuario.get("sub")):
+        raise HTTPException(status_code=403, detail="No autorizado para ver este audio")
+    
+    return respuesta_ok({
+        "token": crear_token_corto(datos_usuario, "eventos", id_audio),
+        "expira_en_segundos": SSE_TOKEN_SEGUNDOS,
+    })
+
+@app.get("/api/v1/audio/{id_audio}/eventos", tags=["Audio"])
+async def eventos_estado_audio(
+    id_audio: str,
+    token: Optional[str] = None,
+    authorization: Optional[str] = Header(None)
+):
+    """
+    Estado de la transcripción por Server-Sent Events (reemplaza el polling a /estado).
+    Envía el estado actual y luego cada cambio, hasta completado o fallido; si hay un
+    refinado pendiente, sigue abierto hasta que la nueva versión reemplace al borrador.
+    EventSource no permite cabeceras: ?token= acepta solo el token de corta duración
+    de /token-eventos, nunca el token de acceso.
+    """
+    datos_usuario = verificar_token_corto(token, "eventos", id_audio) if token else verificar_token(authorization)
+    
+    # Suscribir antes de leer el documento para no perder un cambio intermedio
+    cola = bus_estados.suscribir(id_audio)
+    try:
+        doc_audio = await coleccion_audios.find_one({"_id": id_audio})
+        if not doc_audio:
+            raise HTTPException(status_code=404, detail="Audio no encontrado")
+        if doc_audio["id_usuario"] != int(datos_usuario.get("sub")):
+            raise HTTPException(status_code=403, detail="No autorizado para ver este audio")
+    except BaseException:
+        bus_estados.desuscribir(id_audio, cola)
+        raise
+    
+    datos = datos_estado_audio(doc_audio)
+    
+    async def emitir():
+        try:
+            yield f"retry: {SSE_REINTENTO_MS}\n\n"
+            yield _evento_sse(datos)
+            limite = time.monotonic() + SSE_MAX_SEGUNDOS
+            while not estado_definitivo(datos) and time.monotonic() < limite:
+                try:
+                    cambios = await asyncio.wait_for(cola.get(), SSE_LATIDO_SEGUNDOS)
+                except asyncio.TimeoutError:
+                    yield ": latido\n\n"  # Mantiene viva la conexión a través de proxies
+                    continue
+                datos.update(cambios)
+                datos["tokens_muestra"] = _tokens_muestra(datos.get("transcripcion_raw"))
+                yield _evento_sse(datos)
+        finally:
+            bus_estados.desuscribir(id_audio, cola)
+    
+    return StreamingResponse(
+        emitir(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
-@app.get("/api/v1/audio/{id_audio}/descargar", tags=["Audio"])
+@app.api_route("/api/v1/audio/{id_audio}/descargar", methods=["GET", "HEAD"], tags=["Audio"])
 async def descargar_audio(
     id_audio: str,
+    request: Request,
+    formato: str = "original",
     datos_usuario: dict = Depends(verificar_token)
 ):
-    """Descargar archivo de audio original"""
+    """
+    Descargar el audio en streaming (soporta Range, ETag y peticiones condicionales).
+    formato=original entrega el archivo subido; formato=opus la copia normalizada compacta.
+    """
+    if formato not in ("original", "opus"):
+        raise HTTPException(status_code=400, detail="Formato inválido. Opciones: original, opus")
     
     doc_audio = await coleccion_audios.find_one({"_id": id_audio})
     
@@ -396,15 +778,65 @@ async def descargar_audio(
     if doc_audio["id_usuario"] != int(datos_usuario.get("sub")):
         raise HTTPException(status_code=403, detail="No autorizado")
     
-    # Descargar desde MinIO
-    bytes_audio = await obtener_de_minio(doc_audio["nombre_objeto_s3"])
+    # Si el original se descartó tras la ingesta, se sirve la copia Opus
+    nombre_archivo = doc_audio["nombre_archivo_original"]
+    media_type = doc_audio.get("tipo_contenido", "audio/wav")
+    nombre_objeto = doc_audio["nombre_objeto_s3"]
+    if formato == "opus" or doc_audio.get("original_eliminado"):
+        if not doc_audio.get("nombre_objeto_opus"):
+            raise HTTPException(status_code=404, detail="El audio todavía no tiene copia Opus")
+        nombre_objeto = doc_audio["nombre_objeto_opus"]
+        nombre_archivo = f"{os.path.splitext(nombre_archivo)[0]}.opus"
+        media_type = "audio/ogg"
+    
+    # Metadata del objeto (tamaño, ETag) sin descargarlo
+    try:
+        info = await almacenamiento.info(nombre_objeto)
+    except ObjetoNoEncontrado as e:
+        raise HTTPException(status_code=404, detail=f"Audio no encontrado: {str(e)}")
+    
+    tamano = info["tamano"]
+    etag = f'"{info["etag"]}"'
+    cabeceras = {
+        "Accept-Ranges": "bytes",
+        "ETag": etag,
+        "Cache-Control": "private, max-age=0, must-revalidate",
+        "Content-Disposition": f'attachment; filename="{nombre_archivo}"',
+    }
+    if info["ultima_modificacion"]:
+        cabeceras["Last-Modified"] = format_datetime(info["ultima_modificacion"], usegmt=True)
+    
+    # Peticiones condicionales
+    if_none_match = request.headers.get("if-none-match")
+    if _coincide_etag(if_none_match, etag) or (
+        if_none_match is None and _no_modificado_desde(request.headers.get("if-modified-since"), info["ultima_modificacion"])
+    ):
+        return Response(status_code=304, headers=cabeceras)
+    
+    # Rango solicitado (If-Range: solo si el objeto no cambió)
+    rango = parsear_rango(request.headers.get("range"), tamano)
+    if_range = request.headers.get("if-range")
+    if rango and if_range and if_range.strip() != etag:
+        rango = None
+    
+    if rango:
+        inicio, fin = rango
+        codigo = 206
+        cabeceras["Content-Range"] = f"bytes {inicio}-{fin}/{tamano}"
+    else:
+        inicio, fin = 0, tamano - 1
+        codigo = 200
+    longitud = fin - inicio + 1
+    cabeceras["Content-Length"] = str(longitud)
+    
+    if request.method == "HEAD" or longitud <= 0:
+        return Response(status_code=codigo, headers=cabeceras, media_type=media_type)
     
     return StreamingResponse(
-        io.BytesIO(bytes_audio),
-        media_type=doc_audio.get("tipo_contenido", "audio/wav"),
-        headers={
-            "Content-Disposition": f'attachment; filename="{doc_audio["nombre_archivo_original"]}"'
-        }
+        almacenamiento.iterar(nombre_objeto, inicio, longitud),
+        status_code=codigo,
+        media_type=media_type,
+        headers=cabeceras,
     )
 
 @app.delete("/api/v1/audio/{id_audio}", tags=["Audio"])
@@ -423,11 +855,20 @@ async def eliminar_audio(
     if doc_audio["id_usuario"] != int(datos_usuario.get("sub")):
         raise HTTPException(status_code=403, detail="No autorizado")
     
-    # Eliminar de MinIO
-    try:
-        cliente_minio.remove_object(BUCKET_MINIO, doc_audio["nombre_objeto_s3"])
-    except S3Error:
-        pass  # Ya eliminado o no existe
+    # Eliminar del almacenamiento cada artefacto que ningún otro audio referencie
+    # (un duplicado puede compartir el original y tener PCM/Opus propios, o al revés)
+    for campo in ("nombre_objeto_s3", "nombre_objeto_pcm", "nombre_objeto_opus"):
+        if not doc_audio.get(campo):
+            continue
+        compartido = await coleccion_audios.count_documents(
+            {campo: doc_audio[campo], "_id": {"$ne": id_audio}}, limit=1
+        )
+        if compartido:
+            continue
+        try:
+            await almacenamiento.eliminar(doc_audio[campo])
+        except ObjetoNoEncontrado:
+            pass  # Ya eliminado
     
     # Eliminar de MongoDB
     await coleccion_audios.delete_one({"_id": id_audio})
@@ -437,30 +878,88 @@ async def eliminar_audio(
 @app.get("/api/v1/audio/usuario/listar", tags=["Audio"])
 async def listar_audios_usuario(
     limite: int = 50,
+    cursor: Optional[str] = None,
     datos_usuario: dict = Depends(verificar_token)
 ):
-    """Listar todos los audios del usuario actual"""
+    """
+    Listar los audios del usuario actual, del más reciente al más antiguo.
+    Paginación por cursor: pasar `siguiente_cursor` de la respuesta para obtener la página siguiente.
+    """
+    if not 1 <= limite <= LISTADO_MAX_LIMITE:
+        raise HTTPException(status_code=400, detail=f"limite debe estar entre 1 y {LISTADO_MAX_LIMITE}")
     
     id_usuario = int(datos_usuario.get("sub"))
+    filtro = {"id_usuario": id_usuario}
+    if cursor:
+        fecha, id_ultimo = decodificar_cursor_listado(cursor)
+        filtro["$or"] = [
+            {"fecha_creacion": {"$lt": fecha}},
+            {"fecha_creacion": fecha, "_id": {"$lt": id_ultimo}},
+        ]
     
-    cursor = coleccion_audios.find(
-        {"id_usuario": id_usuario}
-    ).sort("fecha_creacion", -1).limit(limite)
-    
-    audios = await cursor.to_list(length=limite)
-    
-    return respuesta_ok({"total": len(audios), "audios": [
+    # Se pide un elemento extra para saber si hay más páginas
+    consulta = coleccion_audios.find(filtro, PROYECCION_LISTADO).sort(
+        [("fecha_creacion", -1), ("_id", -1)]
+    ).limit(limite + 1)
+    audios = await consulta.to_list(length=limite + 1)
+    hay_mas = len(audios) > limite
+    audios = audios[:limite]
+    
+    return respuesta_ok({
+        "total": len(audios),
+        "audios": [
             {
                 "id_audio": a["_id"],
                 "nombre_archivo": a["nombre_archivo_original"],
                 "estado": a["estado"],
                 "fecha_creacion": a["fecha_creacion"],
-                "tiene_transcripcion": a.get("transcripcion") is not None
+                "tiene_transcripcion": bool(a.get("tiene_transcripcion")),
             }
             for a in audios
-        ]
+        ],
+        "siguiente_cursor": codificar_cursor_listado(audios[-1]) if hay_mas else None,
+    })
+
+@app.post("/api/v1/audio/en-vivo/token", tags=["Audio"])
+async def token_en_vivo(datos_usuario: dict = Depends(verificar_token)):
+    """Emitir un token de corta duración para abrir el WebSocket de /en-vivo"""
+    return respuesta_ok({
+        "token": crear_token_corto(datos_usuario, "en_vivo"),
+        "expira_en_segundos": SSE_TOKEN_SEGUNDOS,
     })
 
+@app.websocket("/api/v1/audio/en-vivo")
+async def transcripcion_en_vivo(
+    websocket: WebSocket,
+    token: Optional[str] = None,
+    formato: str = "contenedor",
+    tipo_contenido: str = "audio/webm",
+):
+    """
+    Transcripción en vivo por WebSocket.
+    - formato=contenedor: bloques de MediaRecorder (webm/ogg), decodificados con ffmpeg
+    - formato=pcm16: PCM s16le mono 16 kHz
+    Mensajes binarios = audio; texto {"evento": "fin"} cierra la grabación.
+    El servidor envía {"tipo": "parcial"} durante la grabación y {"tipo": "final"} al terminar.
+    ?token= acepta solo el token de corta duración de /en-vivo/token, nunca el token de acceso.
+    """
+    try:
+        if token:
+            datos_usuario = verificar_token_corto(token, "en_vivo")
+        else:
+            datos_usuario = verificar_token(websocket.headers.get("authorization"))
+    except HTTPException:
+        await websocket.close(code=1008)
+        return
+    if formato not in ("contenedor", "pcm16") or (formato == "contenedor" and not tipo_contenido.startswith("audio/")):
+        await websocket.close(code=1003)
+        return
+    if sesiones_en_vivo["activas"] >= MAX_SESIONES_EN_VIVO:
+        await websocket.close(code=1013)  # Try again later
+        return
+    
+    await atender_sesion_en_vivo(websocket, datos_usuario, formato, tipo_contenido)
+
 # ==================== EJECUCIÓN ====================
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,1226 @@
+# servicios/audio/pipeline.py
+"""
+Pipeline de transcripción del microservicio de Audio: deduplicación y caché,
+decodificación e ingesta, enrutamiento de modelos, segmentación, pre-pasada,
+lotes, las etapas de cada trabajo y los workers que consumen la cola.
+"""
+
+from typing import Optional, List, Dict, Tuple
+import os
+from datetime import datetime, timezone
+import asyncio
+import bisect
+import hashlib
+import json
+import re
+import struct
+import subprocess
+import threading
+import time
+from collections import deque
+import numpy as np
+from dotenv import load_dotenv
+from pathlib import Path
+from inferencia import (
+    DURACION_VENTANA_WHISPER_S,
+    FRECUENCIA_MUESTREO,
+    PROCESOS_TRANSCRIPCION,
+    WHISPER_BACKEND,
+    WHISPER_BEAM_SIZE,
+    WHISPER_BEST_OF,
+    WHISPER_CONDITION_PREV,
+    WHISPER_IDIOMA,
+    WHISPER_MODELO,
+    WHISPER_TEMPERATURA,
+    ProcesoInferenciaCaido,
+    _transcribir_lote,
+    _transcribir_segmento,
+    crear_pool_inferencia,
+    motor_whisper,
+    opciones_whisper,
+    registro_modelos,
+)
+from almacenamiento import ErrorAlmacenamiento, ObjetoNoEncontrado, almacenamiento
+from base_datos import coleccion_audios, coleccion_cache_transcripciones
+from cola import (
+    COLA_INTERVALO_SONDEO,
+    COLA_MAX_INTENTOS,
+    COLA_SEGUNDOS_LATIDO,
+    PRIORIDAD_NORMAL,
+    PRIORIDAD_REFINADO,
+    WORKERS_TRANSCRIPCION,
+    _mantener_lease,
+    _percentil,
+    cola_transcripcion,
+    encolar_transcripcion,
+    id_trabajo_transcripcion,
+    metricas_cola,
+)
+from estados import actualizar_estado_audio
+
+load_dotenv(dotenv_path=Path(__file__).resolve().parents[2] / ".env")
+
+# ==================== CONFIGURACIÓN ====================
+WHISPER_RUTAS_DURACION = os.getenv("WHISPER_RUTAS_DURACION", "")  # "60:small,600:base": hasta 60 s small, hasta 600 s base
+WHISPER_MODELO_CALIDAD = os.getenv("WHISPER_MODELO_CALIDAD", "")  # Para calidad=alta
+WHISPER_MODELO_RAPIDO = os.getenv("WHISPER_MODELO_RAPIDO", "")  # Para calidad=rapida o cola saturada
+# Dos pasadas: borrador inmediato con un modelo pequeño y refinado en segundo plano con uno mayor
+TRANSCRIPCION_DOS_PASADAS = os.getenv("TRANSCRIPCION_DOS_PASADAS", "false").lower() == "true"
+WHISPER_MODELO_BORRADOR = os.getenv("WHISPER_MODELO_BORRADOR", WHISPER_MODELO_RAPIDO or "tiny")
+WHISPER_MODELO_REFINADO = os.getenv("WHISPER_MODELO_REFINADO", WHISPER_MODELO_CALIDAD or "small")
+COLA_PROFUNDIDAD_DEGRADAR = int(os.getenv("COLA_PROFUNDIDAD_DEGRADAR", "0"))  # 0 = desactivado
+TAMANO_BLOQUE_DECODIFICACION = 256 * 1024
+
+# Transcripción segmentada (motores, modelos y procesos de inferencia: ver inferencia.py)
+SEGMENTACION_MIN_SEGUNDOS = float(os.getenv("SEGMENTACION_MIN_SEGUNDOS", "60"))
+SEGMENTO_MAX_SEGUNDOS = float(os.getenv("SEGMENTO_MAX_SEGUNDOS", "30"))
+
+# Pre-pasada: recorte de silencio y normalización de ganancia
+RECORTE_SILENCIO = os.getenv("RECORTE_SILENCIO", "true").lower() == "true"
+RECORTE_SILENCIO_MIN_S = float(os.getenv("RECORTE_SILENCIO_MIN_S", "1.0"))  # Silencios internos más largos se quitan
+RECORTE_MARGEN_S = float(os.getenv("RECORTE_MARGEN_S", "0.2"))  # Contexto conservado alrededor de la voz
+RECORTE_UMBRAL_DB = float(os.getenv("RECORTE_UMBRAL_DB", "-50"))
+NORMALIZAR_GANANCIA = os.getenv("NORMALIZAR_GANANCIA", "true").lower() == "true"
+GANANCIA_OBJETIVO_DBFS = float(os.getenv("GANANCIA_OBJETIVO_DBFS", "-20"))
+GANANCIA_MAX_DB = float(os.getenv("GANANCIA_MAX_DB", "30"))
+
+# Inferencia por lotes entre solicitudes (opcional: más throughput con muchos audios cortos)
+INFERENCIA_POR_LOTES = os.getenv("INFERENCIA_POR_LOTES", "false").lower() == "true"
+LOTE_MAX_TAMANO = int(os.getenv("LOTE_MAX_TAMANO", "8"))
+LOTE_MAX_ESPERA_MS = float(os.getenv("LOTE_MAX_ESPERA_MS", "50"))
+
+# Pipeline de transcripción: preparación (descarga/decodificación) solapada con la inferencia
+PIPELINE_TRANSCRIPCION = os.getenv("PIPELINE_TRANSCRIPCION", "true").lower() == "true"
+PIPELINE_PREPARADORES = int(os.getenv("PIPELINE_PREPARADORES", "2"))
+PIPELINE_CAPACIDAD = int(os.getenv("PIPELINE_CAPACIDAD", "2"))  # Trabajos decodificados esperando inferencia
+
+# Ingesta: copia Opus compacta para reproducir/archivar; el original puede descartarse
+INGESTA_BITRATE_OPUS = os.getenv("INGESTA_BITRATE_OPUS", "24k")
+INGESTA_CONSERVAR_ORIGINAL = os.getenv("INGESTA_CONSERVAR_ORIGINAL", "true").lower() == "true"
+
+# ==================== DEDUPLICACIÓN Y CACHÉ DE TRANSCRIPCIONES ====================
+# El hash SHA-256 se calcula mientras el audio llega. Un contenido repetido reutiliza
+# el objeto de MinIO existente y, si ya se transcribió con los mismos parámetros, el resultado.
+
+def parametros_transcripcion(modelo: str = WHISPER_MODELO) -> dict:
+    """Modelo y parámetros de decodificación que determinan el resultado de una transcripción"""
+    return {
+        "modelo": modelo,
+        "motor": WHISPER_BACKEND,
+        "idioma": WHISPER_IDIOMA,
+        "beam_size": WHISPER_BEAM_SIZE,
+        "best_of": WHISPER_BEST_OF,
+        "temperatura": WHISPER_TEMPERATURA,
+        "condition_prev": WHISPER_CONDITION_PREV,
+        "recorte_silencio": RECORTE_SILENCIO,
+        "normalizar_ganancia": NORMALIZAR_GANANCIA,
+    }
+
+def clave_cache_transcripcion(hash_contenido: str, parametros: dict) -> str:
+    """Clave de caché: hash del contenido + parámetros de transcripción"""
+    return hashlib.sha256(f"{hash_contenido}:{json.dumps(parametros, sort_keys=True)}".encode("utf-8")).hexdigest()
+
+async def obtener_transcripcion_cache(clave: str) -> Optional[dict]:
+    """Buscar una transcripción completada con la misma clave"""
+    return await coleccion_cache_transcripciones.find_one({"_id": clave})
+
+async def buscar_transcripcion_cache(
+    hash_contenido: str, calidad: Optional[str] = None, pasada: str = "unica", pendientes: Optional[int] = None
+) -> Optional[dict]:
+    """
+    Buscar el resultado en caché antes de decodificar. La duración (necesaria para
+    elegir el modelo) se toma de una transcripción previa del mismo contenido.
+    El worker pasa la profundidad de cola con la que enrutará; sin ella (al subir)
+    se prueba cada modelo elegible: el de la ruta normal y el de la cola degradada.
+    """
+    previo = await coleccion_cache_transcripciones.find_one({"hash_contenido": hash_contenido})
+    if not previo:
+        return None
+    if pendientes is not None:
+        profundidades = [pendientes]
+    else:
+        profundidades = [0, COLA_PROFUNDIDAD_DEGRADAR] if COLA_PROFUNDIDAD_DEGRADAR else [0]
+    modelos = []
+    for profundidad in profundidades:
+        modelo, _ = enrutar_pasada(pasada, previo["duracion_segundos"], calidad, profundidad)
+        if modelo not in modelos:
+            modelos.append(modelo)
+    for modelo in modelos:
+        cache = await obtener_transcripcion_cache(clave_cache_transcripcion(hash_contenido, parametros_transcripcion(modelo)))
+        if cache:
+            return cache
+    return None
+
+async def guardar_transcripcion_cache(clave: str, hash_contenido: str, id_audio: str, parametros: dict, resultado: dict):
+    """Guardar el resultado de una transcripción para reutilizarlo con el mismo contenido"""
+    await coleccion_cache_transcripciones.update_one(
+        {"_id": clave},
+        {
+            "$setOnInsert": {
+                "hash_contenido": hash_contenido,
+                "parametros": parametros,
+                "id_audio_origen": id_audio,
+                "transcripcion": resultado["transcripcion"],
+                "transcripcion_raw": resultado["transcripcion_raw"],
+                "segmentos": resultado["segmentos"],
+                "duracion_segundos": resultado["duracion_segundos"],
+                "fecha_creacion": datetime.now(timezone.utc),
+            }
+        },
+        upsert=True
+    )
+
+def campos_desde_cache(cache: dict) -> dict:
+    """Campos del documento de audio que apuntan a un resultado en caché"""
+    return {
+        "estado": "completado",
+        "transcripcion": cache["transcripcion"],
+        "transcripcion_raw": cache["transcripcion_raw"],
+        "segmentos": cache["segmentos"],
+        "duracion_segundos": cache["duracion_segundos"],
+        "clave_cache_transcripcion": cache["_id"],
+        "modelo_whisper": cache["parametros"].get("modelo"),
+        "parametros_transcripcion": cache["parametros"],
+        "id_audio_origen": cache["id_audio_origen"],
+        "desde_cache": True,
+        "fecha_procesamiento": datetime.now(timezone.utc),
+    }
+
+CAMPOS_INGESTA = (
+    "nombre_objeto_pcm", "nombre_objeto_opus", "tamano_bytes_pcm", "tamano_bytes_opus",
+    "duracion_segundos", "fecha_ingesta", "original_eliminado",
+)
+
+async def reutilizar_objeto_existente(recibido: dict) -> bool:
+    """
+    Si el mismo contenido ya está guardado, borrar el objeto recién subido y apuntar al existente.
+    Sin INGESTA_CONSERVAR_ORIGINAL la ingesta borra el original, así que solo se reutilizan
+    audios ya ingeridos (se comparten sus artefactos PCM/Opus, que la ingesta no borra):
+    apuntar a un original aún sin ingerir lo dejaría sin objeto cuando su ingesta termine.
+    """
+    filtro = {"hash_contenido": recibido["hash_contenido"], "nombre_objeto_s3": {"$ne": recibido["nombre_objeto"]}}
+    if not INGESTA_CONSERVAR_ORIGINAL:
+        filtro["nombre_objeto_pcm"] = {"$exists": True}
+    existente = await coleccion_audios.find_one(
+        filtro,
+        {"nombre_objeto_s3": 1, **{campo: 1 for campo in CAMPOS_INGESTA}},
+    )
+    if not existente:
+        return False
+    try:
+        await almacenamiento.eliminar(recibido["nombre_objeto"])
+    except ErrorAlmacenamiento as e:
+        print(f"⚠️ No se pudo eliminar el objeto duplicado {recibido['nombre_objeto']}: {e}")
+    recibido["nombre_objeto"] = existente["nombre_objeto_s3"]
+    # Los artefactos normalizados también se comparten: no hay que volver a ingerir
+    recibido["ingesta"] = {campo: existente[campo] for campo in CAMPOS_INGESTA if campo in existente}
+    return True
+
+# ==================== LIMPIEZA DE TEXTO ====================
+
+def limpiar_transcripcion(texto: str) -> str:
+    """Limpiar transcripción de muletillas y normalizar"""
+    if not isinstance(texto, str):
+        return ""
+    
+    # Muletillas a eliminar
+    muletillas = [
+        r"\beh\b", r"\beste\b", r"\bpues\b", r"\bo sea\b", 
+        r"\bmmm\b", r"\bajá\b", r"\bem\b", r"\bah\b", 
+        r"\bdigamos\b", r"\bentonces\b"
+    ]
+    
+    for muletilla in muletillas:
+        texto = re.sub(muletilla, " ", texto, flags=re.IGNORECASE)
+    
+    # Normalizar espacios
+    texto = re.sub(r"\s+", " ", texto)
+    texto = re.sub(r"\s+([.,!?;:])", r"\1", texto)
+    texto = texto.strip()
+    
+    # Capitalizar primera letra
+    if texto:
+        texto = texto[0].upper() + texto[1:]
+    
+    return texto
+
+# ==================== DECODIFICACIÓN DE AUDIO ====================
+# ffmpeg recibe el objeto de MinIO por stdin y entrega PCM mono 16 kHz por stdout,
+# que se convierte en el arreglo float32 que Whisper acepta directamente.
+
+def _comando_ffmpeg(entrada: str) -> List[str]:
+    return [
+        "ffmpeg", "-nostdin", "-loglevel", "error", "-threads", "0",
+        "-i", entrada,
+        "-f", "s16le", "-ac", "1", "-acodec", "pcm_s16le", "-ar", str(FRECUENCIA_MUESTREO),
+        "pipe:1",
+    ]
+
+def pcm16_a_float32(pcm: bytes) -> np.ndarray:
+    """Convertir PCM s16le a float32 en [-1, 1] (mismo formato que whisper.load_audio)"""
+    return np.frombuffer(pcm, np.int16).astype(np.float32) / 32768.0
+
+def _decodificar_por_pipe(nombre_objeto: str) -> bytes:
+    proceso = subprocess.Popen(
+        _comando_ffmpeg("pipe:0"), stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+    errores: List[BaseException] = []
+
+    def alimentar():
+        bloques = almacenamiento.iterar_bloques(nombre_objeto, TAMANO_BLOQUE_DECODIFICACION)
+        try:
+            for bloque in bloques:
+                proceso.stdin.write(bloque)
+        except BrokenPipeError:
+            pass  # ffmpeg terminó antes (error de formato); se reporta por stderr
+        except BaseException as e:
+            errores.append(e)
+        finally:
+            try:
+                proceso.stdin.close()
+            except BrokenPipeError:
+                pass
+            bloques.close()
+
+    alimentador = threading.Thread(target=alimentar, daemon=True)
+    alimentador.start()
+    pcm = proceso.stdout.read()
+    stderr = proceso.stderr.read()  # -loglevel error: salida mínima, no bloquea
+    proceso.wait()
+    alimentador.join()
+    if errores:
+        raise errores[0]
+    if proceso.returncode != 0:
+        raise RuntimeError(f"ffmpeg no pudo decodificar el audio: {stderr.decode(errors='replace').strip()}")
+    return pcm
+
+def _decodificar_por_url(nombre_objeto: str) -> bytes:
+    """Contenedores que requieren seek (p. ej. mp4 con 'moov' al final): ffmpeg lee por HTTP con rangos"""
+    proceso = subprocess.run(_comando_ffmpeg(almacenamiento.url_lectura(nombre_objeto)), capture_output=True)
+    if proceso.returncode != 0:
+        raise RuntimeError(f"ffmpeg no pudo decodificar el audio: {proceso.stderr.decode(errors='replace').strip()}")
+    return proceso.stdout
+
+def decodificar_pcm16_objeto(nombre_objeto: str) -> bytes:
+    """Decodificar un objeto almacenado a PCM s16le mono 16 kHz sin tocar disco (bloqueante)"""
+    try:
+        return _decodificar_por_pipe(nombre_objeto)
+    except RuntimeError as e:
+        print(f"⚠️ Decodificación por pipe falló ({e}); reintentando con lectura por rangos")
+        return _decodificar_por_url(nombre_objeto)
+
+def decodificar_audio_objeto(nombre_objeto: str) -> np.ndarray:
+    """Decodificar un objeto almacenado a float32 mono 16 kHz (bloqueante)"""
+    return pcm16_a_float32(decodificar_pcm16_objeto(nombre_objeto))
+
+# ==================== INGESTA Y NORMALIZACIÓN ====================
+# Primer paso de cada trabajo: el original se decodifica una sola vez a 16 kHz mono.
+# Se guardan un WAV PCM16 listo para inferencia y una copia Opus compacta para
+# reproducir/archivar; las retranscripciones leen el PCM sin volver a decodificar.
+
+TAMANO_CABECERA_WAV = 44
+
+def cabecera_wav(bytes_datos: Optional[int] = None, frecuencia: int = FRECUENCIA_MUESTREO) -> bytes:
+    """Cabecera WAV PCM16 mono; sin tamaño usa 0xFFFFFFFF (convención para WAV en streaming)"""
+    datos = 0xFFFFFFFF if bytes_datos is None else bytes_datos
+    riff = 0xFFFFFFFF if bytes_datos is None else bytes_datos + TAMANO_CABECERA_WAV - 8
+    return (
+        b"RIFF" + struct.pack("<I", riff) + b"WAVE"
+        + b"fmt " + struct.pack("<IHHIIHH", 16, 1, 1, frecuencia, frecuencia * 2, 2, 16)
+        + b"data" + struct.pack("<I", datos)
+    )
+
+def codificar_opus(pcm: bytes) -> bytes:
+    """PCM16 mono 16 kHz -> Ogg/Opus para voz (bloqueante)"""
+    proceso = subprocess.run(
+        [
+            "ffmpeg", "-nostdin", "-loglevel", "error",
+            "-f", "s16le", "-ar", str(FRECUENCIA_MUESTREO), "-ac", "1", "-i", "pipe:0",
+            "-c:a", "libopus", "-b:a", INGESTA_BITRATE_OPUS, "-application", "voip",
+            "-f", "ogg", "pipe:1",
+        ],
+        input=pcm,
+        capture_output=True,
+    )
+    if proceso.returncode != 0:
+        raise RuntimeError(f"ffmpeg no pudo codificar Opus: {proceso.stderr.decode(errors='replace').strip()}")
+    return proceso.stdout
+
+async def ingerir_audio(doc_audio: dict) -> np.ndarray:
+    """Normalizar el original (16 kHz mono), guardar los artefactos PCM y Opus y completar la duración"""
+    nombre_original = doc_audio["nombre_objeto_s3"]
+    pcm = await asyncio.to_thread(decodificar_pcm16_objeto, nombre_original)
+    opus = await asyncio.to_thread(codificar_opus, pcm)
+
+    nombre_pcm = f"{nombre_original}.16k.wav"
+    nombre_opus = f"{nombre_original}.opus"
+    await asyncio.gather(
+        almacenamiento.guardar_como(nombre_pcm, cabecera_wav(len(pcm)) + pcm, "audio/wav"),
+        almacenamiento.guardar_como(nombre_opus, opus, "audio/ogg"),
+    )
+
+    campos = {
+        "nombre_objeto_pcm": nombre_pcm,
+        "nombre_objeto_opus": nombre_opus,
+        "tamano_bytes_pcm": TAMANO_CABECERA_WAV + len(pcm),
+        "tamano_bytes_opus": len(opus),
+        "duracion_segundos": round(len(pcm) / 2 / FRECUENCIA_MUESTREO, 2),
+        "fecha_ingesta": datetime.now(timezone.utc),
+    }
+    if not INGESTA_CONSERVAR_ORIGINAL:
+        await almacenamiento.eliminar(nombre_original)
+        campos["original_eliminado"] = True
+    await actualizar_estado_audio(doc_audio["_id"], campos)
+    doc_audio.update(campos)
+    print(
+        f"📦 Audio {doc_audio['_id']} normalizado: {campos['duracion_segundos']} s, "
+        f"original {doc_audio.get('tamano_bytes')} B -> Opus {len(opus)} B"
+    )
+    return pcm16_a_float32(pcm)
+
+async def obtener_audio_para_inferencia(doc_audio: dict) -> np.ndarray:
+    """PCM float32 16 kHz: desde el artefacto normalizado o, la primera vez, ingiriendo el original"""
+    if doc_audio.get("nombre_objeto_pcm"):
+        try:
+            wav = await almacenamiento.obtener(doc_audio["nombre_objeto_pcm"])
+            return pcm16_a_float32(wav[TAMANO_CABECERA_WAV:])
+        except ObjetoNoEncontrado:
+            print(f"⚠️ Falta el PCM normalizado de {doc_audio['_id']}; se vuelve a ingerir")
+    return await ingerir_audio(doc_audio)
+
+
+# ==================== ENRUTAMIENTO DE MODELOS ====================
+# Qué modelo usa cada trabajo (calidad, presión de la cola, duración y pasada);
+# el registro de modelos cargados está en inferencia.py.
+
+def _parsear_rutas_duracion(valor: str) -> List[Tuple[float, str]]:
+    """'60:small,600:base' -> [(60.0, 'small'), (600.0, 'base')]"""
+    rutas = []
+    for parte in valor.split(","):
+        if ":" in parte:
+            limite, modelo = parte.split(":", 1)
+            rutas.append((float(limite), modelo.strip()))
+    return sorted(rutas)
+
+RUTAS_DURACION = _parsear_rutas_duracion(WHISPER_RUTAS_DURACION)
+CALIDADES = ("rapida", "normal", "alta")
+rutas_elegidas: Dict[str, int] = {}
+
+def enrutar_modelo(duracion_s: Optional[float], calidad: Optional[str] = None, pendientes: int = 0) -> Tuple[str, str]:
+    """Elegir modelo por calidad pedida, presión de la cola y duración. Retorna (modelo, motivo)"""
+    if calidad == "alta" and WHISPER_MODELO_CALIDAD:
+        return WHISPER_MODELO_CALIDAD, "calidad"
+    if calidad == "rapida" and WHISPER_MODELO_RAPIDO:
+        return WHISPER_MODELO_RAPIDO, "calidad"
+    if COLA_PROFUNDIDAD_DEGRADAR and pendientes >= COLA_PROFUNDIDAD_DEGRADAR and WHISPER_MODELO_RAPIDO:
+        return WHISPER_MODELO_RAPIDO, "cola"
+    if duracion_s is not None:
+        for limite, modelo in RUTAS_DURACION:
+            if duracion_s <= limite:
+                return modelo, "duracion"
+    return WHISPER_MODELO, "defecto"
+
+# Pasadas de transcripción: "unica" (modelo enrutado), "borrador" (modelo pequeño, se
+# publica enseguida) y "refinado" (modelo mayor, reemplaza al borrador en segundo plano)
+PASADAS = ("unica", "borrador", "refinado")
+
+def pasada_inicial() -> str:
+    return "borrador" if TRANSCRIPCION_DOS_PASADAS else "unica"
+
+def pasada_cache(pasada: str) -> str:
+    """Con dos pasadas solo el resultado refinado evita transcribir de nuevo"""
+    return "unica" if pasada == "unica" else "refinado"
+
+def enrutar_pasada(pasada: str, duracion_s: Optional[float], calidad: Optional[str] = None, pendientes: int = 0) -> Tuple[str, str]:
+    """Modelo de una pasada; la pasada única se enruta por calidad, cola y duración"""
+    if pasada == "borrador":
+        return WHISPER_MODELO_BORRADOR, "borrador"
+    if pasada == "refinado":
+        return WHISPER_MODELO_REFINADO, "refinado"
+    return enrutar_modelo(duracion_s, calidad, pendientes)
+
+def campos_version(doc_audio: dict, pasada: str) -> dict:
+    """Marca de versión de la transcripción que publica esta pasada"""
+    campos = {"version_transcripcion": (doc_audio.get("version_transcripcion") or 0) + 1}
+    if pasada == "borrador":
+        campos["refinamiento"] = "pendiente"
+    elif pasada == "refinado":
+        campos.update({
+            "refinamiento": "completado",
+            "transcripcion_borrador": doc_audio.get("transcripcion"),
+            "fecha_refinamiento": datetime.now(timezone.utc),
+        })
+    return campos
+
+# El modelo por defecto se carga al inicio: en la API solo si la inferencia corre en hilos;
+# con procesos de inferencia, cada proceso lo carga al arrancar
+if PROCESOS_TRANSCRIPCION <= 0:
+    registro_modelos.obtener(WHISPER_MODELO)
+
+# ==================== PROCESOS DE INFERENCIA ====================
+# El pool y el punto de entrada de los procesos viven en inferencia.py, que no tiene
+# efectos al importar: los procesos hijos no cargan la app, los clientes ni el almacenamiento.
+
+pool_inferencia = crear_pool_inferencia()
+
+async def ejecutar_inferencia(funcion, *args):
+    """Ejecutar una función de inferencia en el pool de procesos (o en un hilo si está desactivado)"""
+    if pool_inferencia is None:
+        return await asyncio.to_thread(funcion, *args)
+    return await pool_inferencia.ejecutar(funcion, *args)
+
+# ==================== SEGMENTACIÓN Y TRANSCRIPCIÓN PARALELA ====================
+# Las grabaciones largas se cortan en silencios y los segmentos se transcriben en
+# paralelo en los procesos de inferencia (cada proceso tiene su propia copia del modelo).
+
+DURACION_TRAMA_S = 0.03
+
+def _voz_por_tramas(audio: np.ndarray, umbral_db: float) -> Tuple[np.ndarray, np.ndarray, int]:
+    """Energía por trama (dB) y máscara de voz con umbral adaptativo al piso de ruido"""
+    tam_trama = int(DURACION_TRAMA_S * FRECUENCIA_MUESTREO)
+    n_tramas = len(audio) // tam_trama
+    if n_tramas == 0:
+        return np.zeros(0), np.zeros(0, dtype=bool), tam_trama
+    tramas = audio[: n_tramas * tam_trama].reshape(n_tramas, tam_trama)
+    energia_db = 10 * np.log10(np.mean(tramas.astype(np.float64) ** 2, axis=1) + 1e-10)
+    # Umbral: 10 dB sobre el piso de ruido, sin acercarse a menos de 20 dB de la voz
+    piso, pico = np.percentile(energia_db, [10, 95])
+    umbral = max(umbral_db, min(float(piso) + 10, float(pico) - 20))
+    return energia_db, energia_db > umbral, tam_trama
+
+def segmentar_por_silencio(
+    audio: np.ndarray,
+    max_segundos: float = 30.0,
+    min_silencio_s: float = 0.3,
+    umbral_db: float = -45.0,
+) -> List[Tuple[int, int]]:
+    """
+    Dividir el audio en segmentos de hasta max_segundos cortando en silencios
+    (detección por energía con umbral adaptativo al piso de ruido).
+    Retorna rangos (inicio, fin) en muestras; omite segmentos sin voz.
+    """
+    energia_db, es_voz, tam_trama = _voz_por_tramas(audio, umbral_db)
+    n_tramas = len(es_voz)
+    if n_tramas == 0:
+        return [(0, len(audio))] if len(audio) else []
+
+    # Candidatos de corte: centro de cada racha de silencio suficientemente larga
+    min_tramas_silencio = max(1, int(min_silencio_s / DURACION_TRAMA_S))
+    cortes = []
+    inicio_silencio = None
+    for i, voz in enumerate(np.append(es_voz, True)):
+        if not voz and inicio_silencio is None:
+            inicio_silencio = i
+        elif voz and inicio_silencio is not None:
+            if i - inicio_silencio >= min_tramas_silencio:
+                cortes.append((inicio_silencio + i) // 2)
+            inicio_silencio = None
+
+    # Agrupar de forma voraz: cortar en el último silencio antes de max_segundos
+    max_tramas = max(1, int(max_segundos / DURACION_TRAMA_S))
+    limites = [0]
+    ultimo_candidato = None
+    for corte in cortes + [n_tramas]:
+        while corte - limites[-1] > max_tramas:
+            if ultimo_candidato is not None and ultimo_candidato > limites[-1]:
+                limites.append(ultimo_candidato)
+            else:
+                limites.append(limites[-1] + max_tramas)  # Voz continua: corte forzado
+            ultimo_candidato = None
+        ultimo_candidato = corte
+    limites.append(n_tramas)
+
+    segmentos = []
+    for inicio, fin in zip(limites, limites[1:]):
+        if fin > inicio and es_voz[inicio:fin].any():
+            fin_muestra = len(audio) if fin == n_tramas else fin * tam_trama
+            segmentos.append((inicio * tam_trama, fin_muestra))
+    return segmentos
+
+metricas_transcripcion = {
+    "rtf": {"unico": deque(maxlen=200), "segmentado": deque(maxlen=200), "lotes": deque(maxlen=200)},
+}
+duraciones_trabajo_ms = deque(maxlen=100)  # Inferencias recientes (el control de admisión estima la espera con ellas)
+
+async def _transcribir_segmentado(audio: np.ndarray, rangos: List[Tuple[int, int]], opciones: dict, modelo: str) -> dict:
+    partes = await asyncio.gather(*[
+        ejecutar_inferencia(_transcribir_segmento, audio[inicio:fin], inicio / FRECUENCIA_MUESTREO, opciones, modelo)
+        for inicio, fin in rangos
+    ])
+    return {
+        "texto": " ".join(p["texto"] for p in partes if p["texto"]),
+        "segmentos": [s for p in partes for s in p["segmentos"]],
+    }
+
+async def ejecutar_transcripcion(audio: np.ndarray, modelo: str = WHISPER_MODELO) -> dict:
+    """
+    Transcribir un audio decodificado. Con inferencia por lotes (opcional), los
+    segmentos (≤ 30 s) se agrupan con los de otras solicitudes; si no, las grabaciones
+    largas se segmentan en silencios y se reparten en el pool de procesos. Los lotes
+    decodifican cada segmento por separado, así que con condition_on_previous_text
+    se usa el camino normal para no perder el contexto entre segmentos.
+    Retorna texto, segmentos con marcas de tiempo y métricas (incluye RTF).
+    """
+    opciones = opciones_whisper()
+    duracion_s = len(audio) / FRECUENCIA_MUESTREO
+    inicio = time.perf_counter()
+
+    resultado = None
+    modo = "unico"
+    if duracion_s == 0:
+        resultado = {"texto": "", "segmentos": []}  # Sin voz tras el recorte: nada que alucinar
+        modo = "sin_voz"
+    elif INFERENCIA_POR_LOTES and motor_whisper.soporta_lotes and not opciones["condition_on_previous_text"]:
+        resultado = await _transcribir_por_lotes(audio, opciones, modelo)
+        modo = "lotes"
+    elif PROCESOS_TRANSCRIPCION > 1 and duracion_s >= SEGMENTACION_MIN_SEGUNDOS:
+        rangos = segmentar_por_silencio(audio, max_segundos=SEGMENTO_MAX_SEGUNDOS)
+        if len(rangos) > 1:
+            try:
+                resultado = await _transcribir_segmentado(audio, rangos, opciones, modelo)
+                modo = "segmentado"
+            except ProcesoInferenciaCaido as e:
+                print(f"⚠️ {e} durante la transcripción segmentada; se usa una sola pasada")
+    if resultado is None:
+        resultado = await ejecutar_inferencia(_transcribir_segmento, audio, 0.0, opciones, modelo)
+
+    tiempo_s = time.perf_counter() - inicio
+    rtf = tiempo_s / duracion_s if duracion_s > 0 else None
+    if rtf is not None:
+        metricas_transcripcion["rtf"][modo].append(rtf)
+    resultado.update({
+        "modelo": modelo,
+        "motor": motor_whisper.nombre,
+        "modo": modo,
+        "duracion_audio_s": round(duracion_s, 2),
+        "tiempo_ms": int(tiempo_s * 1000),
+        "rtf": round(rtf, 3) if rtf is not None else None,
+    })
+    return resultado
+
+def obtener_metricas_transcripcion() -> dict:
+    """RTF observado por modo (único vs. segmentado) para comparar el speed-up"""
+    return {
+        "procesos": PROCESOS_TRANSCRIPCION,
+        "inferencia": pool_inferencia.estado() if pool_inferencia else None,
+        "rtf": {
+            modo: {
+                "muestras": len(valores),
+                "promedio": round(sum(valores) / len(valores), 3) if valores else None,
+                "p50": _percentil(valores, 50, decimales=3),
+            }
+            for modo, valores in metricas_transcripcion["rtf"].items()
+        },
+    }
+
+# ==================== RECORTE DE SILENCIO Y GANANCIA ====================
+# Pre-pasada antes de Whisper: se quitan los silencios de inicio, fin e intermedios
+# largos y se normaliza la ganancia. Whisper procesa solo la señal reducida y las
+# marcas de tiempo se reubican en la línea de tiempo original.
+
+def recortar_silencio(
+    audio: np.ndarray,
+    min_silencio_s: float = RECORTE_SILENCIO_MIN_S,
+    margen_s: float = RECORTE_MARGEN_S,
+    umbral_db: float = RECORTE_UMBRAL_DB,
+) -> Tuple[np.ndarray, List[Tuple[int, int, int]]]:
+    """
+    Eliminar silencio al inicio, al final y los intermedios de más de min_silencio_s.
+    Se conservan margen_s alrededor de la voz para no cortar bordes de palabras.
+    Retorna la señal reducida y los tramos conservados como
+    (inicio_original, inicio_reducido, longitud) en muestras.
+    """
+    _, es_voz, tam_trama = _voz_por_tramas(audio, umbral_db)
+    if not es_voz.any():
+        return audio[:0], []
+
+    # Dilatar la voz con el margen y rellenar los huecos internos cortos
+    margen = int(np.ceil(margen_s / DURACION_TRAMA_S))
+    conservar = np.convolve(es_voz.astype(np.int32), np.ones(2 * margen + 1, dtype=np.int32), "same") > 0
+    min_tramas_silencio = max(1, int(min_silencio_s / DURACION_TRAMA_S))
+    cambios = np.flatnonzero(np.diff(np.concatenate(([1], conservar.astype(np.int8), [1]))))
+    for inicio, fin in zip(cambios[::2], cambios[1::2]):
+        if inicio > 0 and fin < len(conservar) and fin - inicio < min_tramas_silencio:
+            conservar[inicio:fin] = True
+
+    bordes = np.flatnonzero(np.diff(np.concatenate(([0], conservar.astype(np.int8), [0]))))
+    tramos = []
+    reducido = 0
+    for inicio, fin in zip(bordes[::2], bordes[1::2]):
+        inicio_muestra = int(inicio) * tam_trama
+        fin_muestra = len(audio) if fin == len(conservar) else int(fin) * tam_trama
+        tramos.append((inicio_muestra, reducido, fin_muestra - inicio_muestra))
+        reducido += fin_muestra - inicio_muestra
+    if len(tramos) == 1 and tramos[0][2] == len(audio):
+        return audio, tramos
+    return np.concatenate([audio[i:i + n] for i, _, n in tramos]), tramos
+
+def normalizar_ganancia(
+    audio: np.ndarray,
+    objetivo_dbfs: float = GANANCIA_OBJETIVO_DBFS,
+    max_db: float = GANANCIA_MAX_DB,
+) -> Tuple[np.ndarray, float]:
+    """Llevar el RMS a objetivo_dbfs (ganancia acotada a ±max_db y sin recortar picos)"""
+    if not len(audio):
+        return audio, 0.0
+    rms_db = 10 * np.log10(float(np.mean(audio.astype(np.float64) ** 2)) + 1e-10)
+    ganancia_db = float(np.clip(objetivo_dbfs - rms_db, -max_db, max_db))
+    pico = float(np.max(np.abs(audio)))
+    if pico > 0:
+        ganancia_db = min(ganancia_db, 20 * np.log10(0.99 / pico))
+    if abs(ganancia_db) < 0.1:
+        return audio, 0.0
+    return (audio * np.float32(10 ** (ganancia_db / 20))).astype(np.float32), round(ganancia_db, 1)
+
+def preprocesar_audio(audio: np.ndarray) -> Tuple[np.ndarray, dict]:
+    """Recorte de silencio + normalización de ganancia según configuración (bloqueante)"""
+    duracion_original = len(audio) / FRECUENCIA_MUESTREO
+    tramos = [(0, 0, len(audio))]
+    if RECORTE_SILENCIO:
+        audio, tramos = recortar_silencio(audio)
+    ganancia_db = 0.0
+    if NORMALIZAR_GANANCIA:
+        audio, ganancia_db = normalizar_ganancia(audio)
+    duracion_efectiva = len(audio) / FRECUENCIA_MUESTREO
+    return audio, {
+        "duracion_original_s": round(duracion_original, 2),
+        "duracion_efectiva_s": round(duracion_efectiva, 2),
+        "segundos_recortados": round(duracion_original - duracion_efectiva, 2),
+        "ganancia_db": ganancia_db,
+        "tramos": tramos,
+    }
+
+def reubicar_segmentos(segmentos: List[dict], tramos: List[Tuple[int, int, int]]) -> List[dict]:
+    """Pasar marcas de tiempo de la señal reducida a la línea de tiempo original"""
+    if len(tramos) == 1 and tramos[0][0] == 0:
+        return segmentos
+    inicios_reducidos = [r for _, r, _ in tramos]
+
+    def reubicar(t: float) -> float:
+        muestra = t * FRECUENCIA_MUESTREO
+        original, reducido, longitud = tramos[max(0, bisect.bisect_right(inicios_reducidos, muestra) - 1)]
+        return round((original + min(max(muestra - reducido, 0), longitud)) / FRECUENCIA_MUESTREO, 2)
+
+    return [dict(s, inicio=reubicar(s["inicio"]), fin=reubicar(s["fin"])) for s in segmentos]
+
+# ==================== INFERENCIA POR LOTES ====================
+# Segmentos de hasta 30 s (la ventana nativa de Whisper) de distintas solicitudes
+# se agrupan y pasan juntos por el encoder/decoder, acotados por tamaño y espera.
+
+class PlanificadorLotes:
+    """Junta segmentos pendientes (de cualquier solicitud) y los despacha por lotes"""
+
+    def __init__(self, max_tamano: int, max_espera_s: float, lotes_en_vuelo: int = 1):
+        self.max_tamano = max_tamano
+        self.max_espera_s = max_espera_s
+        self.lotes_en_vuelo = lotes_en_vuelo  # Uno por proceso de inferencia
+        self._pendientes: Dict[tuple, List[dict]] = {}  # (modelo, opciones de decodificación) -> segmentos
+        self._hay_pendientes: Optional[asyncio.Event] = None
+        self._tarea: Optional[asyncio.Task] = None
+        self._libres: Optional[asyncio.Semaphore] = None
+        self._despachos: set = set()
+        self.estadisticas = deque(maxlen=500)  # Por lote: tamaño, espera y cómputo
+
+    async def transcribir(self, audio: np.ndarray, desplazamiento_s: float, opciones: dict, modelo: str = WHISPER_MODELO) -> dict:
+        if self._tarea is None or self._tarea.done():
+            self._hay_pendientes = asyncio.Event()
+            self._libres = asyncio.Semaphore(self.lotes_en_vuelo)
+            self._tarea = asyncio.create_task(self._bucle())
+        futuro = asyncio.get_running_loop().create_future()
+        self._pendientes.setdefault((modelo, tuple(sorted(opciones.items()))), []).append({
+            "audio": audio,
+            "desplazamiento_s": desplazamiento_s,
+            "futuro": futuro,
+            "encolado_en": time.perf_counter(),
+        })
+        self._hay_pendientes.set()
+        return await futuro
+
+    def detener(self):
+        if self._tarea is not None:
+            self._tarea.cancel()
+            self._tarea = None
+        for despacho in self._despachos:
+            despacho.cancel()
+        self._despachos.clear()
+
+    async def _bucle(self):
+        while True:
+            await self._hay_pendientes.wait()
+            self._hay_pendientes.clear()
+            if not self._pendientes:
+                continue
+            # Esperar un proceso libre; mientras tanto el lote sigue creciendo
+            await self._libres.acquire()
+            if not self._pendientes:
+                self._libres.release()
+                continue
+
+            # El lote del segmento más antiguo sale al llenarse o al vencer su espera máxima
+            clave = min(self._pendientes, key=lambda c: self._pendientes[c][0]["encolado_en"])
+            limite = self._pendientes[clave][0]["encolado_en"] + self.max_espera_s
+            while len(self._pendientes[clave]) < self.max_tamano:
+                restante = limite - time.perf_counter()
+                if restante <= 0:
+                    break
+                try:
+                    await asyncio.wait_for(self._hay_pendientes.wait(), restante)
+                except asyncio.TimeoutError:
+                    break
+                self._hay_pendientes.clear()
+
+            lote = self._pendientes[clave][:self.max_tamano]
+            del self._pendientes[clave][:self.max_tamano]
+            if not self._pendientes[clave]:
+                del self._pendientes[clave]
+            lote = [s for s in lote if not s["futuro"].cancelled()]
+
+            if lote:
+                despacho = asyncio.create_task(self._despachar(lote, clave))
+                self._despachos.add(despacho)
+                despacho.add_done_callback(self._despachos.discard)
+            else:
+                self._libres.release()
+            if self._pendientes:
+                self._hay_pendientes.set()
+
+    async def _despachar(self, lote: List[dict], clave: tuple):
+        inicio = time.perf_counter()
+        try:
+            resultados = await ejecutar_inferencia(
+                _transcribir_lote,
+                [s["audio"] for s in lote],
+                [s["desplazamiento_s"] for s in lote],
+                dict(clave[1]),
+                clave[0],
+            )
+        except Exception as e:
+            for s in lote:
+                if not s["futuro"].done():
+                    s["futuro"].set_exception(e)
+        else:
+            for s, resultado in zip(lote, resultados):
+                if not s["futuro"].done():
+                    s["futuro"].set_result(resultado)
+        finally:
+            self._libres.release()
+        self.estadisticas.append({
+            "tamano": len(lote),
+            "espera_ms": (inicio - lote[0]["encolado_en"]) * 1000,
+            "computo_ms": (time.perf_counter() - inicio) * 1000,
+        })
+
+planificador_lotes = PlanificadorLotes(LOTE_MAX_TAMANO, LOTE_MAX_ESPERA_MS / 1000, max(1, PROCESOS_TRANSCRIPCION))
+
+async def _transcribir_por_lotes(audio: np.ndarray, opciones: dict, modelo: str) -> dict:
+    """Partir en segmentos ≤ 30 s y enviarlos al planificador de lotes"""
+    if len(audio) <= DURACION_VENTANA_WHISPER_S * FRECUENCIA_MUESTREO:
+        rangos = [(0, len(audio))]
+    else:
+        rangos = segmentar_por_silencio(audio, max_segundos=min(SEGMENTO_MAX_SEGUNDOS, DURACION_VENTANA_WHISPER_S))
+    partes = await asyncio.gather(*[
+        planificador_lotes.transcribir(audio[inicio:fin], inicio / FRECUENCIA_MUESTREO, opciones, modelo)
+        for inicio, fin in rangos
+    ])
+    return {
+        "texto": " ".join(p["texto"] for p in partes if p["texto"]),
+        "segmentos": [s for p in partes for s in p["segmentos"]],
+    }
+
+def obtener_metricas_lotes() -> dict:
+    """Tamaño, espera y cómputo por lote para ajustar throughput vs. latencia"""
+    lotes = list(planificador_lotes.estadisticas)
+    return {
+        "habilitado": INFERENCIA_POR_LOTES,
+        "max_tamano": LOTE_MAX_TAMANO,
+        "max_espera_ms": LOTE_MAX_ESPERA_MS,
+        "lotes": len(lotes),
+        "tamano_promedio": round(sum(l["tamano"] for l in lotes) / len(lotes), 2) if lotes else None,
+        "espera_ms": {
+            "p50": _percentil([l["espera_ms"] for l in lotes], 50),
+            "p95": _percentil([l["espera_ms"] for l in lotes], 95),
+        },
+        "computo_ms": {
+            "p50": _percentil([l["computo_ms"] for l in lotes], 50),
+            "p95": _percentil([l["computo_ms"] for l in lotes], 95),
+        },
+        "computo_ms_por_segmento": round(
+            sum(l["computo_ms"] for l in lotes) / sum(l["tamano"] for l in lotes), 1
+        ) if lotes else None,
+    }
+
+# ==================== ETAPAS DE UN TRABAJO ====================
+# Etapas de un trabajo de transcripción: preparación (E/S y decodificación),
+# inferencia (cómputo) y guardado (E/S). El pipeline las solapa entre trabajos;
+# transcribir_audio las encadena para un solo trabajo.
+
+async def _marcar_fallido(id_audio: str, e: Exception, pasada: str = "unica"):
+    if pasada == "refinado":
+        # El borrador ya publicado se conserva como transcripción final
+        print(f"⚠️ Error refinando audio {id_audio}: {str(e)}")
+        await actualizar_estado_audio(id_audio, {"refinamiento": "fallido", "error_refinamiento": str(e)})
+        return
+    print(f"❌ Error transcribiendo audio {id_audio}: {str(e)}")
+    await actualizar_estado_audio(id_audio, {
+        "estado": "fallido",
+        "error": str(e),
+        "fecha_procesamiento": datetime.now(timezone.utc)
+    })
+
+async def preparar_transcripcion(id_audio: str, pasada: str = "unica") -> Optional[dict]:
+    """Estado, metadata, caché, descarga/decodificación y pre-pasada. None si no hace falta inferir"""
+    try:
+        # Actualizar estado a procesando (el refinado no toca el borrador ya publicado)
+        if pasada != "refinado":
+            await actualizar_estado_audio(id_audio, {
+                "estado": "procesando",
+                "fecha_inicio_procesamiento": datetime.now(timezone.utc)
+            })
+        
+        # Obtener metadata del audio
+        doc_audio = await coleccion_audios.find_one({"_id": id_audio})
+        if not doc_audio:
+            raise Exception("Documento de audio no encontrado")
+        
+        # Profundidad de cola con la que se enruta el modelo: la misma para la caché y la inferencia
+        pendientes = (await cola_transcripcion.profundidad())["pendientes"]
+        
+        # Mismo contenido ya transcrito con los mismos parámetros (p. ej. reintento encolado dos veces)
+        if doc_audio.get("hash_contenido"):
+            cache = await buscar_transcripcion_cache(
+                doc_audio["hash_contenido"], doc_audio.get("calidad"), pasada_cache(pasada), pendientes
+            )
+            if cache:
+                print(f"♻️ Audio {id_audio}: transcripción reutilizada de {cache['id_audio_origen']}")
+                await actualizar_estado_audio(id_audio, {
+                    **campos_desde_cache(cache),
+                    **campos_version(doc_audio, "refinado" if pasada == "refinado" else "unica"),
+                })
+                return None
+        
+        # PCM 16 kHz: del artefacto normalizado o, la primera vez, decodificando el original
+        inicio = time.perf_counter()
+        audio = await obtener_audio_para_inferencia(doc_audio)
+        decodificacion_ms = (time.perf_counter() - inicio) * 1000
+        duracion_s = len(audio) / FRECUENCIA_MUESTREO
+        
+        # Quitar silencios y normalizar ganancia: Whisper procesa solo la señal reducida
+        inicio = time.perf_counter()
+        audio, preproceso = await asyncio.to_thread(preprocesar_audio, audio)
+        tramos = preproceso.pop("tramos")
+        if preproceso["segundos_recortados"]:
+            print(f"✂️ Audio {id_audio}: {preproceso['segundos_recortados']} s de silencio recortados")
+        return {
+            "id_audio": id_audio,
+            "pasada": pasada,
+            "doc_audio": doc_audio,
+            "audio": audio,
+            "duracion_s": duracion_s,
+            "pendientes": pendientes,
+            "tramos": tramos,
+            "preproceso": preproceso,
+            "etapas_ms": {
+                "descarga_decodificacion": round(decodificacion_ms, 1),
+                "preproceso": round((time.perf_counter() - inicio) * 1000, 1),
+            },
+        }
+    except Exception as e:
+        await _marcar_fallido(id_audio, e, pasada)
+        return None
+
+async def inferir_transcripcion(preparado: dict) -> Optional[dict]:
+    """Elegir modelo y transcribir la señal preparada"""
+    id_audio = preparado["id_audio"]
+    try:
+        # Elegir modelo según la pasada o, en pasada única, calidad pedida, duración y presión de la cola
+        modelo, motivo = enrutar_pasada(
+            preparado["pasada"], preparado["duracion_s"], preparado["doc_audio"].get("calidad"), preparado["pendientes"]
+        )
+        rutas_elegidas[modelo] = rutas_elegidas.get(modelo, 0) + 1
+        
+        # Transcribir en los procesos de inferencia (segmentado o por lotes según configuración)
+        print(f"🎙️ Transcribiendo audio {id_audio} con '{modelo}' ({motivo})...")
+        resultado = await ejecutar_transcripcion(preparado.pop("audio"), modelo)
+        resultado["segmentos"] = reubicar_segmentos(resultado["segmentos"], preparado["tramos"])
+        resultado["motivo_modelo"] = motivo
+        duraciones_trabajo_ms.append(resultado["tiempo_ms"])
+        preparado["etapas_ms"]["inferencia"] = resultado["tiempo_ms"]
+        return resultado
+    except Exception as e:
+        await _marcar_fallido(id_audio, e, preparado["pasada"])
+        return None
+
+async def guardar_transcripcion(preparado: dict, resultado: dict):
+    """Limpiar el texto, completar el documento y guardar en la caché de transcripciones"""
+    id_audio = preparado["id_audio"]
+    pasada = preparado["pasada"]
+    doc_audio = preparado["doc_audio"]
+    try:
+        transcripcion_raw = resultado["texto"]
+        modelo = resultado["modelo"]
+        parametros = parametros_transcripcion(modelo)
+        duracion_s = round(preparado["duracion_s"], 2)
+        
+        # Limpiar transcripción
+        transcripcion = limpiar_transcripcion(transcripcion_raw)
+        
+        print(
+            f"✅ Transcripción ({pasada}) completada en {resultado['tiempo_ms']} ms "
+            f"(RTF {resultado['rtf']}, {resultado['modo']}): {transcripcion[:100]}..."
+        )
+        
+        # Actualizar documento con transcripción
+        await actualizar_estado_audio(id_audio, {
+            "estado": "completado",
+            "transcripcion": transcripcion,
+            "transcripcion_raw": transcripcion_raw,
+            "segmentos": resultado["segmentos"],
+            "duracion_segundos": duracion_s,
+            "modelo_whisper": modelo,
+            "parametros_transcripcion": dict(parametros, motivo_modelo=resultado["motivo_modelo"]),
+            "metricas_transcripcion": {
+                "motor": resultado["motor"],
+                "modo": resultado["modo"],
+                "tiempo_ms": resultado["tiempo_ms"],
+                "rtf": resultado["rtf"],
+                "etapas_ms": preparado["etapas_ms"],
+            },
+            "preproceso": preparado["preproceso"],
+            "fecha_procesamiento": datetime.now(timezone.utc),
+            **campos_version(doc_audio, pasada),
+        })
+        
+        if pasada == "borrador":
+            try:
+                await encolar_transcripcion(id_audio, PRIORIDAD_REFINADO, "refinado")
+            except Exception as e:
+                # Queda refinamiento "pendiente": se reencola al rehidratar la cola
+                print(f"⚠️ No se pudo encolar el refinado de {id_audio}: {e}")
+        
+        if doc_audio.get("hash_contenido"):
+            clave_cache = clave_cache_transcripcion(doc_audio["hash_contenido"], parametros)
+            await guardar_transcripcion_cache(clave_cache, doc_audio["hash_contenido"], id_audio, parametros, {
+                "transcripcion": transcripcion,
+                "transcripcion_raw": transcripcion_raw,
+                "segmentos": resultado["segmentos"],
+                "duracion_segundos": duracion_s,
+            })
+    except Exception as e:
+        await _marcar_fallido(id_audio, e, pasada)
+
+async def transcribir_audio(id_audio: str, pasada: str = "unica"):
+    """Transcribir un audio con las tres etapas en secuencia (modo sin pipeline)"""
+    preparado = await preparar_transcripcion(id_audio, pasada)
+    if preparado is None:
+        return
+    resultado = await inferir_transcripcion(preparado)
+    if resultado is None:
+        return
+    await guardar_transcripcion(preparado, resultado)
+
+# ==================== WORKERS DE TRANSCRIPCIÓN ====================
+# Sin pipeline, cada worker encadena las tres etapas de un trabajo; con pipeline,
+# las etapas corren en tareas separadas unidas por colas acotadas.
+
+async def _ejecutar_trabajo(trabajo: dict):
+    """Transcribir un trabajo reservado manteniendo vivo su lease"""
+    metricas_cola["esperas_ms"].append((time.time() - trabajo["encolado_en"]) * 1000)
+    metricas_cola["workers_ocupados"] += 1
+    latido = asyncio.create_task(_mantener_lease(trabajo["id_trabajo"]))
+    try:
+        await transcribir_audio(trabajo["id_audio"], trabajo.get("pasada", "unica"))
+    finally:
+        latido.cancel()
+        metricas_cola["workers_ocupados"] -= 1
+    # Si el worker se cancela (apagado) no se completa: el lease vence y otro lo retoma
+    await cola_transcripcion.completar(trabajo["id_trabajo"])
+    metricas_cola["completados"] += 1
+
+async def _bucle_worker_transcripcion(numero: int):
+    """Consumir la cola de transcripción indefinidamente"""
+    while True:
+        try:
+            trabajo = await cola_transcripcion.reservar()
+            if trabajo is None:
+                await asyncio.sleep(COLA_INTERVALO_SONDEO)
+                continue
+            await _ejecutar_trabajo(trabajo)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"❌ Worker de transcripción {numero}: {e}")
+            await asyncio.sleep(COLA_INTERVALO_SONDEO)
+
+class PipelineTranscripcion:
+    """
+    Etapas solapadas con colas acotadas: mientras un trabajo está en inferencia,
+    los siguientes ya se descargan y decodifican, y el anterior se guarda.
+    La capacidad acota el audio decodificado en memoria y cuántos trabajos se
+    reservan por adelantado (el resto queda en la cola para otras réplicas).
+    """
+
+    ETAPAS = ("espera_cola", "descarga_decodificacion", "preproceso", "espera_inferencia", "inferencia", "espera_guardado", "guardado")
+
+    def __init__(self, preparadores: int, inferidores: int, capacidad: int):
+        self.preparadores = preparadores
+        self.inferidores = inferidores
+        self.capacidad = capacidad
+        self.preparados: Optional[asyncio.Queue] = None
+        self.inferidos: Optional[asyncio.Queue] = None
+        self._latidos: Dict[str, asyncio.Task] = {}
+        self.tiempos = {etapa: deque(maxlen=500) for etapa in self.ETAPAS}
+        self._inferencia_ocupada_s = 0.0
+        self._iniciado_en: Optional[float] = None
+
+    def tareas(self) -> List[asyncio.Task]:
+        self.preparados = asyncio.Queue(self.capacidad)
+        self.inferidos = asyncio.Queue(self.capacidad)
+        self._iniciado_en = time.perf_counter()
+        return (
+            [asyncio.create_task(self._bucle_etapa(self._preparar, n + 1, "preparación")) for n in range(self.preparadores)]
+            + [asyncio.create_task(self._bucle_etapa(self._inferir, n + 1, "inferencia")) for n in range(self.inferidores)]
+            + [asyncio.create_task(self._bucle_etapa(self._guardar, 1, "guardado"))]
+        )
+
+    def detener(self):
+        # Los trabajos aún en el pipeline no se completan: su lease vence y se reintentan
+        for latido in self._latidos.values():
+            latido.cancel()
+        self._latidos.clear()
+
+    def _abrir(self, trabajo: dict):
+        espera_ms = (time.time() - trabajo["encolado_en"]) * 1000
+        self.tiempos["espera_cola"].append(espera_ms)
+        metricas_cola["esperas_ms"].append(espera_ms)
+        metricas_cola["workers_ocupados"] += 1
+        self._latidos[trabajo["id_trabajo"]] = asyncio.create_task(_mantener_lease(trabajo["id_trabajo"]))
+
+    async def _cerrar(self, trabajo: dict):
+        latido = self._latidos.pop(trabajo["id_trabajo"], None)
+        if latido:
+            latido.cancel()
+        metricas_cola["workers_ocupados"] -= 1
+        await cola_transcripcion.completar(trabajo["id_trabajo"])
+        metricas_cola["completados"] += 1
+
+    async def _bucle_etapa(self, paso, numero: int, nombre: str):
+        while True:
+            try:
+                await paso()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"❌ Etapa de {nombre} {numero}: {e}")
+                await asyncio.sleep(COLA_INTERVALO_SONDEO)
+
+    async def _preparar(self):
+        trabajo = await cola_transcripcion.reservar()
+        if trabajo is None:
+            await asyncio.sleep(COLA_INTERVALO_SONDEO)
+            return
+        self._abrir(trabajo)
+        preparado = await preparar_transcripcion(trabajo["id_audio"], trabajo.get("pasada", "unica"))
+        if preparado is None:
+            await self._cerrar(trabajo)
+            return
+        for etapa, ms in preparado["etapas_ms"].items():
+            self.tiempos[etapa].append(ms)
+        preparado["listo_en"] = time.perf_counter()
+        await self.preparados.put((trabajo, preparado))  # Bloquea si la inferencia va atrasada
+
+    async def _inferir(self):
+        trabajo, preparado = await self.preparados.get()
+        inicio = time.perf_counter()
+        espera_ms = round((inicio - preparado.pop("listo_en")) * 1000, 1)
+        preparado["etapas_ms"]["espera_inferencia"] = espera_ms
+        self.tiempos["espera_inferencia"].append(espera_ms)
+        try:
+            resultado = await inferir_transcripcion(preparado)
+        finally:
+            self._inferencia_ocupada_s += time.perf_counter() - inicio
+        if resultado is None:
+            await self._cerrar(trabajo)
+            return
+        self.tiempos["inferencia"].append(resultado["tiempo_ms"])
+        preparado["inferido_en"] = time.perf_counter()
+        await self.inferidos.put((trabajo, preparado, resultado))
+
+    async def _guardar(self):
+        trabajo, preparado, resultado = await self.inferidos.get()
+        inicio = time.perf_counter()
+        espera_ms = round((inicio - preparado.pop("inferido_en")) * 1000, 1)
+        preparado["etapas_ms"]["espera_guardado"] = espera_ms
+        self.tiempos["espera_guardado"].append(espera_ms)
+        try:
+            await guardar_transcripcion(preparado, resultado)
+        finally:
+            self.tiempos["guardado"].append(round((time.perf_counter() - inicio) * 1000, 1))
+            await self._cerrar(trabajo)
+
+    def estado(self) -> dict:
+        """Tiempos por etapa y ocupación de la inferencia (cerca de 1 = el límite es el cómputo)"""
+        transcurrido = time.perf_counter() - self._iniciado_en if self._iniciado_en else 0
+        return {
+            "habilitado": True,
+            "preparadores": self.preparadores,
+            "inferidores": self.inferidores,
+            "capacidad": self.capacidad,
+            "preparados": self.preparados.qsize() if self.preparados else 0,
+            "por_guardar": self.inferidos.qsize() if self.inferidos else 0,
+            "ocupacion_inferencia": round(
+                self._inferencia_ocupada_s / (transcurrido * self.inferidores), 3
+            ) if transcurrido else None,
+            "etapas_ms": {
+                etapa: {"p50": _percentil(valores, 50), "p95": _percentil(valores, 95)}
+                for etapa, valores in self.tiempos.items()
+            },
+        }
+
+pipeline_transcripcion = PipelineTranscripcion(PIPELINE_PREPARADORES, WORKERS_TRANSCRIPCION, PIPELINE_CAPACIDAD)
+
+async def _bucle_recuperacion_cola():
+    """Reencolar trabajos cuyo worker dejó de renovar el lease"""
+    while True:
+        await asyncio.sleep(COLA_SEGUNDOS_LATIDO)
+        try:
+            reencolados, agotados = await cola_transcripcion.recuperar_vencidos(COLA_MAX_INTENTOS)
+            metricas_cola["reintentados"] += len(reencolados)
+            metricas_cola["agotados"] += len(agotados)
+            for trabajo in reencolados:
+                print(f"🔁 Trabajo {trabajo['id_trabajo']} reencolado (intento {trabajo['intentos']})")
+            for trabajo in agotados:
+                error = f"Transcripción abandonada tras {trabajo['intentos']} intentos"
+                if trabajo.get("pasada") == "refinado":
+                    await actualizar_estado_audio(trabajo["id_audio"], {"refinamiento": "fallido", "error_refinamiento": error})
+                    continue
+                await actualizar_estado_audio(trabajo["id_audio"], {
+                    "estado": "fallido",
+                    "error": error,
+                    "fecha_procesamiento": datetime.now(timezone.utc)
+                })
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"⚠️ Error recuperando trabajos vencidos: {e}")
+
+async def _rehidratar_cola():
+    """Encolar audios que quedaron pendientes, a medio procesar o sin refinar antes del último reinicio"""
+    try:
+        cursor = coleccion_audios.find(
+            {"$or": [{"estado": {"$in": ["pendiente", "procesando"]}}, {"refinamiento": "pendiente"}]},
+            {"_id": 1, "estado": 1},
+        )
+        reencolados = 0
+        async for doc in cursor:
+            if doc.get("estado") == "completado":
+                pasada, prioridad = "refinado", PRIORIDAD_REFINADO
+            else:
+                pasada, prioridad = pasada_inicial(), PRIORIDAD_NORMAL
+            if await cola_transcripcion.contiene(id_trabajo_transcripcion(doc["_id"], pasada)):
+                continue
+            if await encolar_transcripcion(doc["_id"], prioridad, pasada):
+                reencolados += 1
+        if reencolados:
+            print(f"🔁 {reencolados} audio(s) pendientes reencolados")
+    except Exception as e:
+        print(f"⚠️ No se pudo rehidratar la cola de transcripción: {e}")
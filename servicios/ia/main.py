@@ -7,14 +7,20 @@ Integración con Gemini para corrección de texto y extracción de campos médic
 from fastapi import FastAPI, HTTPException, Depends, Header
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel, Field
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, Awaitable, Callable, Tuple
 import google.generativeai as genai
+import asyncio
 import json
 import re
-from datetime import datetime, timezone
+import time
+import uuid
+from collections import OrderedDict, deque
+from datetime import datetime, timezone, timedelta
 import jwt
 import os
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.errors import DuplicateKeyError, OperationFailure
+from redis import asyncio as aioredis
 import hashlib
 from dotenv import load_dotenv
 from pathlib import Path
@@ -28,6 +34,28 @@ SECRETO_JWT = os.getenv("SECRETO_JWT", os.getenv("JWT_SECRET", ""))
 if not SECRETO_JWT:
     raise RuntimeError("SECRETO_JWT/JWT_SECRET es obligatorio")
 
+# Llamadas a Gemini: concurrentes por worker, con límite y timeout por llamada
+GEMINI_MAX_CONCURRENCIA = int(os.getenv("GEMINI_MAX_CONCURRENCIA", "8"))
+GEMINI_TIMEOUT_S = float(os.getenv("GEMINI_TIMEOUT_S", "20"))
+
+# Ruteo de modelos: ventana móvil de latencia/errores y circuit breaker por modelo
+RUTEO_VENTANA_S = float(os.getenv("RUTEO_VENTANA_S", "300"))
+RUTEO_MAX_MUESTRAS = int(os.getenv("RUTEO_MAX_MUESTRAS", "100"))
+CIRCUITO_FALLOS_SEGUIDOS = int(os.getenv("CIRCUITO_FALLOS_SEGUIDOS", "3"))
+CIRCUITO_TASA_ERROR = float(os.getenv("CIRCUITO_TASA_ERROR", "0.5"))
+CIRCUITO_MIN_LLAMADAS = int(os.getenv("CIRCUITO_MIN_LLAMADAS", "10"))
+CIRCUITO_ABIERTO_S = float(os.getenv("CIRCUITO_ABIERTO_S", "30"))
+
+# Caché de resultados: LRU en memoria del worker delante de la colección cache_ia
+CACHE_IA_DIAS = int(os.getenv("CACHE_IA_DIAS", "7"))
+CACHE_IA_MEMORIA_MAX = int(os.getenv("CACHE_IA_MEMORIA_MAX", "1000"))  # 0 = sin nivel en memoria
+
+# Coalescencia de análisis idénticos en curso; con Redis, también entre workers
+URL_REDIS = os.getenv("URL_REDIS", os.getenv("REDIS_URL", ""))  # Vacío = solo dentro del worker
+COALESCENCIA_BLOQUEO_S = int(os.getenv("COALESCENCIA_BLOQUEO_S", "90"))  # Debe cubrir la cadena de modelos
+COALESCENCIA_ESPERA_MAX_S = float(os.getenv("COALESCENCIA_ESPERA_MAX_S", "90"))
+COALESCENCIA_SONDEO_S = float(os.getenv("COALESCENCIA_SONDEO_S", "0.2"))
+
 # Configurar Gemini
 if CLAVE_API_GEMINI:
     genai.configure(api_key=CLAVE_API_GEMINI)
@@ -87,6 +115,7 @@ bd = cliente_mongo.project_parallel
 coleccion_cache_ia = bd.cache_ia
 coleccion_logs_ia = bd.logs_ia
 
+
 # ==================== ESQUEMAS ====================
 class SolicitudAnalisis(BaseModel):
     texto: str = Field(..., min_length=10, description="Texto a analizar")
@@ -145,29 +174,273 @@ def generar_hash_cache(texto: str) -> str:
     """Generar hash para caché"""
     return hashlib.sha256(texto.encode('utf-8')).hexdigest()
 
+# ==================== CACHÉ DE RESULTADOS ====================
+# Dos niveles: LRU en memoria del worker (microsegundos) y cache_ia en MongoDB,
+# compartido entre workers. Una entrada vence en ambos niveles en el mismo instante:
+# fecha_creacion del documento + CACHE_IA_DIAS.
+
+DURACION_CACHE_IA = timedelta(days=CACHE_IA_DIAS)
+
+class CacheMemoriaLRU:
+    """Resultados recientes del worker, acotados por cantidad y con vencimiento absoluto"""
+
+    def __init__(self, maximo: int):
+        self.maximo = maximo
+        self._entradas: "OrderedDict[str, tuple]" = OrderedDict()  # hash -> (vence_en, resultado)
+
+    def obtener(self, clave: str) -> Optional[dict]:
+        entrada = self._entradas.get(clave)
+        if entrada is None:
+            return None
+        vence_en, resultado = entrada
+        if vence_en <= datetime.now(timezone.utc):
+            del self._entradas[clave]
+            return None
+        self._entradas.move_to_end(clave)
+        return resultado
+
+    def guardar(self, clave: str, resultado: dict, vence_en: datetime):
+        if self.maximo <= 0:
+            return
+        self._entradas[clave] = (vence_en, resultado)
+        self._entradas.move_to_end(clave)
+        while len(self._entradas) > self.maximo:
+            self._entradas.popitem(last=False)
+
+    def eliminar_vencidos(self) -> int:
+        ahora = datetime.now(timezone.utc)
+        vencidas = [clave for clave, (vence_en, _) in self._entradas.items() if vence_en <= ahora]
+        for clave in vencidas:
+            del self._entradas[clave]
+        return len(vencidas)
+
+    def __len__(self) -> int:
+        return len(self._entradas)
+
+cache_memoria_ia = CacheMemoriaLRU(CACHE_IA_MEMORIA_MAX)
+metricas_cache = {
+    "memoria": {"aciertos": 0, "fallos": 0},
+    "mongo": {"aciertos": 0, "fallos": 0},
+}
+
+def _vencimiento(fecha_creacion: datetime) -> datetime:
+    # Mongo devuelve fechas sin zona (UTC)
+    if fecha_creacion.tzinfo is None:
+        fecha_creacion = fecha_creacion.replace(tzinfo=timezone.utc)
+    return fecha_creacion + DURACION_CACHE_IA
+
+async def leer_cache(hash_texto: str) -> Tuple[Optional[dict], Optional[str]]:
+    """Resultado en caché y el nivel que lo tenía ("memoria" o "mongo"), sin tocar las métricas"""
+    resultado = cache_memoria_ia.obtener(hash_texto)
+    if resultado is not None:
+        return resultado, "memoria"
+    
+    # El vencimiento se filtra en la consulta, no después de traer el documento
+    doc = await coleccion_cache_ia.find_one(
+        {"hash": hash_texto, "fecha_creacion": {"$gt": datetime.now(timezone.utc) - DURACION_CACHE_IA}},
+        {"resultado": 1, "fecha_creacion": 1},
+    )
+    # Entradas heurísticas guardadas antes de excluirlas de la caché cuentan como fallo
+    if not doc or not resultado_cacheable(doc["resultado"]):
+        return None, None
+    cache_memoria_ia.guardar(hash_texto, doc["resultado"], _vencimiento(doc["fecha_creacion"]))
+    return doc["resultado"], "mongo"
+
 async def obtener_desde_cache(hash_texto: str) -> Optional[dict]:
-    """Intentar obtener resultado desde caché"""
-    doc = await coleccion_cache_ia.find_one({"hash": hash_texto})
-    if doc:
-        # Verificar que no sea muy antiguo (7 días)
-        if (datetime.now(timezone.utc) - doc["fecha_creacion"]).days < 7:
-            return doc["resultado"]
-    return None
+    """Intentar obtener resultado desde caché: primero memoria, luego MongoDB"""
+    resultado, nivel = await leer_cache(hash_texto)
+    if nivel == "memoria":
+        metricas_cache["memoria"]["aciertos"] += 1
+        return resultado
+    metricas_cache["memoria"]["fallos"] += 1
+    metricas_cache["mongo"]["aciertos" if nivel == "mongo" else "fallos"] += 1
+    return resultado
+
+def resultado_cacheable(resultado: dict) -> bool:
+    """
+    El respaldo heurístico (Gemini caído, circuitos abiertos o timeout) no se guarda:
+    quedaría servido durante CACHE_IA_DIAS en lugar de reintentar con Gemini.
+    """
+    return resultado.get("modelo_usado") != "heuristico"
 
 async def guardar_en_cache(hash_texto: str, resultado: dict, texto_original: str):
-    """Guardar resultado en caché"""
-    await coleccion_cache_ia.update_one(
-        {"hash": hash_texto},
-        {
-            "$set": {
-                "hash": hash_texto,
-                "resultado": resultado,
-                "texto_original": texto_original[:500],  # Solo primeros 500 chars
-                "fecha_creacion": datetime.now(timezone.utc)
-            }
-        },
-        upsert=True
-    )
+    """Guardar resultado en ambos niveles de caché"""
+    fecha_creacion = datetime.now(timezone.utc)
+    filtro = {"hash": hash_texto}
+    cambios = {
+        "$set": {
+            "hash": hash_texto,
+            "resultado": resultado,
+            "texto_original": texto_original[:500],  # Solo primeros 500 chars
+            "fecha_creacion": fecha_creacion
+        }
+    }
+    try:
+        await coleccion_cache_ia.update_one(filtro, cambios, upsert=True)
+    except DuplicateKeyError:
+        # Otro worker insertó el mismo hash entre la búsqueda y el upsert: ahora sí coincide
+        await coleccion_cache_ia.update_one(filtro, cambios)
+    cache_memoria_ia.guardar(hash_texto, resultado, _vencimiento(fecha_creacion))
+
+def estado_cache() -> dict:
+    """Aciertos y fallos por nivel de caché"""
+    def tasa(nivel: dict) -> Optional[float]:
+        consultas = nivel["aciertos"] + nivel["fallos"]
+        return round(nivel["aciertos"] / consultas, 3) if consultas else None
+    return {
+        "dias": CACHE_IA_DIAS,
+        "memoria": {**metricas_cache["memoria"], "tasa_aciertos": tasa(metricas_cache["memoria"]),
+                    "entradas": len(cache_memoria_ia), "maximo": CACHE_IA_MEMORIA_MAX},
+        "mongo": {**metricas_cache["mongo"], "tasa_aciertos": tasa(metricas_cache["mongo"])},
+    }
+
+# Códigos de MongoDB: índice existente con otras opciones (p. ej. otro expireAfterSeconds)
+# y clave duplicada (datos previos que violan un índice único)
+CODIGO_CONFLICTO_OPCIONES_INDICE = 85
+CODIGO_CLAVE_DUPLICADA = 11000
+
+async def _deduplicar_cache_ia() -> int:
+    """Deja una sola entrada por hash (la más reciente) y devuelve cuántas se borraron"""
+    borradas = 0
+    async for grupo in coleccion_cache_ia.aggregate([
+        {"$sort": {"fecha_creacion": -1}},
+        {"$group": {"_id": "$hash", "ids": {"$push": "$_id"}, "total": {"$sum": 1}}},
+        {"$match": {"total": {"$gt": 1}}},
+    ], allowDiskUse=True):
+        resultado = await coleccion_cache_ia.delete_many({"_id": {"$in": grupo["ids"][1:]}})
+        borradas += resultado.deleted_count
+    return borradas
+
+async def _crear_indice_hash_cache():
+    """Hash único; con duplicados previos se depuran y, si aún fallan, queda un índice no único"""
+    try:
+        await coleccion_cache_ia.create_index("hash", name="hash_unico", unique=True)
+        return
+    except OperationFailure as e:
+        if e.code != CODIGO_CLAVE_DUPLICADA:
+            raise
+    print(f"🧹 Caché de IA: {await _deduplicar_cache_ia()} entradas duplicadas por hash eliminadas")
+    try:
+        await coleccion_cache_ia.create_index("hash", name="hash_unico", unique=True)
+    except OperationFailure as e:
+        if e.code != CODIGO_CLAVE_DUPLICADA:
+            raise
+        # Otro worker sin el índice volvió a duplicar: al menos las búsquedas por hash usan índice
+        await coleccion_cache_ia.create_index("hash", name="hash_busqueda")
+        print("⚠️ Caché de IA: índice por hash creado sin unicidad (siguen llegando duplicados)")
+
+async def _crear_indice_ttl_cache():
+    """TTL sobre fecha_creacion: MongoDB borra los resultados vencidos; si cambió CACHE_IA_DIAS, se ajusta"""
+    segundos = int(DURACION_CACHE_IA.total_seconds())
+    try:
+        await coleccion_cache_ia.create_index("fecha_creacion", name="fecha_creacion_ttl", expireAfterSeconds=segundos)
+    except OperationFailure as e:
+        if e.code != CODIGO_CONFLICTO_OPCIONES_INDICE:
+            raise
+        await bd.command("collMod", coleccion_cache_ia.name, index={"name": "fecha_creacion_ttl", "expireAfterSeconds": segundos})
+
+async def _crear_indice_logs():
+    await coleccion_logs_ia.create_index([("id_usuario", 1), ("fecha", -1)], name="usuario_fecha")
+
+async def _crear_indices_ia():
+    """Índices de la caché (hash único y vencimiento por TTL) y de los logs por usuario y fecha"""
+    # Cada índice por separado: un fallo en uno no impide crear los demás
+    for descripcion, crear in (
+        ("hash único de la caché", _crear_indice_hash_cache),
+        ("TTL de la caché", _crear_indice_ttl_cache),
+        ("de logs por usuario y fecha", _crear_indice_logs),
+    ):
+        try:
+            await crear()
+        except Exception as e:
+            print(f"⚠️ No se pudo crear el índice {descripcion} de IA: {e}")
+
+# ==================== COALESCENCIA DE ANÁLISIS ====================
+# Dos solicitudes con el mismo hash (formulario enviado dos veces, dos pestañas)
+# comparten una sola llamada a Gemini. Dentro del worker esperan el mismo futuro;
+# entre workers, el que toma el bloqueo en Redis calcula y guarda en caché, y los
+# demás leen de la caché cuando el resultado aparece.
+
+_LUA_LIBERAR_BLOQUEO = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then return redis.call('DEL', KEYS[1]) end
+return 0
+"""
+
+class CoalescedorAnalisis:
+    """Single-flight por hash de caché"""
+
+    def __init__(self, url_redis: Optional[str] = None):
+        self.cliente = aioredis.from_url(url_redis, decode_responses=True) if url_redis else None
+        self._en_curso: Dict[str, asyncio.Task] = {}
+        self.metricas = {"calculados": 0, "coalescidos_worker": 0, "coalescidos_redis": 0, "esperas_agotadas": 0}
+
+    async def ejecutar(self, clave: str, calcular: Callable[[], Awaitable[dict]]) -> Tuple[dict, bool]:
+        """Resultado de calcular() para la clave y si vino de otra solicitud (y por tanto de la caché)"""
+        tarea = self._en_curso.get(clave)
+        seguidor = tarea is not None
+        if seguidor:
+            self.metricas["coalescidos_worker"] += 1
+        else:
+            # Tarea desacoplada: si la solicitud que la inició se cancela, el cálculo sigue
+            # para las demás (y termina guardándose en la caché)
+            tarea = asyncio.ensure_future(self._calcular_entre_workers(clave, calcular))
+            self._en_curso[clave] = tarea
+            tarea.add_done_callback(lambda t: self._terminado(clave, t))
+        # shield: cancelar una solicitud no cancela el cálculo que comparte con otras
+        resultado, coalescido = await asyncio.shield(tarea)
+        # Un resultado heurístico no se guarda en caché: quien lo comparte no lo recibe "desde caché"
+        return resultado, (coalescido or seguidor) and resultado_cacheable(resultado)
+
+    def _terminado(self, clave: str, tarea: asyncio.Task):
+        if self._en_curso.get(clave) is tarea:
+            del self._en_curso[clave]
+        if not tarea.cancelled():
+            tarea.exception()  # Marcada como leída aunque nadie más la espere
+
+    async def _calcular(self, calcular) -> Tuple[dict, bool]:
+        self.metricas["calculados"] += 1
+        return await calcular(), False
+
+    async def _calcular_entre_workers(self, clave: str, calcular) -> Tuple[dict, bool]:
+        if self.cliente is None:
+            return await self._calcular(calcular)
+        
+        llave = f"ia:analisis:{clave}"
+        token = uuid.uuid4().hex
+        try:
+            adquirido = await self.cliente.set(llave, token, nx=True, ex=COALESCENCIA_BLOQUEO_S)
+        except Exception as e:
+            print(f"⚠️ Redis no disponible para coalescer análisis: {e}")
+            return await self._calcular(calcular)
+        
+        if adquirido:
+            try:
+                return await self._calcular(calcular)
+            finally:
+                try:
+                    await self.cliente.eval(_LUA_LIBERAR_BLOQUEO, 1, llave, token)
+                except Exception as e:
+                    print(f"⚠️ No se pudo liberar el bloqueo {llave}: {e}")
+        
+        # Otro worker está analizando el mismo texto: esperar su resultado en la caché.
+        # El sondeo no cuenta en las métricas de caché (la solicitud ya contó su fallo) y
+        # leer_cache ignora resultados heurísticos, que no deben servirse como caché.
+        limite = time.monotonic() + COALESCENCIA_ESPERA_MAX_S
+        while time.monotonic() < limite:
+            await asyncio.sleep(COALESCENCIA_SONDEO_S)
+            resultado, _ = await leer_cache(clave)
+            if resultado is not None:
+                self.metricas["coalescidos_redis"] += 1
+                return resultado, True
+            if not await self.cliente.exists(llave):
+                break  # Liberado sin resultado (falló): calcular aquí
+        self.metricas["esperas_agotadas"] += 1
+        return await self._calcular(calcular)
+
+    def estado(self) -> dict:
+        return {"redis": self.cliente is not None, "en_curso": len(self._en_curso), **self.metricas}
+
+coalescedor_ia = CoalescedorAnalisis(URL_REDIS)
 
 async def registrar_log_ia(
     id_usuario: int,
@@ -187,7 +460,210 @@ async def registrar_log_ia(
         "fecha": datetime.now(timezone.utc)
     })
 
-def analizar_con_gemini(texto: str) -> dict:
+# ==================== CLIENTE GEMINI ====================
+# generate_content bloquea el event loop: se usa la variante asíncrona, con un
+# semáforo que acota las llamadas simultáneas del worker y un timeout por llamada.
+
+semaforo_gemini = asyncio.Semaphore(GEMINI_MAX_CONCURRENCIA)
+metricas_gemini = {
+    "llamadas": 0,
+    "en_curso": 0,
+    "errores": 0,
+    "timeouts": 0,
+    "esperas_ms": deque(maxlen=500),
+    "latencias_ms": deque(maxlen=500),
+}
+
+def _percentil(valores, percentil: float) -> Optional[float]:
+    """Percentil por rango más cercano sobre una muestra pequeña"""
+    ordenados = sorted(valores)
+    if not ordenados:
+        return None
+    indice = min(len(ordenados) - 1, max(0, int(round(percentil / 100 * len(ordenados) + 0.5)) - 1))
+    return round(ordenados[indice], 1)
+
+def modelos_candidatos() -> list:
+    """Modelos a intentar en orden: los preferidos que estén disponibles"""
+    if MODELOS_GEMINI_DISPONIBLES:
+        modelos = [m for m in MODELOS_GEMINI_PREFERIDOS if m in MODELOS_GEMINI_DISPONIBLES]
+        return modelos or MODELOS_GEMINI_DISPONIBLES[:3]
+    return MODELOS_GEMINI_PREFERIDOS
+
+# ==================== RUTEO DE MODELOS ====================
+# En lugar de recorrer MODELOS_GEMINI_PREFERIDOS siempre en el mismo orden, cada
+# análisis empieza por el modelo sano más rápido (p50 de la ventana reciente).
+# Un modelo con fallos seguidos o tasa de error alta abre su circuito: se omite
+# durante CIRCUITO_ABIERTO_S y luego una sola solicitud lo prueba (semiabierto);
+# si responde, el circuito se cierra, y si falla, vuelve a abrirse.
+
+class RuteadorModelos:
+    """Latencia y errores por modelo en una ventana móvil, con circuit breaker"""
+
+    def __init__(self):
+        self._modelos: Dict[str, dict] = {}
+        self.decisiones: Dict[str, int] = {}
+        self.sin_modelos = 0
+
+    def _estado(self, modelo: str) -> dict:
+        if modelo not in self._modelos:
+            self._modelos[modelo] = {
+                "muestras": deque(maxlen=RUTEO_MAX_MUESTRAS),  # (instante, exito, latencia_ms)
+                "fallos_seguidos": 0,
+                "abierto_hasta": 0.0,  # 0 = cerrado; vencido = semiabierto
+                "sondeo_desde": None,
+                "aperturas": 0,
+            }
+        return self._modelos[modelo]
+
+    def _recientes(self, estado: dict, ahora: float) -> list:
+        muestras = estado["muestras"]
+        while muestras and ahora - muestras[0][0] > RUTEO_VENTANA_S:
+            muestras.popleft()
+        return list(muestras)
+
+    @staticmethod
+    def _circuito(estado: dict, ahora: float) -> str:
+        if not estado["abierto_hasta"]:
+            return "cerrado"
+        return "abierto" if estado["abierto_hasta"] > ahora else "semiabierto"
+
+    def ordenar(self, modelos: list) -> list:
+        """
+        Modelos a intentar: primero el que toca sondear (semiabierto), luego los medidos
+        por tasa de error en la ventana y, a igual tasa, por p50 de sus llamadas exitosas.
+        Un modelo sin éxitos recientes (sin medir o fallando) no tiene latencia que comparar:
+        solo uno de ellos, el intentado hace más tiempo, ocupa un turno de prueba al final.
+        Los de circuito abierto se omiten; sin ninguno, el llamador usa la heurística.
+        """
+        ahora = time.monotonic()
+        sondeos, medidos, sin_medir = [], [], []
+        for posicion, modelo in enumerate(modelos):
+            estado = self._estado(modelo)
+            circuito = self._circuito(estado, ahora)
+            if circuito == "abierto":
+                continue
+            if circuito == "semiabierto":
+                # Un solo sondeo a la vez; si el que lo tomó no respondió, se libera tras el timeout
+                if estado["sondeo_desde"] is None or ahora - estado["sondeo_desde"] > GEMINI_TIMEOUT_S:
+                    estado["sondeo_desde"] = ahora
+                    sondeos.append(modelo)
+                continue
+            recientes = self._recientes(estado, ahora)
+            latencias = [ms for _, exito, ms in recientes if exito]
+            if not latencias:
+                ultimo_intento = recientes[-1][0] if recientes else 0.0
+                sin_medir.append((ultimo_intento, posicion, modelo))
+                continue
+            tasa_error = 1 - len(latencias) / len(recientes)
+            medidos.append((tasa_error, _percentil(latencias, 50), posicion, modelo))
+        
+        if medidos:
+            sin_medir = sorted(sin_medir)[:1]  # Un turno de prueba, detrás de los medidos
+        sin_medir.sort(key=lambda s: s[1])  # Sin ningún modelo medido: todos, en el orden configurado
+        orden = sondeos + [m[-1] for m in sorted(medidos)] + [m[-1] for m in sin_medir]
+        if orden:
+            self.decisiones[orden[0]] = self.decisiones.get(orden[0], 0) + 1
+        else:
+            self.sin_modelos += 1
+        return orden
+
+    def registrar(self, modelo: str, exito: bool, latencia_ms: Optional[float] = None):
+        ahora = time.monotonic()
+        estado = self._estado(modelo)
+        circuito = self._circuito(estado, ahora)
+        estado["muestras"].append((ahora, exito, latencia_ms))
+        
+        if exito:
+            estado["fallos_seguidos"] = 0
+            if circuito != "cerrado":
+                print(f"✅ Circuito de {modelo} cerrado")
+                estado["abierto_hasta"], estado["sondeo_desde"] = 0.0, None
+            return
+        
+        estado["fallos_seguidos"] += 1
+        recientes = self._recientes(estado, ahora)
+        errores = sum(1 for _, ok, _ in recientes if not ok)
+        if circuito == "semiabierto" or (circuito == "cerrado" and (
+            estado["fallos_seguidos"] >= CIRCUITO_FALLOS_SEGUIDOS
+            or (len(recientes) >= CIRCUITO_MIN_LLAMADAS and errores / len(recientes) >= CIRCUITO_TASA_ERROR)
+        )):
+            print(f"⛔ Circuito de {modelo} abierto por {CIRCUITO_ABIERTO_S} s")
+            estado["abierto_hasta"] = ahora + CIRCUITO_ABIERTO_S
+            estado["sondeo_desde"] = None
+            estado["aperturas"] += 1
+            estado["muestras"].clear()  # Tras cerrarse, la ventana empieza de cero
+
+    def estado(self) -> dict:
+        ahora = time.monotonic()
+        modelos = {}
+        for modelo, estado in self._modelos.items():
+            recientes = self._recientes(estado, ahora)
+            latencias = [ms for _, exito, ms in recientes if exito]
+            errores = sum(1 for _, exito, _ in recientes if not exito)
+            circuito = self._circuito(estado, ahora)
+            modelos[modelo] = {
+                "circuito": circuito,
+                "reabre_en_s": round(estado["abierto_hasta"] - ahora, 1) if circuito == "abierto" else None,
+                "llamadas": len(recientes),
+                "tasa_error": round(errores / len(recientes), 3) if recientes else None,
+                "latencia_ms": {"p50": _percentil(latencias, 50), "p95": _percentil(latencias, 95)},
+                "fallos_seguidos": estado["fallos_seguidos"],
+                "aperturas": estado["aperturas"],
+            }
+        return {
+            "ventana_s": RUTEO_VENTANA_S,
+            "modelos": modelos,
+            "primera_eleccion": self.decisiones,
+            "sin_modelos_disponibles": self.sin_modelos,
+        }
+
+ruteador_gemini = RuteadorModelos()
+
+async def generar_contenido(modelo_id: str, prompt: str, configuracion: dict) -> str:
+    """Una llamada a Gemini sin bloquear el event loop; TimeoutError si supera GEMINI_TIMEOUT_S"""
+    inicio = time.perf_counter()
+    async with semaforo_gemini:
+        metricas_gemini["esperas_ms"].append((time.perf_counter() - inicio) * 1000)
+        metricas_gemini["llamadas"] += 1
+        metricas_gemini["en_curso"] += 1
+        inicio = time.perf_counter()
+        try:
+            modelo = genai.GenerativeModel(modelo_id)
+            respuesta = await asyncio.wait_for(
+                modelo.generate_content_async(prompt, generation_config=configuracion),
+                GEMINI_TIMEOUT_S,
+            )
+            latencia_ms = (time.perf_counter() - inicio) * 1000
+            metricas_gemini["latencias_ms"].append(latencia_ms)
+            ruteador_gemini.registrar(modelo_id, True, latencia_ms)
+            return respuesta.text.strip()
+        except asyncio.TimeoutError:
+            metricas_gemini["timeouts"] += 1
+            ruteador_gemini.registrar(modelo_id, False)
+            raise
+        except Exception:
+            metricas_gemini["errores"] += 1
+            ruteador_gemini.registrar(modelo_id, False)
+            raise
+        finally:
+            metricas_gemini["en_curso"] -= 1
+
+def estado_gemini() -> dict:
+    """Concurrencia y tiempos recientes de las llamadas a Gemini"""
+    esperas = list(metricas_gemini["esperas_ms"])
+    latencias = list(metricas_gemini["latencias_ms"])
+    return {
+        "max_concurrencia": GEMINI_MAX_CONCURRENCIA,
+        "timeout_s": GEMINI_TIMEOUT_S,
+        "llamadas": metricas_gemini["llamadas"],
+        "en_curso": metricas_gemini["en_curso"],
+        "errores": metricas_gemini["errores"],
+        "timeouts": metricas_gemini["timeouts"],
+        "espera_ms": {"p50": _percentil(esperas, 50), "p95": _percentil(esperas, 95)},
+        "latencia_ms": {"p50": _percentil(latencias, 50), "p95": _percentil(latencias, 95)},
+    }
+
+async def analizar_con_gemini(texto: str) -> dict:
     """
     Analizar texto con Gemini y extraer campos médicos
     Incluye fallback heurístico si Gemini falla
@@ -224,20 +700,12 @@ Texto a analizar:
 \"\"\"
 """
     
-    # Elegir modelos válidos
-    if MODELOS_GEMINI_DISPONIBLES:
-        modelos = [m for m in MODELOS_GEMINI_PREFERIDOS if m in MODELOS_GEMINI_DISPONIBLES]
-        if not modelos:
-            modelos = MODELOS_GEMINI_DISPONIBLES[:3]
-    else:
-        modelos = MODELOS_GEMINI_PREFERIDOS
-    
-    for modelo_id in modelos:
+    for modelo_id in ruteador_gemini.ordenar(modelos_candidatos()):
         try:
-            modelo = genai.GenerativeModel(modelo_id)
-            respuesta = modelo.generate_content(
+            salida = await generar_contenido(
+                modelo_id,
                 prompt,
-                generation_config={
+                {
                     "temperature": 0.15,
                     "top_p": 0.8,
                     "top_k": 40,
@@ -245,8 +713,6 @@ Texto a analizar:
                 }
             )
             
-            salida = respuesta.text.strip()
-            
             # Extraer JSON del texto
             if "{" in salida and "}" in salida:
                 inicio = salida.find("{")
@@ -273,6 +739,9 @@ Texto a analizar:
                 except json.JSONDecodeError:
                     continue
                     
+        except asyncio.TimeoutError:
+            print(f"⏱️ Timeout con {modelo_id} ({GEMINI_TIMEOUT_S} s)")
+            continue
         except Exception as e:
             print(f"❌ Error con {modelo_id}: {str(e)}")
             continue
@@ -758,29 +1227,21 @@ def _normalizar_campos(tipo: str, campos: Dict[str, Any]) -> Dict[str, Any]:
             resultado["telefono"] = valor
     return resultado
 
-def analizar_extraccion(texto: str, tipo: str) -> dict:
+async def analizar_extraccion(texto: str, tipo: str) -> dict:
     prompt = construir_prompt_extraccion(texto, tipo)
 
-    if MODELOS_GEMINI_DISPONIBLES:
-        modelos = [m for m in MODELOS_GEMINI_PREFERIDOS if m in MODELOS_GEMINI_DISPONIBLES]
-        if not modelos:
-            modelos = MODELOS_GEMINI_DISPONIBLES[:3]
-    else:
-        modelos = MODELOS_GEMINI_PREFERIDOS
-
-    for modelo_id in modelos:
+    for modelo_id in ruteador_gemini.ordenar(modelos_candidatos()):
         try:
-            modelo = genai.GenerativeModel(modelo_id)
-            respuesta = modelo.generate_content(
+            salida = await generar_contenido(
+                modelo_id,
                 prompt,
-                generation_config={
+                {
                     "temperature": 0.1,
                     "top_p": 0.8,
                     "top_k": 40,
                     "max_output_tokens": 1024,
                 }
             )
-            salida = respuesta.text.strip()
             datos = _extraer_json_salida(salida)
             if not datos:
                 continue
@@ -797,6 +1258,9 @@ def analizar_extraccion(texto: str, tipo: str) -> dict:
                 "modelo_usado": modelo_id,
                 "confianza": 0.9,
             }
+        except asyncio.TimeoutError:
+            print(f"Timeout con {modelo_id} ({GEMINI_TIMEOUT_S} s)")
+            continue
         except Exception as e:
             print(f"Error con {modelo_id}: {str(e)}")
             continue
@@ -808,6 +1272,13 @@ def analizar_extraccion(texto: str, tipo: str) -> dict:
             heur["campos"][k] = "No especificado"
     return heur
 
+# ==================== EVENTOS ====================
+
+@app.on_event("startup")
+async def iniciar():
+    # Sin bloquear el arranque si MongoDB aún no responde
+    asyncio.create_task(_crear_indices_ia())
+
 # ==================== ENDPOINTS ====================
 
 @app.get("/", tags=["General"])
@@ -823,6 +1294,16 @@ async def verificar_salud():
     except Exception as e:
         raise HTTPException(status_code=503, detail=str(e))
 
+@app.get("/metricas", tags=["General"])
+async def obtener_metricas():
+    """Métricas operativas del servicio (llamadas a Gemini, ruteo de modelos, caché y coalescencia)"""
+    return respuesta_ok({
+        "gemini": estado_gemini(),
+        "ruteo_modelos": ruteador_gemini.estado(),
+        "cache": estado_cache(),
+        "coalescencia": coalescedor_ia.estado(),
+    })
+
 @app.post("/api/v1/ia/analizar", response_model=RespuestaAnalisis, tags=["Análisis IA"])
 async def analizar_texto(
     solicitud: SolicitudAnalisis,
@@ -848,15 +1329,18 @@ async def analizar_texto(
             resultado = resultado_cache
             tiempo_ms = 10  # Caché es casi instantáneo
         else:
-            # Analizar con IA
-            resultado = analizar_con_gemini(solicitud.texto)
-            tiempo_ms = int((datetime.now(timezone.utc) - inicio).total_seconds() * 1000)
+            # Analizar con IA y guardar en caché (una sola vez por texto en curso)
+            async def calcular():
+                resultado = await analizar_con_gemini(solicitud.texto)
+                if resultado_cacheable(resultado):
+                    await guardar_en_cache(hash_texto, resultado, solicitud.texto)
+                return resultado
             
-            # Guardar en caché
-            await guardar_en_cache(hash_texto, resultado, solicitud.texto)
+            resultado, desde_cache = await coalescedor_ia.ejecutar(hash_texto, calcular)
+            tiempo_ms = int((datetime.now(timezone.utc) - inicio).total_seconds() * 1000)
     else:
         # Forzar análisis sin caché
-        resultado = analizar_con_gemini(solicitud.texto)
+        resultado = await analizar_con_gemini(solicitud.texto)
         tiempo_ms = int((datetime.now(timezone.utc) - inicio).total_seconds() * 1000)
     
     # Registrar uso
@@ -891,11 +1375,16 @@ async def extraer_campos(
             resultado = resultado_cache
             tiempo_ms = 10
         else:
-            resultado = analizar_extraccion(solicitud.texto, tipo)
+            async def calcular():
+                resultado = await analizar_extraccion(solicitud.texto, tipo)
+                if resultado_cacheable(resultado):
+                    await guardar_en_cache(hash_texto, resultado, solicitud.texto)
+                return resultado
+
+            resultado, desde_cache = await coalescedor_ia.ejecutar(hash_texto, calcular)
             tiempo_ms = int((datetime.now(timezone.utc) - inicio).total_seconds() * 1000)
-            await guardar_en_cache(hash_texto, resultado, solicitud.texto)
     else:
-        resultado = analizar_extraccion(solicitud.texto, tipo)
+        resultado = await analizar_extraccion(solicitud.texto, tipo)
         tiempo_ms = int((datetime.now(timezone.utc) - inicio).total_seconds() * 1000)
 
     await registrar_log_ia(
@@ -917,25 +1406,20 @@ async def obtener_estadisticas_ia(
     
     id_usuario = int(datos_usuario.get("sub"))
     
-    # Contar análisis totales
-    total = await coleccion_logs_ia.count_documents({"id_usuario": id_usuario})
-    
-    # Contar desde caché
-    desde_cache = await coleccion_logs_ia.count_documents({
-        "id_usuario": id_usuario,
-        "desde_cache": True
-    })
-    
-    # Tiempo promedio
+    # Un solo recorrido del índice usuario_fecha: totales, desde caché y tiempo promedio
     pipeline = [
         {"$match": {"id_usuario": id_usuario}},
         {"$group": {
             "_id": None,
+            "total": {"$sum": 1},
+            "desde_cache": {"$sum": {"$cond": ["$desde_cache", 1, 0]}},
             "tiempo_promedio": {"$avg": "$tiempo_ms"}
         }}
     ]
     resultado = await coleccion_logs_ia.aggregate(pipeline).to_list(1)
-    tiempo_promedio = int(resultado[0].get("tiempo_promedio", 0)) if resultado else 0
+    total = resultado[0]["total"] if resultado else 0
+    desde_cache = resultado[0]["desde_cache"] if resultado else 0
+    tiempo_promedio = int(resultado[0].get("tiempo_promedio") or 0) if resultado else 0
     
     return respuesta_ok({"total_analisis": total, "desde_cache": desde_cache, "nuevos_analisis": total - desde_cache, "tiempo_promedio_ms": tiempo_promedio, "porcentaje_cache": round((desde_cache / total * 100), 2) if total > 0 else 0})
 
@@ -943,11 +1427,13 @@ async def obtener_estadisticas_ia(
 async def limpiar_cache(
     datos_usuario: dict = Depends(verificar_token)
 ):
-    """Limpiar caché antiguo (más de 7 días)"""
+    """
+    Limpiar caché antiguo (más de CACHE_IA_DIAS días). El índice TTL ya lo borra
+    automáticamente; esto fuerza la limpieza sin esperar al monitor de TTL.
+    """
     
-    fecha_limite = datetime.now(timezone.utc)
-    from datetime import timedelta
-    fecha_limite = fecha_limite - timedelta(days=7)
+    fecha_limite = datetime.now(timezone.utc) - DURACION_CACHE_IA
+    cache_memoria_ia.eliminar_vencidos()
     
     resultado = await coleccion_cache_ia.delete_many({
         "fecha_creacion": {"$lt": fecha_limite}
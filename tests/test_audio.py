@@ -1,9 +1,11 @@
 """
 Tests del microservicio de Audio: subida, estado, listado.
-Mocks: MinIO, Whisper, MongoDB.
+Mocks: Whisper, MongoDB. Almacenamiento local (sistema de archivos) en lugar de MinIO.
 """
+import asyncio
 import os
 import sys
+from contextlib import ExitStack, contextmanager
 from io import BytesIO
 from unittest.mock import AsyncMock, MagicMock, patch
 
@@ -13,9 +15,35 @@ from fastapi.testclient import TestClient
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "servicios", "audio"))
 
 # Mock Whisper load_model antes de import (se ejecuta a nivel de módulo)
-with patch("whisper.load_model") as _:
+# Cola en memoria y almacenamiento local para no depender de Redis ni MinIO;
+# inferencia en hilos (el Whisper simulado no existe en procesos hijos)
+with patch("whisper.load_model") as _, patch.dict(os.environ, {"COLA_BACKEND": "memoria", "ALMACENAMIENTO_BACKEND": "local",
+                                                       "PROCESOS_TRANSCRIPCION": "0"}):
     _.return_value = MagicMock(transcribe=MagicMock(return_value={"text": "Transcripción de prueba."}))
     import main as audio_main  # noqa: E402
+    import inferencia  # noqa: E402
+    import almacenamiento as audio_almacenamiento  # noqa: E402
+    import base_datos as audio_base_datos  # noqa: E402
+    import cola as audio_cola  # noqa: E402
+    import estados as audio_estados  # noqa: E402
+    import pipeline as audio_pipeline  # noqa: E402
+    import en_vivo as audio_en_vivo  # noqa: E402
+
+MODULOS_AUDIO = (audio_main, audio_almacenamiento, audio_base_datos, audio_cola, audio_estados, audio_pipeline, audio_en_vivo)
+
+
+@contextmanager
+def reemplazar(nombre, valor):
+    """Reemplazar un objeto compartido (colección, almacenamiento, cola) en cada módulo que lo importa"""
+    with ExitStack() as pila:
+        for modulo in MODULOS_AUDIO:
+            if hasattr(modulo, nombre):
+                pila.enter_context(patch.object(modulo, nombre, valor))
+        yield valor
+
+
+# Cabecera WAV mínima (RIFF/WAVE) seguida de datos
+WAV_PRUEBA = b"RIFF\x24\x00\x00\x00WAVEfmt " + b"\x00" * 64
 
 
 @pytest.fixture
@@ -26,7 +54,9 @@ def mock_mongo():
         inserted["doc"] = doc
         return MagicMock(inserted_id=doc.get("_id", "id"))
 
-    async def find_one(query):
+    async def find_one(query, *args, **kwargs):
+        if "hash_contenido" in query and inserted.get("doc", {}).get("hash_contenido") != query["hash_contenido"]:
+            return None
         if inserted.get("doc"):
             d = inserted["doc"].copy()
             d["nombre_objeto_s3"] = "obj123"
@@ -37,32 +67,42 @@ def mock_mongo():
     async def update_one(*args, **kwargs):
         return None
 
+    async def count_documents(*args, **kwargs):
+        return col.en_curso_usuario
+
+    cache = {}
+
+    async def cache_find_one(query):
+        if "_id" in query:
+            return cache.get(query["_id"])
+        return next((c for c in cache.values() if c["hash_contenido"] == query["hash_contenido"]), None)
+
+    async def cache_update_one(filtro, cambios, upsert=False):
+        cache.setdefault(filtro["_id"], {"_id": filtro["_id"], **cambios["$setOnInsert"]})
+
     col = MagicMock()
+    col.inserted = inserted
     col.insert_one = insert_one
     col.find_one = find_one
     col.update_one = update_one
-    with patch.object(audio_main, "coleccion_audios", col):
+    col.count_documents = count_documents
+    col.en_curso_usuario = 0
+    col_cache = MagicMock(find_one=cache_find_one, update_one=cache_update_one)
+    with reemplazar("coleccion_audios", col), \
+            reemplazar("coleccion_cache_transcripciones", col_cache):
         yield col
 
 
 @pytest.fixture
-def mock_minio():
-    with patch.object(audio_main, "cliente_minio") as m:
-        client = MagicMock()
-        client.bucket_exists.return_value = True
-        client.put_object.return_value = None
-        client.get_object.return_value = MagicMock(
-            read=MagicMock(return_value=b"fake"),
-            close=MagicMock(),
-            release_conn=MagicMock(),
-        )
-        client.remove_object.return_value = None
-        m.return_value = client
-        yield client
+def almacenamiento(tmp_path):
+    local = audio_almacenamiento.AlmacenamientoLocal(audio_almacenamiento.BUCKET_MINIO, str(tmp_path))
+    local.raiz.mkdir(parents=True)
+    with reemplazar("almacenamiento", local):
+        yield local
 
 
 @pytest.fixture
-def client(mock_mongo, mock_minio):
+def client(mock_mongo, almacenamiento):
     with TestClient(audio_main.app) as c:
         yield c
 
@@ -94,7 +134,7 @@ def test_subir_audio(client, token):
     r = client.post(
         "/api/v1/audio/subir",
         headers={"Authorization": f"Bearer {token}"},
-        files={"archivo": ("grabacion.wav", BytesIO(b"fake audio content"), "audio/wav")},
+        files={"archivo": ("grabacion.wav", BytesIO(WAV_PRUEBA), "audio/wav")},
     )
     assert r.status_code == 200
     body = r.json()
@@ -102,6 +142,669 @@ def test_subir_audio(client, token):
     assert body.get("estado") == "pendiente"
 
 
+def test_subir_audio_streaming_a_almacenamiento(client, token, mock_mongo, almacenamiento):
+    contenido = WAV_PRUEBA + b"\x01" * 200_000
+    r = client.post(
+        "/api/v1/audio/subir",
+        headers={"Authorization": f"Bearer {token}"},
+        files={"archivo": ("grabacion.wav", BytesIO(contenido), "audio/wav")},
+    )
+    assert r.status_code == 200
+    nombre_objeto = mock_mongo.inserted["doc"]["nombre_objeto_s3"]
+    assert (almacenamiento.raiz / nombre_objeto).read_bytes() == contenido
+
+
+def test_subir_audio_repetido_reutiliza_objeto_y_transcripcion(client, token, mock_mongo, almacenamiento):
+    import hashlib
+    contenido = WAV_PRUEBA + b"\x02" * 1000
+    subir = lambda: client.post(
+        "/api/v1/audio/subir",
+        headers={"Authorization": f"Bearer {token}"},
+        files={"archivo": ("grabacion.wav", BytesIO(contenido), "audio/wav")},
+    )
+    assert subir().json()["estado"] == "pendiente"
+    hash_contenido = hashlib.sha256(contenido).hexdigest()
+    assert mock_mongo.inserted["doc"]["hash_contenido"] == hash_contenido
+
+    clave = audio_pipeline.clave_cache_transcripcion(hash_contenido, audio_pipeline.parametros_transcripcion())
+    asyncio.run(audio_pipeline.guardar_transcripcion_cache(clave, hash_contenido, "original", {}, {
+        "transcripcion": "Hola.", "transcripcion_raw": "hola", "segmentos": [], "duracion_segundos": 1.0,
+    }))
+
+    r = subir()
+    assert r.json()["estado"] == "completado"
+    doc = mock_mongo.inserted["doc"]
+    assert doc["transcripcion"] == "Hola." and doc["id_audio_origen"] == "original"
+    assert doc["nombre_objeto_s3"] == "obj123"  # objeto ya existente
+    assert len(list(almacenamiento.raiz.iterdir())) == 1  # el duplicado se eliminó
+
+
+def test_buscar_cache_usa_la_ruta_de_cola_del_worker(mock_mongo):
+    # Transcrito con el modelo rápido porque la cola estaba degradada
+    clave = audio_pipeline.clave_cache_transcripcion("h1", audio_pipeline.parametros_transcripcion("rapido"))
+    with patch.object(audio_pipeline, "COLA_PROFUNDIDAD_DEGRADAR", 5), \
+            patch.object(audio_pipeline, "WHISPER_MODELO_RAPIDO", "rapido"), \
+            patch.object(audio_pipeline, "RUTAS_DURACION", []):
+        asyncio.run(audio_pipeline.guardar_transcripcion_cache(clave, "h1", "original", {}, {
+            "transcripcion": "Hola.", "transcripcion_raw": "hola", "segmentos": [], "duracion_segundos": 1.0,
+        }))
+        buscar = audio_pipeline.buscar_transcripcion_cache
+        assert asyncio.run(buscar("h1", pendientes=10))["_id"] == clave  # el worker enrutaría al rápido
+        assert asyncio.run(buscar("h1", pendientes=0)) is None  # el worker usaría el modelo normal
+        assert asyncio.run(buscar("h1"))["_id"] == clave  # al subir: cualquier modelo elegible
+
+
+def test_subir_audio_rechaza_contenido_no_audio(client, token):
+    r = client.post(
+        "/api/v1/audio/subir",
+        headers={"Authorization": f"Bearer {token}"},
+        files={"archivo": ("grabacion.wav", BytesIO(b"<html>no es audio</html>"), "audio/wav")},
+    )
+    assert r.status_code == 415
+
+
+def test_subir_audio_excede_tamano(client, token):
+    with patch.object(audio_main, "MAX_TAMANO_AUDIO_BYTES", 32):
+        r = client.post(
+            "/api/v1/audio/subir",
+            headers={"Authorization": f"Bearer {token}"},
+            files={"archivo": ("grabacion.wav", BytesIO(WAV_PRUEBA), "audio/wav")},
+        )
+    assert r.status_code == 413
+
+
 def test_listar_sin_token(client):
     r = client.get("/api/v1/audio/usuario/listar")
     assert r.status_code == 403
+
+
+def test_cola_prioridad_y_orden_llegada():
+    async def escenario():
+        cola = audio_cola.ColaTrabajosMemoria(segundos_lease=60)
+        for id_trabajo, prioridad, t in [("a", 0, 1.0), ("b", 0, 2.0), ("c", 5, 3.0)]:
+            await cola.encolar({"id_trabajo": id_trabajo, "id_audio": id_trabajo, "encolado_en": t,
+                                "puntaje": audio_cola._puntaje_trabajo(prioridad, t)})
+        assert not await cola.encolar({"id_trabajo": "a", "id_audio": "a", "encolado_en": 4.0, "puntaje": 4.0})
+        return [(await cola.reservar())["id_trabajo"] for _ in range(3)], await cola.reservar()
+
+    orden, vacio = asyncio.run(escenario())
+    assert orden == ["c", "a", "b"]
+    assert vacio is None
+
+
+def test_cola_lease_vencido_se_reencola_y_agota():
+    async def escenario():
+        cola = audio_cola.ColaTrabajosMemoria(segundos_lease=0)
+        await cola.encolar({"id_trabajo": "x", "id_audio": "x", "encolado_en": 1.0, "puntaje": 1.0})
+        primero = await cola.reservar()
+        reencolados, agotados = await cola.recuperar_vencidos(max_intentos=2)
+        segundo = await cola.reservar()
+        reencolados2, agotados2 = await cola.recuperar_vencidos(max_intentos=2)
+        return primero, reencolados, segundo, agotados2, await cola.profundidad()
+
+    primero, reencolados, segundo, agotados, profundidad = asyncio.run(escenario())
+    assert primero["intentos"] == 1 and [t["id_trabajo"] for t in reencolados] == ["x"]
+    assert segundo["intentos"] == 2 and [t["id_trabajo"] for t in agotados] == ["x"]
+    assert profundidad == {"pendientes": 0, "en_curso": 0}
+
+
+def test_pcm16_a_float32():
+    import numpy as np
+    pcm = np.array([0, 16384, -32768, 32767], dtype=np.int16).tobytes()
+    audio = audio_pipeline.pcm16_a_float32(pcm)
+    assert audio.dtype == np.float32
+    assert audio.tolist() == [0.0, 0.5, -1.0, 32767 / 32768]
+
+
+@pytest.fixture
+def audio_guardado(mock_mongo, almacenamiento):
+    contenido = bytes(range(256)) * 4
+
+    async def find_one(query, *args, **kwargs):
+        return {"_id": "a1", "id_usuario": 1, "nombre_objeto_s3": "obj123",
+                "nombre_archivo_original": "test.wav", "tipo_contenido": "audio/wav"}
+
+    mock_mongo.find_one = find_one
+    (almacenamiento.raiz / "obj123").write_bytes(contenido)
+    return contenido
+
+
+def test_descargar_rango_parcial(client, token, audio_guardado):
+    r = client.get("/api/v1/audio/a1/descargar",
+                   headers={"Authorization": f"Bearer {token}", "Range": "bytes=100-199"})
+    assert r.status_code == 206
+    assert r.content == audio_guardado[100:200]
+    assert r.headers["content-range"] == f"bytes 100-199/{len(audio_guardado)}"
+    assert r.headers["etag"]
+
+    r = client.get("/api/v1/audio/a1/descargar",
+                   headers={"Authorization": f"Bearer {token}", "Range": "bytes=5000-"})
+    assert r.status_code == 416
+
+
+def test_descargar_condicional_etag(client, token, audio_guardado):
+    etag = client.head("/api/v1/audio/a1/descargar", headers={"Authorization": f"Bearer {token}"}).headers["etag"]
+    r = client.get("/api/v1/audio/a1/descargar",
+                   headers={"Authorization": f"Bearer {token}", "If-None-Match": etag})
+    assert r.status_code == 304
+    r = client.get("/api/v1/audio/a1/descargar", headers={"Authorization": f"Bearer {token}"})
+    assert r.status_code == 200
+    assert r.content == audio_guardado
+
+
+def test_segmentar_por_silencio_corta_en_silencios():
+    import numpy as np
+    sr = inferencia.FRECUENCIA_MUESTREO
+    rng = np.random.default_rng(0)
+    voz = lambda s: (0.3 * rng.standard_normal(int(s * sr))).astype(np.float32)
+    silencio = lambda s: np.zeros(int(s * sr), dtype=np.float32)
+    audio = np.concatenate([voz(20), silencio(1), voz(20), silencio(1), voz(5), silencio(40)])
+
+    rangos = audio_pipeline.segmentar_por_silencio(audio, max_segundos=30)
+
+    assert len(rangos) == 3
+    assert all((fin - inicio) / sr <= 30 for inicio, fin in rangos)
+    cortes = [inicio / sr for inicio, _ in rangos[1:]]
+    assert 20 < cortes[0] < 21 and 41 < cortes[1] < 42
+
+
+def test_subida_en_streaming_no_bloquea_otras_operaciones(tmp_path):
+    local = audio_almacenamiento.AlmacenamientoLocal(audio_almacenamiento.BUCKET_MINIO, str(tmp_path), hilos=1)
+    local.raiz.mkdir(parents=True)
+    (local.raiz / "existente").write_bytes(b"x" * 10)
+
+    async def escenario():
+        # La subida queda abierta (como una sesión en vivo) y ocupa su hilo
+        subida = local.subida_en_streaming("en-curso", "audio/wav")
+        await subida.entregar(b"parcial")
+        info = await asyncio.wait_for(local.info("existente"), 2)
+        await subida.finalizar()
+        return info
+
+    try:
+        assert asyncio.run(escenario())["tamano"] == 10
+    finally:
+        local.cerrar()
+    assert (local.raiz / "en-curso").read_bytes() == b"parcial"
+
+
+def test_eliminar_audio_conserva_artefactos_compartidos(client, token, mock_mongo, almacenamiento):
+    # El original es compartido con un duplicado; el PCM es solo de este audio
+    doc = {"_id": "a1", "id_usuario": 1, "nombre_objeto_s3": "original", "nombre_objeto_pcm": "propio.pcm"}
+    compartidos = {("nombre_objeto_s3", "original")}
+
+    async def find_one(query, *args, **kwargs):
+        return dict(doc)
+
+    async def count_documents(filtro, **kwargs):
+        assert filtro["_id"] == {"$ne": "a1"}
+        return int(any((campo, valor) in compartidos for campo, valor in filtro.items() if campo != "_id"))
+
+    async def delete_one(*args, **kwargs):
+        return None
+
+    mock_mongo.find_one = find_one
+    mock_mongo.count_documents = count_documents
+    mock_mongo.delete_one = delete_one
+    (almacenamiento.raiz / "original").write_bytes(WAV_PRUEBA)
+    (almacenamiento.raiz / "propio.pcm").write_bytes(b"\x00" * 16)
+
+    r = client.delete("/api/v1/audio/a1", headers={"Authorization": f"Bearer {token}"})
+    assert r.status_code == 200
+    assert (almacenamiento.raiz / "original").exists()
+    assert not (almacenamiento.raiz / "propio.pcm").exists()
+
+
+def test_transcripcion_en_vivo_pcm16(client, token, mock_mongo, almacenamiento):
+    pcm = b"\x00\x10" * inferencia.FRECUENCIA_MUESTREO * 3  # 3 s de PCM16
+    r = client.post("/api/v1/audio/en-vivo/token", headers={"Authorization": f"Bearer {token}"})
+    assert r.status_code == 200
+    token_en_vivo = r.json()["datos"]["token"]
+    with client.websocket_connect(f"/api/v1/audio/en-vivo?token={token_en_vivo}&formato=pcm16") as ws:
+        for i in range(0, len(pcm), 16000):
+            ws.send_bytes(pcm[i:i + 16000])
+        ws.send_json({"evento": "fin"})
+        mensaje = ws.receive_json()
+        while mensaje["tipo"] == "parcial":
+            mensaje = ws.receive_json()
+
+    assert mensaje["tipo"] == "final"
+    assert mensaje["transcripcion_raw"] == "Transcripción de prueba."
+    assert mensaje["duracion_segundos"] == 3.0
+    doc = mock_mongo.inserted["doc"]
+    assert doc["tipo_contenido"] == "audio/wav"
+    guardado = (almacenamiento.raiz / doc["nombre_objeto_s3"]).read_bytes()
+    assert guardado[:4] == b"RIFF" and guardado.endswith(pcm)
+
+
+def test_transcripcion_en_vivo_sin_token(client):
+    from starlette.websockets import WebSocketDisconnect
+    with pytest.raises(WebSocketDisconnect) as error:
+        with client.websocket_connect("/api/v1/audio/en-vivo?formato=pcm16") as ws:
+            ws.receive_json()
+    assert error.value.code == 1008
+
+
+def test_transcripcion_en_vivo_rechaza_token_de_acceso_en_url(client, token):
+    from starlette.websockets import WebSocketDisconnect
+    with pytest.raises(WebSocketDisconnect) as error:
+        with client.websocket_connect(f"/api/v1/audio/en-vivo?token={token}&formato=pcm16") as ws:
+            ws.receive_json()
+    assert error.value.code == 1008
+
+
+def test_planificador_lotes_agrupa_solicitudes():
+    import numpy as np
+    lotes = []
+
+    def transcribir_lote(audios, desplazamientos, opciones, modelo):
+        lotes.append(len(audios))
+        return [{"texto": f"s{len(a)}", "segmentos": []} for a in audios]
+
+    async def escenario():
+        planificador = audio_pipeline.PlanificadorLotes(max_tamano=2, max_espera_s=0.05)
+        audios = [np.zeros(n, dtype=np.float32) for n in (1, 2, 3)]
+        try:
+            return await asyncio.gather(*[planificador.transcribir(a, 0.0, {"language": "es"}) for a in audios])
+        finally:
+            planificador.detener()
+
+    with patch.object(audio_pipeline, "_transcribir_lote", transcribir_lote):
+        resultados = asyncio.run(escenario())
+
+    assert [r["texto"] for r in resultados] == ["s1", "s2", "s3"]
+    assert lotes == [2, 1]
+
+
+@pytest.fixture
+def whisper_aleatorio():
+    """Whisper diminuto con pesos aleatorios: determinista y sin descargas"""
+    import torch
+    from whisper.model import ModelDimensions, Whisper
+    torch.manual_seed(0)
+    dims = ModelDimensions(n_mels=80, n_audio_ctx=1500, n_audio_state=64, n_audio_head=2, n_audio_layer=1,
+                           n_vocab=51865, n_text_ctx=448, n_text_state=64, n_text_head=2, n_text_layer=1)
+    return Whisper(dims).eval()
+
+
+@pytest.mark.parametrize("respaldo", [True, False])
+def test_lote_openai_whisper_coincide_con_transcribe(whisper_aleatorio, respaldo):
+    import numpy as np
+    rng = np.random.default_rng(0)
+    audios = [
+        (0.3 * np.sin(2 * np.pi * 220 * np.arange(s * 16000) / 16000) + 0.05 * rng.standard_normal(s * 16000)).astype(np.float32)
+        for s in (3, 7)
+    ]
+    opciones = {**inferencia.opciones_whisper(), "fp16": False, "beam_size": 1, "best_of": 1, "temperature": 0.0,
+                "condition_on_previous_text": False}
+    motor = inferencia.MotorOpenAIWhisper()
+    # respaldo=False fuerza a aceptar la primera pasada del lote (sin reintentos con transcribe())
+    with patch.object(inferencia.MotorOpenAIWhisper, "_requiere_respaldo",
+                      staticmethod(lambda r: True) if respaldo else staticmethod(lambda r: False)), \
+            patch.object(inferencia.MotorOpenAIWhisper, "_sin_voz", staticmethod(lambda r: False)):
+        en_lote = motor.transcribir_lote(whisper_aleatorio, audios, opciones)
+    individual = [motor.transcribir(whisper_aleatorio, a, opciones) for a in audios]
+
+    assert [r["texto"] for r in en_lote] == [r["texto"] for r in individual]
+
+
+@pytest.mark.parametrize("conservar", [True, False])
+def test_reutilizar_objeto_sin_original_solo_si_ya_fue_ingerido(almacenamiento, conservar):
+    existente = {"nombre_objeto_s3": "a.webm", "nombre_objeto_pcm": "a.webm.16k.wav",
+                 "nombre_objeto_opus": "a.webm.opus", "original_eliminado": True}
+    coleccion = MagicMock(find_one=AsyncMock(return_value=existente))
+    recibido = {"hash_contenido": "h", "nombre_objeto": "b.webm"}
+    with patch.object(audio_pipeline, "coleccion_audios", coleccion), \
+            patch.object(audio_pipeline, "INGESTA_CONSERVAR_ORIGINAL", conservar):
+        assert asyncio.run(audio_pipeline.reutilizar_objeto_existente(recibido)) is True
+
+    filtro = coleccion.find_one.call_args.args[0]
+    # Si la ingesta borra originales, un audio sin ingerir no se comparte (su original puede desaparecer)
+    assert ("nombre_objeto_pcm" in filtro) is not conservar
+    assert recibido["nombre_objeto"] == "a.webm"
+    assert recibido["ingesta"]["nombre_objeto_pcm"] == "a.webm.16k.wav"
+
+
+def test_enrutar_modelo_por_calidad_cola_y_duracion():
+    with patch.object(audio_pipeline, "RUTAS_DURACION", [(60.0, "small"), (600.0, "base")]), \
+            patch.object(audio_pipeline, "WHISPER_MODELO_CALIDAD", "medium"), \
+            patch.object(audio_pipeline, "WHISPER_MODELO_RAPIDO", "tiny"), \
+            patch.object(audio_pipeline, "COLA_PROFUNDIDAD_DEGRADAR", 10):
+        assert audio_pipeline.enrutar_modelo(30) == ("small", "duracion")
+        assert audio_pipeline.enrutar_modelo(300) == ("base", "duracion")
+        assert audio_pipeline.enrutar_modelo(3600)[1] == "defecto"
+        assert audio_pipeline.enrutar_modelo(30, pendientes=10) == ("tiny", "cola")
+        assert audio_pipeline.enrutar_modelo(3600, calidad="alta", pendientes=10) == ("medium", "calidad")
+
+
+def test_registro_modelos_desaloja_lru_libre():
+    registro = inferencia.RegistroModelos(memoria_max_mb=1400)  # tiny 156 + small 976 + base 296
+    with patch("whisper.load_model", side_effect=lambda nombre: MagicMock(name=nombre)):
+        registro.obtener("tiny")
+        with registro.usar("small"):
+            registro.obtener("base")  # 156 + 976 + 296 > 1400: se desaloja "tiny"
+            assert registro.estado()["cargados"] == ["small", "base"]
+            registro.obtener("tiny")  # "small" está en uso: se desaloja "base"
+            assert registro.estado()["cargados"] == ["small", "tiny"]
+    assert registro.estado()["desalojos"] == 2
+
+
+def test_eventos_estado_sse_envia_estado_final(client, token, mock_mongo):
+    from datetime import datetime, timezone
+
+    async def find_one(query, *args, **kwargs):
+        return {"_id": "a1", "id_usuario": 1, "estado": "completado", "transcripcion": "Hola.",
+                "transcripcion_raw": "hola", "fecha_creacion": datetime.now(timezone.utc)}
+
+    mock_mongo.find_one = find_one
+    # El token de acceso no se acepta en la URL; solo el de corta duración para este audio
+    assert client.get(f"/api/v1/audio/a1/eventos?token={token}").status_code == 401
+    r = client.post("/api/v1/audio/a1/token-eventos", headers={"Authorization": f"Bearer {token}"})
+    assert r.status_code == 200
+    token_eventos = r.json()["datos"]["token"]
+    assert client.get(f"/api/v1/audio/otro/eventos?token={token_eventos}").status_code == 401
+    with client.stream("GET", f"/api/v1/audio/a1/eventos?token={token_eventos}") as r:
+        assert r.status_code == 200
+        assert r.headers["content-type"].startswith("text/event-stream")
+        cuerpo = "".join(r.iter_text())
+    assert "event: estado" in cuerpo and '"estado": "completado"' in cuerpo
+
+
+def test_actualizar_estado_notifica_suscriptores(mock_mongo):
+    from datetime import datetime, timezone
+
+    async def escenario():
+        cola = audio_estados.bus_estados.suscribir("a1")
+        try:
+            await audio_estados.actualizar_estado_audio("a1", {
+                "estado": "completado", "transcripcion": "Hola.", "segmentos": [],
+                "fecha_procesamiento": datetime(2024, 1, 1, tzinfo=timezone.utc),
+            })
+            return cola.get_nowait()
+        finally:
+            audio_estados.bus_estados.desuscribir("a1", cola)
+
+    cambios = asyncio.run(escenario())
+    assert cambios == {"estado": "completado", "transcripcion": "Hola.",
+                       "fecha_procesamiento": "2024-01-01T00:00:00+00:00"}
+
+
+def test_ingesta_normaliza_y_reutiliza_pcm(mock_mongo, almacenamiento):
+    import numpy as np
+    pcm = np.full(16000 * 3, 8192, dtype=np.int16).tobytes()
+    doc = {"_id": "a1", "nombre_objeto_s3": "obj123", "tamano_bytes": 1000}
+
+    with patch.object(audio_pipeline, "decodificar_pcm16_objeto", return_value=pcm) as decodificar, \
+            patch.object(audio_pipeline, "codificar_opus", return_value=b"OggS-opus"):
+        audio = asyncio.run(audio_pipeline.obtener_audio_para_inferencia(doc))
+        assert decodificar.call_count == 1
+        assert doc["duracion_segundos"] == 3.0
+        assert (almacenamiento.raiz / "obj123.opus").read_bytes() == b"OggS-opus"
+        wav = (almacenamiento.raiz / "obj123.16k.wav").read_bytes()
+        assert wav[:4] == b"RIFF" and wav[44:] == pcm
+
+        # La siguiente vez se lee el PCM normalizado sin volver a decodificar
+        de_nuevo = asyncio.run(audio_pipeline.obtener_audio_para_inferencia(doc))
+        assert decodificar.call_count == 1
+
+    assert len(audio) == len(de_nuevo) == 16000 * 3
+    assert np.allclose(de_nuevo, 0.25)
+    assert doc["nombre_objeto_pcm"] == "obj123.16k.wav"
+
+
+def test_preproceso_recorta_silencios_y_reubica_marcas():
+    import numpy as np
+    sr = inferencia.FRECUENCIA_MUESTREO
+    rng = np.random.default_rng(0)
+    tono = (0.01 * np.sin(2 * np.pi * 220 * np.arange(sr) / sr)).astype(np.float32)
+    ruido = lambda s: (rng.standard_normal(int(s * sr)) * 1e-4).astype(np.float32)  # noqa: E731
+    audio = np.concatenate([ruido(2), tono, ruido(3), tono, ruido(0.5), tono, ruido(2)])
+
+    reducido, info = audio_pipeline.preprocesar_audio(audio)
+
+    # Se quitan inicio, fin y el silencio interno largo; el corto (0,5 s) se conserva
+    assert len(info["tramos"]) == 2
+    assert 3.5 < info["duracion_efectiva_s"] < 4.5
+    assert info["segundos_recortados"] == round(10.5 - info["duracion_efectiva_s"], 2)
+    assert info["ganancia_db"] > 0 and np.max(np.abs(reducido)) <= 0.99
+
+    # Marca de tiempo en la señal reducida -> posición en el audio original
+    inicio_segundo_tono = info["tramos"][1][1] / sr + 0.2
+    segmentos = audio_pipeline.reubicar_segmentos([{"inicio": inicio_segundo_tono, "fin": inicio_segundo_tono}], info["tramos"])
+    assert abs(segmentos[0]["inicio"] - 6.0) < 0.05
+
+    vacio, info_vacio = audio_pipeline.preprocesar_audio(ruido(5))
+    assert len(vacio) == 0 and info_vacio["segundos_recortados"] == 5.0
+
+
+def test_listar_paginado_por_cursor(client, token, mock_mongo):
+    from datetime import datetime, timedelta
+    base = datetime(2024, 1, 1)
+    docs = [
+        {"_id": f"a{i}", "id_usuario": 1, "nombre_archivo_original": f"{i}.wav", "estado": "completado",
+         "fecha_creacion": base + timedelta(minutes=i // 2), "tiene_transcripcion": True}
+        for i in range(5)
+    ]
+    consultas = []
+
+    def find(filtro, proyeccion):
+        consultas.append((filtro, proyeccion))
+        resultado = sorted(docs, key=lambda d: (d["fecha_creacion"], d["_id"]), reverse=True)
+        if "$or" in filtro:
+            fecha, id_ultimo = filtro["$or"][1]["fecha_creacion"].replace(tzinfo=None), filtro["$or"][1]["_id"]["$lt"]
+            resultado = [d for d in resultado if (d["fecha_creacion"], d["_id"]) < (fecha, id_ultimo)]
+        cursor = MagicMock()
+        cursor.sort.return_value.limit.side_effect = lambda n: MagicMock(to_list=AsyncMock(return_value=resultado[:n]))
+        return cursor
+
+    mock_mongo.find = find
+    cabeceras = {"Authorization": f"Bearer {token}"}
+    paginas, cursor = [], None
+    while True:
+        r = client.get("/api/v1/audio/usuario/listar", params={"limite": 2, **({"cursor": cursor} if cursor else {})},
+                       headers=cabeceras)
+        assert r.status_code == 200
+        datos = r.json()["datos"]
+        paginas.append([a["id_audio"] for a in datos["audios"]])
+        cursor = datos["siguiente_cursor"]
+        if not cursor:
+            break
+
+    assert paginas == [["a4", "a3"], ["a2", "a1"], ["a0"]]
+    assert "transcripcion" not in consultas[0][1]
+    r = client.get("/api/v1/audio/usuario/listar", params={"cursor": "no-es-un-cursor"}, headers=cabeceras)
+    assert r.status_code == 400
+
+
+def test_benchmark_wer_y_matriz():
+    import benchmark
+    assert benchmark.tasa_error_palabras(
+        ["Paciente con dolor torácico.", "Tensión arterial normal"],
+        ["paciente con dolor toracico", "tension normal alta"],
+    ) == round(2 / 7, 4)
+    matriz = benchmark.expandir_matriz({"modelos": ["tiny", "base"], "beam": ["1", "3"]})
+    assert len(matriz) == 4
+    assert {"WHISPER_MODELO": "base", "WHISPER_BEAM_SIZE": "1"} in matriz
+
+
+def test_benchmark_rss_suma_procesos_hijos():
+    import subprocess
+    import time
+    import benchmark
+    hijo = subprocess.Popen([sys.executable, "-c", "import time; x = bytearray(64 * 2**20); time.sleep(5)"])
+    try:
+        time.sleep(1)  # tiempo para que el hijo reserve su memoria
+        assert hijo.pid in benchmark._procesos_descendientes(os.getpid())
+        assert benchmark.rss_arbol_kib(hijo.pid) >= 64 * 1024
+        assert benchmark.rss_arbol_kib(os.getpid()) > benchmark.rss_arbol_kib(hijo.pid)
+    finally:
+        hijo.kill()
+
+
+def test_motor_ctranslate2_mismo_formato_que_openai():
+    import numpy as np
+    from types import SimpleNamespace
+    modelo = MagicMock()
+    modelo.transcribe.return_value = (
+        iter([SimpleNamespace(start=0.0, end=1.5, text=" Paciente consciente."),
+              SimpleNamespace(start=1.5, end=3.0, text=" Respira bien.")]),
+        SimpleNamespace(language="es"),
+    )
+    motor = inferencia.MotorCTranslate2("int8", 0, None)
+    opciones = dict(inferencia.opciones_whisper(), beam_size=None)
+
+    with patch.object(inferencia, "motor_whisper", motor), \
+            patch.object(inferencia.registro_modelos, "obtener", return_value=modelo):
+        resultado = inferencia._transcribir_segmento(np.zeros(48000, dtype=np.float32), 10.0, opciones, "tiny")
+
+    assert resultado == {
+        "texto": "Paciente consciente. Respira bien.",
+        "segmentos": [
+            {"inicio": 10.0, "fin": 11.5, "texto": "Paciente consciente."},
+            {"inicio": 11.5, "fin": 13.0, "texto": "Respira bien."},
+        ],
+    }
+    kwargs = modelo.transcribe.call_args.kwargs
+    assert kwargs["beam_size"] == 1 and kwargs["language"] == "es" and kwargs["vad_filter"] is False
+    assert motor.bytes_por_parametro == 1
+
+
+def test_pool_inferencia_reinicia_proceso_caido():
+    async def escenario():
+        pool = inferencia.PoolInferencia(1, 1, [None], precargar=False)
+        try:
+            assert await pool.ejecutar(abs, -3) == 3
+            # El proceso hijo solo importa inferencia, no la API (app, clientes, almacenamiento)
+            assert await pool.ejecutar(eval, "'main' in __import__('sys').modules") is False
+            with pytest.raises(inferencia.ProcesoInferenciaCaido):
+                await asyncio.wait_for(pool.ejecutar(os._exit, 1), 60)
+            assert await asyncio.wait_for(pool.ejecutar(abs, -2), 60) == 2
+            return pool.estado()
+        finally:
+            await pool.detener()
+
+    estado = asyncio.run(escenario())
+    assert estado["reinicios"] == 1 and estado["completados"] == 3 and estado["vivos"] == 1
+
+
+def test_pool_inferencia_lector_termina_tras_detener():
+    pool = inferencia.PoolInferencia(1, 1, [None], precargar=False)
+    loop = asyncio.new_event_loop()
+    loop.close()
+    # El proceso cierra su pipe cuando detener() ya limpió self._loop y el loop terminó
+    conexion = MagicMock(recv=MagicMock(side_effect=[("listo", None, 123), EOFError()]))
+    pool._leer_resultados(0, {"conexion": conexion}, loop)
+    assert pool._loop is None
+
+
+def test_pipeline_solapa_preparacion_con_inferencia():
+    eventos = []
+
+    async def preparar(id_audio, pasada="unica"):
+        eventos.append(("prep", id_audio))
+        await asyncio.sleep(0.05)
+        return {"id_audio": id_audio, "etapas_ms": {"descarga_decodificacion": 50.0, "preproceso": 0.0}}
+
+    async def inferir(preparado):
+        eventos.append(("inf", preparado["id_audio"]))
+        await asyncio.sleep(0.1)
+        return {"tiempo_ms": 100}
+
+    async def guardar(preparado, resultado):
+        eventos.append(("fin", preparado["id_audio"]))
+
+    async def escenario():
+        pipeline = audio_pipeline.PipelineTranscripcion(preparadores=2, inferidores=1, capacidad=1)
+        for i in range(4):
+            await audio_cola.encolar_transcripcion(f"a{i}")
+        inicio = asyncio.get_running_loop().time()
+        tareas = pipeline.tareas()
+        try:
+            while sum(1 for e in eventos if e[0] == "fin") < 4:
+                await asyncio.sleep(0.01)
+            return asyncio.get_running_loop().time() - inicio, pipeline.estado()
+        finally:
+            for tarea in tareas:
+                tarea.cancel()
+            pipeline.detener()
+
+    with reemplazar("cola_transcripcion", audio_cola.ColaTrabajosMemoria(60)), \
+            patch.object(audio_pipeline, "preparar_transcripcion", preparar), \
+            patch.object(audio_pipeline, "inferir_transcripcion", inferir), \
+            patch.object(audio_pipeline, "guardar_transcripcion", guardar):
+        duracion, estado = asyncio.run(escenario())
+
+    # En secuencia serían 4 x (50 + 100) ms; solapado queda cerca de 4 x 100 ms
+    assert duracion < 0.55
+    assert estado["etapas_ms"]["inferencia"]["p50"] == 100
+    assert estado["ocupacion_inferencia"] > 0.6
+
+
+def test_admision_rechaza_por_usuario_y_por_cola(client, token, mock_mongo):
+    cabeceras = {"Authorization": f"Bearer {token}"}
+    archivos = {"archivo": ("test.wav", BytesIO(WAV_PRUEBA), "audio/wav")}
+
+    mock_mongo.en_curso_usuario = audio_main.ADMISION_MAX_POR_USUARIO
+    r = client.post("/api/v1/audio/subir", files=archivos, headers=cabeceras)
+    assert r.status_code == 429
+    assert int(r.headers["Retry-After"]) >= 1 and "X-Finalizacion-Estimada" in r.headers
+
+    mock_mongo.en_curso_usuario = 0
+    profundidad = AsyncMock(return_value={"pendientes": 40, "en_curso": 2})
+    with patch.object(audio_cola.cola_transcripcion, "profundidad", profundidad), \
+            patch.object(audio_main, "ADMISION_MAX_ESPERA_S", 600), \
+            patch.object(audio_main, "WORKERS_TRANSCRIPCION", 2):
+        r = client.post("/api/v1/audio/subir", files=archivos, headers=cabeceras)
+    # 42 trabajos / 2 workers x 30 s = 630 s de espera estimada > 600 s
+    assert r.status_code == 503
+    assert int(r.headers["Retry-After"]) == 30
+
+
+def test_dos_pasadas_publica_borrador_y_luego_refinado(mock_mongo):
+    import numpy as np
+    doc = {"_id": "a1", "id_usuario": 1, "estado": "pendiente", "transcripcion": None}
+    publicados = []
+
+    async def actualizar(id_audio, campos):
+        doc.update(campos)
+        publicados.append(dict(campos))
+
+    async def find_one(query, *args, **kwargs):
+        return dict(doc)
+
+    async def obtener_audio(doc_audio):
+        return np.zeros(inferencia.FRECUENCIA_MUESTREO, dtype=np.float32)
+
+    async def ejecutar(audio, modelo):
+        return {"texto": f"texto con {modelo}", "modelo": modelo, "segmentos": [], "motor": "openai",
+                "modo": "completo", "tiempo_ms": 10, "rtf": 0.1}
+
+    async def escenario():
+        await audio_pipeline.transcribir_audio("a1", audio_pipeline.pasada_inicial())
+        borrador = dict(doc)
+        en_segundo_plano = await audio_cola.cola_transcripcion.pendientes_segundo_plano()
+        trabajo = await audio_cola.cola_transcripcion.reservar()
+        await audio_pipeline.transcribir_audio(trabajo["id_audio"], trabajo["pasada"])
+        return borrador, en_segundo_plano, trabajo
+
+    mock_mongo.find_one = find_one
+    with reemplazar("cola_transcripcion", audio_cola.ColaTrabajosMemoria(60)), \
+            patch.object(audio_pipeline, "TRANSCRIPCION_DOS_PASADAS", True), \
+            patch.object(audio_pipeline, "WHISPER_MODELO_BORRADOR", "tiny"), \
+            patch.object(audio_pipeline, "WHISPER_MODELO_REFINADO", "small"), \
+            patch.object(audio_pipeline, "actualizar_estado_audio", actualizar), \
+            patch.object(audio_pipeline, "obtener_audio_para_inferencia", obtener_audio), \
+            patch.object(audio_pipeline, "ejecutar_transcripcion", ejecutar):
+        borrador, en_segundo_plano, trabajo = asyncio.run(escenario())
+
+    assert borrador["estado"] == "completado" and "tiny" in borrador["transcripcion"]
+    assert borrador["version_transcripcion"] == 1 and borrador["refinamiento"] == "pendiente"
+    assert not audio_estados.estado_definitivo(audio_estados.datos_estado_audio(borrador))
+    # El refinado va a la cola con prioridad baja y no cuenta para la admisión
+    assert en_segundo_plano == 1
+    assert trabajo["id_trabajo"] == "a1:refinado" and trabajo["prioridad"] == audio_cola.PRIORIDAD_REFINADO
+    assert doc["version_transcripcion"] == 2 and doc["refinamiento"] == "completado"
+    assert "small" in doc["transcripcion"] and doc["transcripcion_borrador"] == borrador["transcripcion"]
+    assert audio_estados.estado_definitivo(audio_estados.datos_estado_audio(doc))
+    # El refinado no vuelve a pasar por "procesando": el borrador sigue visible
+    assert [p.get("estado") for p in publicados] == ["procesando", "completado", "completado"]
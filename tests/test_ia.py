@@ -2,9 +2,11 @@
 Tests del microservicio de IA: analizar, extraer, estadísticas, caché.
 Mocks: Gemini, MongoDB.
 """
+import asyncio
 import os
 import sys
-from unittest.mock import MagicMock, patch
+from datetime import datetime, timedelta, timezone
+from unittest.mock import AsyncMock, MagicMock, patch
 
 import pytest
 from fastapi.testclient import TestClient
@@ -23,6 +25,7 @@ def mock_gemini():
         resp = MagicMock()
         resp.text = '''{"texto_corregido": "Texto corregido.", "paciente": "Juan", "edad": 30, "motivo": "Dolor", "diagnostico": "N/A", "tratamiento": "N/A"}'''
         model.generate_content.return_value = resp
+        model.generate_content_async = AsyncMock(return_value=resp)
         genai_mod.GenerativeModel.return_value = model
         genai_mod.list_models.return_value = []
         yield model
@@ -123,3 +126,277 @@ def test_estadisticas(client, token):
 def test_limpiar_cache(client, token):
     r = client.delete("/api/v1/ia/cache/limpiar", headers={"Authorization": f"Bearer {token}"})
     assert r.status_code == 200
+
+
+RESPUESTA_GEMINI = (
+    '{"texto_corregido": "Texto corregido.", "paciente": "Ana", "edad": 40, '
+    '"motivo": "Caida", "diagnostico": "Contusion", "tratamiento": "Hielo"}'
+)
+
+
+def test_gemini_concurrencia_acotada_y_timeout_por_llamada():
+    activos = maximo = 0
+
+    async def rapido(prompt, generation_config=None):
+        nonlocal activos, maximo
+        activos += 1
+        maximo = max(maximo, activos)
+        await asyncio.sleep(0.05)
+        activos -= 1
+        return MagicMock(text=RESPUESTA_GEMINI)
+
+    async def lento(prompt, generation_config=None):
+        await asyncio.sleep(5)
+
+    modelos = {"gemini-2.0-flash": MagicMock(generate_content_async=lento)}
+
+    async def escenario():
+        return await asyncio.gather(*(ia_main.analizar_con_gemini("Paciente Ana, caida") for _ in range(6)))
+
+    with patch.object(ia_main, "genai") as genai_mod, \
+            patch.object(ia_main, "MODELOS_GEMINI_DISPONIBLES", []), \
+            patch.object(ia_main, "semaforo_gemini", asyncio.Semaphore(2)), \
+            patch.object(ia_main, "ruteador_gemini", ia_main.RuteadorModelos()), \
+            patch.object(ia_main, "GEMINI_TIMEOUT_S", 0.2):
+        genai_mod.GenerativeModel.side_effect = lambda m: modelos.get(m, MagicMock(generate_content_async=rapido))
+        timeouts = ia_main.metricas_gemini["timeouts"]
+        resultados = asyncio.run(escenario())
+
+    # El primer modelo agota su timeout y cada análisis sigue con el siguiente
+    assert [r["modelo_usado"] for r in resultados] == ["gemini-1.5-flash"] * 6
+    assert ia_main.metricas_gemini["timeouts"] - timeouts == 6
+    assert maximo == 2
+
+
+def test_cache_dos_niveles_memoria_delante_de_mongo():
+    consultas = []
+    creado = datetime.now(timezone.utc) - timedelta(days=ia_main.CACHE_IA_DIAS, seconds=-1)
+
+    async def find_one(filtro, proyeccion=None):
+        consultas.append(filtro)
+        if filtro["hash"] == "h1":
+            return {"resultado": {"modelo_usado": "gemini-2.0-flash"}, "fecha_creacion": creado}
+        return None
+
+    async def escenario():
+        primero = await ia_main.obtener_desde_cache("h1")
+        segundo = await ia_main.obtener_desde_cache("h1")
+        ausente = await ia_main.obtener_desde_cache("h2")
+        await asyncio.sleep(1.1)  # La entrada vence en memoria cuando vence en Mongo
+        vencido = ia_main.cache_memoria_ia.obtener("h1")
+        return primero, segundo, ausente, vencido
+
+    with patch.object(ia_main, "coleccion_cache_ia", MagicMock(find_one=find_one)), \
+            patch.object(ia_main, "cache_memoria_ia", ia_main.CacheMemoriaLRU(2)), \
+            patch.dict(ia_main.metricas_cache, {"memoria": {"aciertos": 0, "fallos": 0},
+                                                "mongo": {"aciertos": 0, "fallos": 0}}):
+        primero, segundo, ausente, vencido = asyncio.run(escenario())
+        estado = ia_main.estado_cache()
+
+    assert primero == segundo == {"modelo_usado": "gemini-2.0-flash"} and ausente is None and vencido is None
+    assert len(consultas) == 2 and "$gt" in consultas[0]["fecha_creacion"]
+    assert estado["memoria"]["aciertos"] == 1 and estado["memoria"]["fallos"] == 2
+    assert estado["mongo"]["aciertos"] == 1 and estado["mongo"]["fallos"] == 1
+
+    lru = ia_main.CacheMemoriaLRU(2)
+    vence = datetime.now(timezone.utc) + timedelta(hours=1)
+    for clave in ("a", "b"):
+        lru.guardar(clave, {"clave": clave}, vence)
+    lru.obtener("a")
+    lru.guardar("c", {"clave": "c"}, vence)
+    assert lru.obtener("b") is None and lru.obtener("a") == {"clave": "a"} and len(lru) == 2
+
+
+def test_indices_ia_ttl_hash_unico_y_logs():
+    from pymongo.errors import OperationFailure
+
+    cache = MagicMock(create_index=AsyncMock(side_effect=[None, OperationFailure("conflicto", code=85)]))
+    cache.name = "cache_ia"
+    logs = MagicMock(create_index=AsyncMock())
+    bd = MagicMock(command=AsyncMock())
+    with patch.object(ia_main, "coleccion_cache_ia", cache), \
+            patch.object(ia_main, "coleccion_logs_ia", logs), \
+            patch.object(ia_main, "bd", bd):
+        asyncio.run(ia_main._crear_indices_ia())
+
+    segundos = ia_main.CACHE_IA_DIAS * 86400
+    assert cache.create_index.call_args_list[0].kwargs["unique"] is True
+    assert cache.create_index.call_args_list[1].kwargs["expireAfterSeconds"] == segundos
+    # Índice TTL existente con otro vencimiento: se ajusta con collMod en lugar de fallar
+    assert bd.command.call_args.kwargs["index"] == {"name": "fecha_creacion_ttl", "expireAfterSeconds": segundos}
+    assert logs.create_index.call_args.args[0] == [("id_usuario", 1), ("fecha", -1)]
+
+
+def test_indices_ia_depura_duplicados_y_aisla_fallos():
+    from pymongo.errors import OperationFailure
+
+    class Cursor:
+        def __init__(self, grupos):
+            self.grupos = iter(grupos)
+
+        def __aiter__(self):
+            return self
+
+        async def __anext__(self):
+            try:
+                return next(self.grupos)
+            except StopIteration:
+                raise StopAsyncIteration
+
+    duplicado = OperationFailure("E11000 duplicate key", code=11000)
+    cache = MagicMock(
+        # hash_unico falla por duplicados, se depura y vuelve a fallar: índice no único; el TTL falla aparte
+        create_index=AsyncMock(side_effect=[duplicado, duplicado, None, OperationFailure("sin permisos", code=13)]),
+        aggregate=MagicMock(return_value=Cursor([{"_id": "h1", "ids": ["nuevo", "viejo1", "viejo2"], "total": 3}])),
+        delete_many=AsyncMock(return_value=MagicMock(deleted_count=2)),
+    )
+    logs = MagicMock(create_index=AsyncMock())
+    with patch.object(ia_main, "coleccion_cache_ia", cache), patch.object(ia_main, "coleccion_logs_ia", logs):
+        asyncio.run(ia_main._crear_indices_ia())
+
+    # Se conserva la entrada más reciente de cada hash
+    assert cache.delete_many.call_args.args[0] == {"_id": {"$in": ["viejo1", "viejo2"]}}
+    assert cache.create_index.call_args_list[2].kwargs == {"name": "hash_busqueda"}
+    # El fallo del TTL no impide el índice de logs
+    logs.create_index.assert_awaited_once()
+
+
+def test_coalescencia_una_llamada_por_hash_en_curso():
+    llamadas = []
+
+    async def calcular():
+        llamadas.append(1)
+        await asyncio.sleep(0.05)
+        return {"modelo_usado": "gemini-2.0-flash"}
+
+    async def fallar():
+        await asyncio.sleep(0.05)
+        raise RuntimeError("gemini caido")
+
+    async def escenario():
+        coalescedor = ia_main.CoalescedorAnalisis()
+        iguales = await asyncio.gather(*(coalescedor.ejecutar("h1", calcular) for _ in range(5)))
+        otro = await coalescedor.ejecutar("h2", calcular)
+        errores = await asyncio.gather(*(coalescedor.ejecutar("h3", fallar) for _ in range(2)), return_exceptions=True)
+        return coalescedor, iguales, otro, errores
+
+    coalescedor, iguales, otro, errores = asyncio.run(escenario())
+    assert len(llamadas) == 2
+    assert [coalescido for _, coalescido in iguales].count(False) == 1
+    assert all(r == {"modelo_usado": "gemini-2.0-flash"} for r, _ in iguales) and otro[1] is False
+    assert all(isinstance(e, RuntimeError) for e in errores)
+    assert coalescedor.estado()["coalescidos_worker"] == 5 and coalescedor.estado()["en_curso"] == 0
+
+
+def test_coalescencia_sobrevive_a_la_cancelacion_del_iniciador():
+    async def calcular():
+        await asyncio.sleep(0.05)
+        return {"modelo_usado": "heuristico"}
+
+    async def escenario():
+        coalescedor = ia_main.CoalescedorAnalisis()
+        iniciador = asyncio.ensure_future(coalescedor.ejecutar("h1", calcular))
+        await asyncio.sleep(0)
+        seguidor = asyncio.ensure_future(coalescedor.ejecutar("h1", calcular))
+        await asyncio.sleep(0)
+        iniciador.cancel()
+        return await seguidor, iniciador.cancelled(), coalescedor
+
+    (resultado, desde_cache), cancelado, coalescedor = asyncio.run(escenario())
+    assert cancelado and resultado == {"modelo_usado": "heuristico"}
+    # El respaldo heurístico no se guarda en caché: compartirlo no es un acierto de caché
+    assert desde_cache is False
+    assert coalescedor.estado()["calculados"] == 1 and coalescedor.estado()["en_curso"] == 0
+
+
+def test_coalescencia_entre_workers_espera_resultado_en_cache():
+    redis = MagicMock(set=AsyncMock(return_value=False), exists=AsyncMock(return_value=True))
+    ahora = datetime.now(timezone.utc)
+    # Sin resultado, luego una entrada heurística antigua (se ignora) y luego el del otro worker
+    documentos = [None, {"resultado": {"modelo_usado": "heuristico"}, "fecha_creacion": ahora},
+                  {"resultado": {"modelo_usado": "gemini-2.0-flash"}, "fecha_creacion": ahora}]
+    coleccion = MagicMock(find_one=AsyncMock(side_effect=documentos))
+    metricas = {"memoria": {"aciertos": 0, "fallos": 0}, "mongo": {"aciertos": 0, "fallos": 0}}
+
+    calcular = AsyncMock()
+    coalescedor = ia_main.CoalescedorAnalisis()
+    coalescedor.cliente = redis
+    with patch.object(ia_main, "coleccion_cache_ia", coleccion), \
+            patch.object(ia_main, "cache_memoria_ia", ia_main.CacheMemoriaLRU(10)), \
+            patch.object(ia_main, "metricas_cache", metricas), \
+            patch.object(ia_main, "COALESCENCIA_SONDEO_S", 0.01):
+        resultado, coalescido = asyncio.run(coalescedor.ejecutar("h1", calcular))
+
+    # Otro worker tiene el bloqueo: no se llama a Gemini, se lee su resultado
+    assert coalescido is True and resultado == {"modelo_usado": "gemini-2.0-flash"}
+    calcular.assert_not_called()
+    assert coleccion.find_one.await_count == 3
+    assert redis.set.call_args.kwargs == {"nx": True, "ex": ia_main.COALESCENCIA_BLOQUEO_S}
+    # Los sondeos no cuentan como aciertos ni fallos de caché
+    assert metricas == {"memoria": {"aciertos": 0, "fallos": 0}, "mongo": {"aciertos": 0, "fallos": 0}}
+
+
+def test_resultado_heuristico_no_se_guarda_en_cache():
+    heuristico = ia_main.analisis_heuristico("Paciente de 40 años con dolor abdominal.")
+    guardar = AsyncMock()
+    with patch.object(ia_main, "obtener_desde_cache", AsyncMock(return_value=None)), \
+            patch.object(ia_main, "guardar_en_cache", guardar), \
+            patch.object(ia_main, "registrar_log_ia", AsyncMock()), \
+            patch.object(ia_main, "coalescedor_ia", ia_main.CoalescedorAnalisis()):
+        # Gemini caído o con timeout: analizar_con_gemini devuelve el respaldo heurístico
+        with patch.object(ia_main, "analizar_con_gemini", AsyncMock(return_value=heuristico)):
+            asyncio.run(ia_main.analizar_texto(
+                ia_main.SolicitudAnalisis(texto="Paciente de 40 años con dolor abdominal."), {"sub": "1"}))
+        guardar.assert_not_awaited()
+
+        with patch.object(ia_main, "analizar_con_gemini",
+                          AsyncMock(return_value={**heuristico, "modelo_usado": "gemini-2.0-flash"})):
+            asyncio.run(ia_main.analizar_texto(
+                ia_main.SolicitudAnalisis(texto="Paciente de 40 años con dolor abdominal."), {"sub": "1"}))
+        guardar.assert_awaited_once()
+
+
+def test_ruteador_elige_el_mas_rapido_y_abre_circuito():
+    import time
+
+    ruteador = ia_main.RuteadorModelos()
+    with patch.object(ia_main, "CIRCUITO_ABIERTO_S", 0.05):
+        ruteador.registrar("a", True, 800)
+        ruteador.registrar("b", True, 200)
+        # "c" no tiene muestras: turno de prueba al final, no una latencia de 0 ms
+        assert ruteador.ordenar(["a", "b", "c"]) == ["b", "a", "c"]
+        ruteador.registrar("c", True, 500)
+        assert ruteador.ordenar(["a", "b", "c"]) == ["b", "c", "a"]
+
+        for _ in range(ia_main.CIRCUITO_FALLOS_SEGUIDOS):
+            ruteador.registrar("b", False)
+        assert ruteador.ordenar(["a", "b", "c"]) == ["c", "a"]
+        assert ruteador.estado()["modelos"]["b"]["circuito"] == "abierto"
+
+        time.sleep(0.06)
+        # Semiabierto: una sola solicitud lo sondea, las demás siguen sin él
+        assert ruteador.ordenar(["a", "b", "c"]) == ["b", "c", "a"]
+        assert ruteador.ordenar(["a", "b", "c"]) == ["c", "a"]
+        ruteador.registrar("b", True, 100)
+        # Al abrirse la ventana empezó de cero: sin errores y con el p50 más bajo
+        assert ruteador.ordenar(["a", "b", "c"]) == ["b", "c", "a"]
+
+    estado = ruteador.estado()
+    assert estado["modelos"]["b"]["circuito"] == "cerrado" and estado["modelos"]["b"]["aperturas"] == 1
+    assert estado["primera_eleccion"]["b"] == 4 and estado["primera_eleccion"]["c"] == 2
+
+
+def test_ruteador_sin_exitos_recientes_solo_un_turno_al_final():
+    ruteador = ia_main.RuteadorModelos()
+    ruteador.registrar("a", True, 800)
+    ruteador.registrar("b", False)  # Falló sin abrir el circuito: sin latencia exitosa
+    ruteador.registrar("e", True, 100)
+    ruteador.registrar("e", False)  # Más rápido, pero con errores en la ventana
+    assert ruteador.ordenar(["e", "a"]) == ["a", "e"]
+    # Sin ningún modelo medido se intentan todos en el orden configurado
+    assert ruteador.ordenar(["b", "c", "d"]) == ["b", "c", "d"]
+    # Con uno medido, solo un modelo sin éxitos ocupa el turno de prueba: el nunca intentado
+    assert ruteador.ordenar(["a", "b", "c"]) == ["a", "c"]
+    ruteador.registrar("c", False)
+    # Ahora el intentado hace más tiempo
+    assert ruteador.ordenar(["a", "b", "c"]) == ["a", "b"]